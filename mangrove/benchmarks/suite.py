@@ -0,0 +1,263 @@
+""" Benchmarks of mangrove's hot paths.
+
+    python -m mangrove.benchmarks.suite [--server memory://benchmarks/] [--sizes 10000 100000 1000000]
+                                       [--repeat 200] [--output results.json]
+
+Covers SMS parse -> validate -> save throughput, get_form_model_by_code
+latency, by_short_code lookups, aggregate_for_time_period over 10k, 100k
+and 1M data records, and survey response listing. Every benchmark runs in
+a database of its own which is deleted afterwards.
+
+The report is JSON so runs can be diffed or compared for regressions. A
+benchmark that fails is reported with its error and does not stop the
+others. --server defaults to the in-process memory:// backend; pass a
+CouchDB url, e.g. http://localhost:5984/, to measure a real server.
+
+Saving the questionnaire of every fixture looks the form model up through
+the form model cache. On the memory:// backend that cache is an
+in-process dict; with a CouchDB url the benchmarks need the memcached
+servers in mangrove.datastore.settings.CACHE_SERVERS.
+"""
+
+import argparse
+import copy
+from datetime import datetime
+import json
+import platform
+import random
+import sys
+import traceback
+from time import time
+
+import pytz
+
+from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
+from mangrove.datastore.entity import create_entity, by_short_code
+from mangrove.datastore.entity_type import define_type
+from mangrove.form_model import form_model as form_model_module
+from mangrove.form_model.field import UniqueIdField, IntegerField
+from mangrove.form_model.form_model import FormModel, get_form_model_by_code, NAME_FIELD, MOBILE_NUMBER_FIELD
+from mangrove.form_model.validation import NumericRangeConstraint
+from mangrove.datastore.time_period_aggregation import aggregate_for_time_period, Sum, Min, Max, Latest, Month, Year
+from mangrove.transport.contract.request import Request
+from mangrove.transport.contract.transport_info import TransportInfo
+from mangrove.transport.player.new_players import SMSPlayerV2
+from mangrove.transport.repository.reporters import REPORTER_ENTITY_TYPE
+from mangrove.transport.repository.survey_responses import get_survey_responses
+
+DEFAULT_SERVER = 'memory://benchmarks/'
+DEFAULT_SIZES = (10000, 100000, 1000000)
+DEFAULT_REPEAT = 200
+NUMBER_OF_CLINICS = 100
+SAVE_BATCH_SIZE = 1000
+
+FORM_CODE = 'clinic'
+CLINIC_TYPE = ['clinic']
+REPORTER_MOBILE_NUMBER = '1234'
+
+
+def timings(func, repeat):
+    """Calls func repeat times and summarises the wall clock time of the calls"""
+    times = []
+    for i in range(repeat):
+        start = time()
+        func(i)
+        times.append(time() - start)
+    times.sort()
+    total = sum(times)
+    return {'calls': repeat, 'total_time': total, 'mean_time': total / repeat, 'min_time': times[0],
+            'median_time': times[repeat // 2], 'p95_time': times[min(repeat - 1, int(repeat * 0.95))],
+            'max_time': times[-1], 'calls_per_second': repeat / total if total else None}
+
+
+class LocalCache(object):
+    """In-process stand-in for the memcached client of get_cache_manager, values are copied like memcached does"""
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key):
+        return copy.deepcopy(self._values.get(key))
+
+    def set(self, key, value, time=0):
+        self._values[key] = copy.deepcopy(value)
+
+    def delete(self, key):
+        self._values.pop(key, None)
+
+
+class Fixture(object):
+    """A fresh database with the views, a reporter, NUMBER_OF_CLINICS clinics and the clinic questionnaire"""
+
+    def __init__(self, server, name):
+        self.dbm = get_db_manager(server, 'mangrove-benchmark-%s' % name)
+        initializer.sync_views(self.dbm, warm=False)
+        define_type(self.dbm, REPORTER_ENTITY_TYPE)
+        define_type(self.dbm, CLINIC_TYPE)
+        self._create_reporter()
+        self.short_codes = self._create_clinics()
+        self.form_model = self._create_form_model()
+
+    def close(self):
+        _delete_db_and_remove_db_manager(self.dbm)
+
+    def _create_reporter(self):
+        reporter = create_entity(self.dbm, entity_type=REPORTER_ENTITY_TYPE, location=['India', 'Pune'],
+                                 short_code='rep1')
+        reporter.add_data(data=[(MOBILE_NUMBER_FIELD, REPORTER_MOBILE_NUMBER), (NAME_FIELD, 'Reporter')],
+                          submission=dict(submission_id='1'))
+
+    def _create_clinics(self):
+        short_codes = ['cli%d' % i for i in range(NUMBER_OF_CLINICS)]
+        with self.dbm.batch(max_size=SAVE_BATCH_SIZE):
+            for short_code in short_codes:
+                create_entity(self.dbm, entity_type=CLINIC_TYPE, location=['India', 'Pune'],
+                              short_code=short_code).save()
+        return short_codes
+
+    def _create_form_model(self):
+        fields = [UniqueIdField('clinic', name='clinic', code='EID', label='Which clinic'),
+                  IntegerField(name='beds', code='BEDS', label='Beds', required=False,
+                               constraints=[NumericRangeConstraint(min=0, max=1000)]),
+                  IntegerField(name='arv', code='ARV', label='ARV stock', required=False,
+                               constraints=[NumericRangeConstraint(min=0, max=1000)])]
+        form_model = FormModel(self.dbm, name='clinic', label='Clinic report', form_code=FORM_CODE, fields=fields)
+        form_model.save()
+        return form_model
+
+    def add_data_records(self, count):
+        entities = [by_short_code(self.dbm, short_code, CLINIC_TYPE) for short_code in self.short_codes]
+        submission = dict(form_code=FORM_CODE)
+        with self.dbm.batch(max_size=SAVE_BATCH_SIZE):
+            for i in range(count):
+                event_time = datetime(2012, 1 + i % 12, 1 + i % 28, tzinfo=pytz.UTC)
+                entities[i % len(entities)].add_data(data=[('beds', i % 500), ('arv', i % 300)],
+                                                      event_time=event_time, submission=submission)
+
+    def sms(self, i):
+        return '%s .EID %s .BEDS %d .ARV %d' % (FORM_CODE, self.short_codes[i % len(self.short_codes)], i % 500,
+                                               i % 300)
+
+
+def benchmark_sms_submission(server, repeat, **kwargs):
+    fixture = Fixture(server, 'sms')
+    try:
+        player = SMSPlayerV2(fixture.dbm, [])
+        transport_info = TransportInfo(transport='sms', source=REPORTER_MOBILE_NUMBER, destination='5678')
+        submit = lambda i: player.add_survey_response(Request(message=fixture.sms(i), transportInfo=transport_info))
+        return [dict(timings(submit, repeat), name='sms_submission')]
+    finally:
+        fixture.close()
+
+
+def benchmark_form_model_lookup(server, repeat, **kwargs):
+    fixture = Fixture(server, 'form-model')
+    try:
+        lookup = lambda i: get_form_model_by_code(fixture.dbm, FORM_CODE)
+        return [dict(timings(lookup, repeat), name='get_form_model_by_code')]
+    finally:
+        fixture.close()
+
+
+def benchmark_short_code_lookup(server, repeat, **kwargs):
+    fixture = Fixture(server, 'short-code')
+    try:
+        lookup = lambda i: by_short_code(fixture.dbm, random.choice(fixture.short_codes), CLINIC_TYPE)
+        return [dict(timings(lookup, repeat), name='by_short_code')]
+    finally:
+        fixture.close()
+
+
+def benchmark_aggregation(server, repeat, sizes=DEFAULT_SIZES, **kwargs):
+    results = []
+    aggregates = [Sum('beds'), Min('beds'), Max('arv'), Latest('arv')]
+    for size in sizes:
+        fixture = Fixture(server, 'aggregation-%d' % size)
+        try:
+            start = time()
+            fixture.add_data_records(size)
+            load_time = time() - start
+            aggregate = lambda i, period: aggregate_for_time_period(fixture.dbm, FORM_CODE, period, aggregates)
+            # the first query includes building the views, report it on its own
+            cold = timings(lambda i: aggregate(i, Month(1, 2012)), 1)
+            results.append(dict(timings(lambda i: aggregate(i, Month(1 + i % 12, 2012)), repeat),
+                                name='aggregate_for_time_period.month', data_records=size,
+                                load_time=load_time, first_call_time=cold['total_time']))
+            results.append(dict(timings(lambda i: aggregate(i, Year(2012)), max(1, repeat // 10)),
+                                name='aggregate_for_time_period.year', data_records=size))
+        finally:
+            fixture.close()
+    return results
+
+
+def benchmark_survey_response_listing(server, repeat, **kwargs):
+    fixture = Fixture(server, 'survey-responses')
+    try:
+        player = SMSPlayerV2(fixture.dbm, [])
+        transport_info = TransportInfo(transport='sms', source=REPORTER_MOBILE_NUMBER, destination='5678')
+        for i in range(repeat):
+            player.add_survey_response(Request(message=fixture.sms(i), transportInfo=transport_info))
+        end = (int(time()) + 24 * 60 * 60) * 1000
+        list_all = lambda i: get_survey_responses(fixture.dbm, fixture.form_model.id, 0, end)
+        list_page = lambda i: get_survey_responses(fixture.dbm, fixture.form_model.id, 0, end, page_number=i % 4,
+                                                   page_size=25)
+        return [dict(timings(list_all, max(1, repeat // 10)), name='get_survey_responses', survey_responses=repeat),
+                dict(timings(list_page, repeat), name='get_survey_responses.page', survey_responses=repeat)]
+    finally:
+        fixture.close()
+
+
+BENCHMARKS = [
+    ('sms_submission', benchmark_sms_submission),
+    ('form_model_lookup', benchmark_form_model_lookup),
+    ('short_code_lookup', benchmark_short_code_lookup),
+    ('aggregation', benchmark_aggregation),
+    ('survey_response_listing', benchmark_survey_response_listing),
+]
+
+
+def run(server=DEFAULT_SERVER, sizes=DEFAULT_SIZES, repeat=DEFAULT_REPEAT, only=None):
+    """Runs the benchmarks (those named in only, or all) and returns the report as a dict"""
+    report = {'started': datetime.now(pytz.UTC).isoformat(), 'server': server, 'python': platform.python_version(),
+              'platform': platform.platform(), 'repeat': repeat, 'results': [], 'errors': []}
+    get_cache_manager = form_model_module.get_cache_manager
+    if server.startswith(memory_backend.MEMORY_URL_SCHEME):
+        cache = LocalCache()
+        form_model_module.get_cache_manager = lambda: cache
+    try:
+        for name, benchmark in BENCHMARKS:
+            if only and name not in only:
+                continue
+            try:
+                report['results'].extend(benchmark(server, repeat, sizes=sizes))
+            except Exception as e:
+                report['errors'].append({'name': name, 'error': repr(e), 'traceback': traceback.format_exc()})
+    finally:
+        form_model_module.get_cache_manager = get_cache_manager
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of mangrove hot paths, reported as JSON')
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='number of data records to aggregate over')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS])
+    parser.add_argument('--output', help='file to write the report to, defaults to stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args.server, args.sizes, args.repeat, args.only)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print output
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
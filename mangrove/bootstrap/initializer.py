@@ -2,10 +2,13 @@
 from glob import iglob
 import string
 import os
-from views import view_js
+from threading import Thread
+from couchdb.http import ResourceConflict
+from views import view_design_docs, design_docs
 from mangrove.contrib.deletion import create_default_delete_form_model, ENTITY_DELETION_FORM_CODE
 from mangrove.contrib.registration import create_default_reg_form_model
 from mangrove.datastore.entity_type import define_type
+from mangrove.datastore.view_warmer import warm_up
 from mangrove.errors.MangroveException import FormModelDoesNotExistsException, EntityTypeAlreadyDefined
 from mangrove.form_model.form_model import get_form_model_by_code, REGISTRATION_FORM_CODE
 from mangrove.transport.repository.reporters import REPORTER_ENTITY_TYPE
@@ -49,23 +52,64 @@ def _create_entity_types(manager, entity_types):
 
 def _create_views(dbm):
     """Creates a standard set of views in the database"""
-    database_manager = dbm
-    for v in view_js.keys():
-        if not _exists_view(v, database_manager):
-            funcs = view_js[v]
-            map = (funcs['map'] if 'map' in funcs else None)
-            reduce = (funcs['reduce'] if 'reduce' in funcs else None)
-            database_manager.create_view(v, map, reduce)
-
-
-def sync_views(dbm):
-    """Updates or Creates a standard set of views in the database"""
-    database_manager = dbm
-    for v in view_js.keys():
-        funcs = view_js[v]
-        map = (funcs['map'] if 'map' in funcs else None)
-        reduce = (funcs['reduce'] if 'reduce' in funcs else None)
-        database_manager.create_view(v, map, reduce)
+    sync_views(dbm, warm=False)
+
+
+def sync_views(dbm, warm=True):
+    """
+    Updates or Creates a standard set of views in the database.
+
+    Only design documents whose functions differ from bootstrap/views are
+    written, in one bulk update, so unchanged indexes are left alone.
+    Design documents that held a single view before views were grouped by
+    document type are deleted. Unless warm is False, the indexes of the
+    design documents written are then built in the background.
+
+    Returns the names of the design documents written.
+    """
+    docs = []
+    changed = []
+    for design, views in design_docs.items():
+        doc_id = '_design/%s' % design
+        doc = dbm.database.get(doc_id) or {'_id': doc_id}
+        functions = dict((name, _view_functions(funcs)) for name, funcs in views.items())
+        if doc.get('views') != functions or doc.get('language') != 'javascript':
+            doc['views'] = functions
+            doc['language'] = 'javascript'
+            docs.append(doc)
+            changed.append(design)
+    for name, design in view_design_docs.items():
+        old = dbm.database.get('_design/%s' % name) if design != name else None
+        if old is not None and set(old.get('views', {}).keys()) <= set([name]):
+            docs.append({'_id': old['_id'], '_rev': old['_rev'], '_deleted': True})
+
+    for success, doc_id, rev_or_exc in (dbm.database.update(docs) if docs else []):
+        # a conflict means another process synced the same design document first
+        if not success and not isinstance(rev_or_exc, ResourceConflict):
+            raise rev_or_exc
+    if warm and changed:
+        warm_up_views(dbm, changed)
+    return changed
+
+
+def _view_functions(funcs):
+    return dict((func, funcs[func]) for func in ('map', 'reduce') if func in funcs)
+
+
+def warm_up_views(dbm, designs=None, background=True):
+    """
+    Queries one view of each design document (all of them by default) so
+    that CouchDB brings the whole design document's index up to date now
+    rather than on the next request. Returns the thread doing it when
+    background is True.
+    """
+    designs = designs if designs is not None else design_docs.keys()
+    if not background:
+        return warm_up(dbm, designs)
+    thread = Thread(target=warm_up, args=(dbm, designs), name='view-warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
 
 
 def find_views(view_dir):
@@ -81,12 +125,3 @@ def find_views(view_dir):
             # doesn't match pattern, or file could be read, just skip
             pass
     return views
-
-def _exists_view(aggregation, database_manager):
-    entity_type_views = database_manager.\
-    _load_document('_design/%s' % aggregation)
-    if entity_type_views is not None and entity_type_views['views'].get(aggregation):
-        return True
-    return False
-
-
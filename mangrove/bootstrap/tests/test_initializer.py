@@ -0,0 +1,50 @@
+import unittest
+from couchdb.design import ViewDefinition
+from mangrove.bootstrap import initializer
+from mangrove.bootstrap.views import design_docs, design_doc_for_view, view_js
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import DatabaseManager
+
+
+class TestSyncViews(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://initializer-test/', 'mangrove-test')
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://initializer-test/')['mangrove-test']
+
+    def test_should_group_views_by_document_type(self):
+        self.assertEqual('entity_views', design_doc_for_view('by_short_codes'))
+        self.assertEqual('datarecord_views', design_doc_for_view('monthly_aggregate_stats'))
+        self.assertEqual('surveyresponse_views', design_doc_for_view('surveyresponse'))
+        self.assertEqual('project_names', design_doc_for_view('project_names'))
+
+    def test_should_write_only_changed_design_docs(self):
+        self.assertEqual(sorted(design_docs), sorted(initializer.sync_views(self.dbm, warm=False)))
+        self.assertEqual([], initializer.sync_views(self.dbm, warm=False))
+
+        doc = self.dbm.database['_design/entity_views']
+        doc['views']['by_short_codes']['map'] = 'function(doc) {}'
+        self.dbm.database.save(doc)
+
+        self.assertEqual(['entity_views'], initializer.sync_views(self.dbm, warm=False))
+        self.assertEqual(view_js['by_short_codes']['map'],
+                         self.dbm.database['_design/entity_views']['views']['by_short_codes']['map'])
+
+    def test_should_delete_superseded_single_view_design_docs(self):
+        ViewDefinition('by_short_codes', 'by_short_codes', view_js['by_short_codes']['map']).sync(self.dbm.database)
+        ViewDefinition('project_names', 'project_names', 'function(doc) {}').sync(self.dbm.database)
+
+        initializer.sync_views(self.dbm, warm=False)
+
+        self.assertNotIn('_design/by_short_codes', self.dbm.database)
+        self.assertIn('_design/project_names', self.dbm.database)
+
+    def test_should_warm_up_changed_design_docs(self):
+        initializer.sync_views(self.dbm, warm=False)
+        self.dbm.database.save({'_id': 'e1', 'document_type': 'Entity', 'aggregation_paths': {'_type': ['clinic']},
+                                'short_code': 'cli1'})
+
+        initializer.warm_up_views(self.dbm, ['entity_views'], background=False)
+
+        self.assertIn('entity_views/' + sorted(design_docs['entity_views'])[0], self.dbm.database._indexes)
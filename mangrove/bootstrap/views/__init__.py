@@ -1,8 +1,12 @@
 
+from collections import defaultdict
 from glob import iglob
+import re
 import string
 import os
 
+DOCUMENT_TYPE_PATTERN = re.compile(r"document_type\s*==\s*[\"'](\w+)[\"']")
+
 def _find_views():
     views = {}
     for fn in iglob(os.path.join(os.path.dirname(__file__), '*.js')):
@@ -17,4 +21,32 @@ def _find_views():
             pass
     return views
 
-view_js = _find_views()
\ No newline at end of file
+
+def _design_doc_for(view_name, funcs):
+    """
+    Views that index the same document type share a design document, so
+    CouchDB builds them in one pass over the database. A view that does
+    not name exactly one document_type keeps a design document of its own.
+    """
+    document_types = set(DOCUMENT_TYPE_PATTERN.findall(funcs.get('map', '')))
+    if len(document_types) != 1:
+        return view_name
+    return document_types.pop().lower() + '_views'
+
+
+def _group_views(views):
+    view_design_docs = {}
+    design_docs = defaultdict(dict)
+    for name, funcs in views.items():
+        design = _design_doc_for(name, funcs)
+        view_design_docs[name] = design
+        design_docs[design][name] = funcs
+    return view_design_docs, dict(design_docs)
+
+view_js = _find_views()
+view_design_docs, design_docs = _group_views(view_js)
+
+
+def design_doc_for_view(view_name):
+    """Name of the design document holding view_name; views mangrove doesn't ship have one of their own"""
+    return view_design_docs.get(view_name, view_name)
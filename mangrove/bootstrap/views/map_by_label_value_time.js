@@ -0,0 +1,8 @@
+function(doc) {
+    if (!doc.void && doc.document_type == "DataRecord") {
+        var date = Date.parse(doc.event_time);
+        for (var label in doc.data) {
+            emit([label, doc.data[label].value, date], doc.entity._id);
+        }
+    }
+}
@@ -0,0 +1,8 @@
+function(doc) {
+    if (!doc.void && doc.document_type == "DataRecord") {
+        var date = Date.parse(doc.event_time);
+        for (k in doc.data) {
+            emit([doc.entity._id, k], {"timestamp": date, "value": doc.data[k].value});
+        }
+    }
+}
@@ -0,0 +1,7 @@
+function(doc) {
+    if (doc.document_type == "Entity" && !doc.void) {
+        for (var label in doc.data) {
+            emit([label, doc.data[label].value], null);
+        }
+    }
+}
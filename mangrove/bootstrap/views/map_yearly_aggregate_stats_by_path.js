@@ -0,0 +1,19 @@
+function(doc) {
+    if (!doc.void && doc.document_type == "DataRecord") {
+        var entity_type = doc.entity.aggregation_paths['_type'];
+        var date = new Date(doc.event_time);
+        for (f in doc.data) {
+            var value = doc.data[f].value;
+            if (typeof(value) == 'number') {
+                for (p in doc.entity.aggregation_paths) {
+                    // the short code goes last, in a list, so a group_level cut
+                    // through a short path can't be taken for a path element
+                    var k = [date.getUTCFullYear(), doc.submission.form_code, entity_type, p, f];
+                    k = k.concat(doc.entity.aggregation_paths[p]);
+                    k.push([doc.entity.short_code]);
+                    emit(k, value);
+                }
+            }
+        }
+    }
+}
@@ -1,16 +1,23 @@
 import datetime
+import sys
 from mangrove.datastore.database import get_db_manager,\
     _delete_db_and_remove_db_manager
-from mangrove.bootstrap.initializer import _find_views
+from mangrove.bootstrap.views import view_js
 from pytz import UTC
 import random
 from mangrove.datastore.entity import Entity
 from collections import defaultdict
 
 
+DATA_LABELS = ['beds', 'patients', 'meds', 'doctors']
+
+
 class ViewGenerationTimer(object):
+    def __init__(self, server='http://localhost:5984/'):
+        self.server = server
+
     def _set_db_manager(self):
-        self.manager = get_db_manager('http://localhost:5984/',
+        self.manager = get_db_manager(self.server,
                                       'mangrove-test')
 
     def _delete_db_and_remove_db_manager(self):
@@ -25,7 +32,6 @@ class ViewGenerationTimer(object):
         self._number_of_entities = number_of_entities
         self._refresh_db_manager()
         self._setup_entities()
-        self._setup_datadict_types()
         self._add_data_to_entities(number_of_data_records_per_entity)
 
     def _setup_entities(self):
@@ -61,7 +67,7 @@ class ViewGenerationTimer(object):
     def _add_data_to_entities(self, number_of_data_records_per_entity):
         months = [1]
         number_of_years = number_of_data_records_per_entity / (
-            len(self.dd_types) * len(months)
+            len(DATA_LABELS) * len(months)
             )
         years = range(2011 - max(1, number_of_years), 2011)
         event_times = []
@@ -70,15 +76,15 @@ class ViewGenerationTimer(object):
                 event_time = datetime.datetime(year, month, 1, tzinfo=UTC)
                 event_times.append(event_time)
 
-        #for e in self.entities:
-        #    for dd_type in self.dd_types.values():
-        #        for event_time in event_times:
-        #            slug = dd_type.slug
-        #            value = random.random()
-        #            e.add_data(
-        #                data=[(slug, value, self.dd_types[slug])],
-        #                event_time=event_time
-        #            )
+        with self.manager.batch(max_size=1000):
+            for e in self.entities:
+                for label in DATA_LABELS:
+                    for event_time in event_times:
+                        e.add_data(
+                            data=[(label, random.random())],
+                            event_time=event_time,
+                            submission=dict(form_code='CL1')
+                        )
 
     def print_csv_of_view_generation_times(self):
         iterations = [20, 40, 60, 80, 100]
@@ -103,15 +109,14 @@ class ViewGenerationTimer(object):
     def _calculate_view_generation_time(self, number_of_entities, number_of_data_records_per_entity):
         self._reset(number_of_entities, number_of_data_records_per_entity)
 
-        js_views = _find_views()
         times = {}
-        for v in js_views.keys():
-            funcs = js_views[v]
+        for v in view_js.keys():
+            funcs = view_js[v]
             js_map = (funcs['map'] if 'map' in funcs else None)
             js_reduce = (funcs['reduce'] if 'reduce' in funcs else None)
             start = datetime.datetime.now()
-            self.manager.create_view(v, js_map, js_reduce, view_document=v)
-            all_rows = self.manager.load_all_rows_in_view(v + "/" + v)
+            self.manager.create_view(v, js_map, js_reduce)
+            all_rows = self.manager.load_all_rows_in_view(v)
             # we need to hit the view to make sure it compiles
             number_of_rows = len(all_rows)
             end = datetime.datetime.now()
@@ -121,7 +126,7 @@ class ViewGenerationTimer(object):
 
 if __name__ == "__main__":
     divider = "-" * 70
-    timer = ViewGenerationTimer()
+    timer = ViewGenerationTimer(*sys.argv[1:2])
     print divider
     timer.print_view_generation_times()
     print divider
@@ -0,0 +1,343 @@
+""" Python equivalents of the javascript views in this directory.
+
+They are used by the in-memory datastore backend, which cannot run
+javascript. Each map function takes a plain JSON document (dates are
+still ISO strings) and an emit callable; each reduce function has the
+CouchDB signature reduce(keys, values, rereduce). Built-in reduces
+('_count', '_sum', '_stats') are left to the backend.
+
+The ports are deliberately literal, quirks included (e.g. the week
+number arithmetic of the weekly views), so that emitted keys match what
+CouchDB produces for the same documents. Date getters that the
+javascript calls in local time are evaluated in UTC, the timezone the
+CouchDB servers run in.
+"""
+
+import math
+from datetime import datetime, timedelta
+from numbers import Number
+
+import pytz
+
+from mangrove.utils.dates import js_datestring_to_py_datetime, convert_date_time_to_epoch
+
+def _date(value):
+    return js_datestring_to_py_datetime(value)
+
+
+def _date_parse(value):
+    """Date.parse(value): milliseconds since the epoch"""
+    return convert_date_time_to_epoch(_date(value))
+
+
+def _js_date_json(date):
+    """JSON serialization of a javascript Date"""
+    return date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (date.microsecond // 1000)
+
+
+def _js_week(date):
+    """Date.prototype.getWeek as defined in the weekly views"""
+    target = date - timedelta(days=date.weekday() - 3)
+    jan4 = datetime(target.year, 1, 4, tzinfo=pytz.UTC)
+    day_diff = (target - jan4).total_seconds() / 86400.0
+    return 1 + int(math.ceil(day_diff / 7))
+
+
+def _is_number(value):
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _is_data_record(doc):
+    return not doc.get('void') and doc.get('document_type') == 'DataRecord'
+
+
+def _type_path(doc):
+    return doc['aggregation_paths']['_type']
+
+
+def map_all_media_details(doc, emit):
+    if doc.get('document_type') == 'MediaDetails':
+        emit(doc.get('questionnaire_id'), doc.get('size'))
+
+
+def map_all_questionnaire(doc, emit):
+    if doc.get('document_type') == 'FormModel':
+        emit(doc.get('form_code'), doc)
+
+
+def map_all_subjects(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void') and _type_path(doc)[0] != 'reporter':
+        emit(_type_path(doc), doc)
+
+
+def map_by_aggregation_path(doc, emit):
+    if _is_data_record(doc):
+        entity_type = _type_path(doc['entity'])
+        date = _date(doc['event_time'])
+        dates = [date.year, date.month, date.day, date.hour, date.minute, date.second]
+        for f, field in doc['data'].items():
+            value = field.get('value')
+            if _is_number(value):
+                for p, path in doc['entity']['aggregation_paths'].items():
+                    emit([entity_type, p, f] + list(path) + dates, value)
+
+
+def map_by_form_code_time(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        for k, field in doc['data'].items():
+            emit([doc['submission']['form_code'], date, doc['entity']['_id'], k], field.get('value'))
+
+
+def map_by_label_value(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and not doc.get('void'):
+        for label, field in doc['data'].items():
+            emit([label, field['value']], doc['entity']['_id'])
+
+
+def map_by_label_value_time(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        for label, field in doc['data'].items():
+            emit([label, field.get('value'), date], doc['entity']['_id'])
+
+
+def map_by_location(doc, emit):
+    if not doc.get('void') and doc.get('document_type') == 'Entity':
+        emit([_type_path(doc), doc['aggregation_paths'].get('_geo')], doc['_id'])
+
+
+def map_by_short_codes(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void'):
+        emit([_type_path(doc), doc.get('short_code')], None)
+
+
+def map_by_type(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void'):
+        for index in range(len(_type_path(doc))):
+            emit(_type_path(doc)[index], 1)
+
+
+def map_by_values(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        entity = doc['entity']
+        for k, field in doc['data'].items():
+            value = field.get('value')
+            if _is_number(value):
+                emit([_type_path(entity), entity['_id'], k, doc['submission']['form_code'], date], value)
+
+
+def map_by_values_latest(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        entity = doc['entity']
+        for k, field in doc['data'].items():
+            emit([_type_path(entity), entity['_id'], k, doc['submission']['form_code'], date],
+                 {'timestamp': date, 'value': field.get('value')})
+
+
+def map_by_values_latest_by_time(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        entity = doc['entity']
+        for k, field in doc['data'].items():
+            emit([_type_path(entity), entity['_id'], k, date], {'timestamp': date, 'value': field.get('value')})
+
+
+def map_count_entities_by_type(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        emit(_type_path(doc), 1)
+
+
+def map_count_non_voided_entities_by_type(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void'):
+        emit(_type_path(doc), 1)
+
+
+def map_data_record_by_form_code(doc, emit):
+    if doc.get('document_type') == 'DataRecord':
+        emit([doc['submission']['form_code'], doc['entity']['short_code']], doc)
+
+
+def map_datasender_by_mobile(doc, emit):
+    if doc.get('document_type') == 'Entity' and _type_path(doc)[0] == 'reporter' and not doc.get('void'):
+        data = doc['data']
+        emit([data['mobile_number']['value'], data['name']['value'], doc.get('short_code')], None)
+
+
+def map_entity_by_label_value(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and not doc.get('void'):
+        for label, field in doc['data'].items():
+            emit([_type_path(doc['entity']), label, field['value']], doc['entity']['_id'])
+
+
+def map_entity_by_short_code(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        emit([_type_path(doc), doc.get('short_code')], None)
+
+
+def map_entity_data(doc, emit):
+    if doc.get('document_type') == 'DataRecord' and doc.get('entity') is not None:
+        emit(doc['entity']['_id'], 1)
+
+
+def map_entity_datatypes(doc, emit):
+    if doc.get('document_type') == 'DataRecord':
+        for field in doc['data'].values():
+            emit(doc['entity']['_id'], field['type']['_id'])
+
+
+def map_entity_datatypes_by_tag(doc, emit):
+    if doc.get('document_type') == 'DataRecord':
+        for field in doc['data'].values():
+            for tag in field['type']['tags']:
+                emit([doc['entity']['_id'], tag], field['type']['_id'])
+
+
+def map_entity_field_values(doc, emit):
+    if _is_data_record(doc):
+        date = _date_parse(doc['event_time'])
+        for k, field in doc['data'].items():
+            emit([doc['entity']['_id'], k], {'timestamp': date, 'value': field.get('value')})
+
+
+def map_get_entity_attributes(doc, emit):
+    if doc.get('document_type') == 'Entity':
+        emit([_type_path(doc), doc.get('short_code')],
+             dict((k, field.get('value')) for k, field in doc.get('data', {}).items()))
+
+
+def map_latest_by_label_value(doc, emit):
+    if doc.get('document_type') == 'Entity' and not doc.get('void'):
+        for label, field in doc.get('data', {}).items():
+            emit([label, field.get('value')], None)
+
+
+def map_media_attachment(doc, emit):
+    if doc.get('document_type') == 'MediaDetails' and doc.get('size') > 0:
+        emit(doc.get('questionnaire_id'), 1)
+
+
+def map_questionnaire(doc, emit):
+    if doc.get('document_type') == 'FormModel' and not doc.get('void'):
+        emit(doc.get('form_code'), doc)
+
+
+def map_registration_form_model_by_entity_type(doc, emit):
+    if doc.get('document_type') == 'FormModel' and not doc.get('void') and doc.get('is_registration_model'):
+        emit(doc.get('entity_type'), None)
+
+
+def map_survey_response_by_survey_response_id(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse':
+        emit(doc['_id'], doc)
+
+
+def map_survey_response_for_activity_period(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse' and not doc.get('void'):
+        emit([doc.get('form_model_id'), _date_parse(doc['event_time'])], doc)
+
+
+def map_surveyresponse(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse':
+        emit([doc.get('form_model_id'), _date_parse(doc['created'])], doc)
+
+
+def map_undeleted_survey_response(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse' and not doc.get('void'):
+        emit([doc.get('form_model_id'), _date_parse(doc['created'])], doc)
+
+
+def map_undeleted_survey_response_on_modified(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse' and doc.get('form_model_id') is not None and not doc.get('void'):
+        emit([doc['form_model_id'], _date_parse(doc['modified'])], doc)
+
+
+def map_undeleted_survey_response_on_modified_and_tag(doc, emit):
+    if doc.get('document_type') == 'SurveyResponse' and doc.get('form_model_id') and not doc.get('void') \
+            and (doc.get('values') or {}).get('tag'):
+        emit([doc['form_model_id'], doc['values']['tag'], _date_parse(doc['modified'])], doc)
+
+
+def _period_aggregate_map(period_key, numbers_only):
+    def map_fun(doc, emit):
+        if _is_data_record(doc):
+            entity_type = _type_path(doc['entity'])
+            date = _date(doc['event_time'])
+            for f, field in doc['data'].items():
+                value = field.get('value')
+                if numbers_only:
+                    if not _is_number(value):
+                        continue
+                else:
+                    value = {'timestamp': _js_date_json(date), 'value': value}
+                emit(period_key(date) + [doc['submission']['form_code'], entity_type, doc['entity']['short_code'], f],
+                     value)
+
+    return map_fun
+
+
+def _period_aggregate_by_path_map(period_key):
+    def map_fun(doc, emit):
+        if _is_data_record(doc):
+            entity = doc['entity']
+            entity_type = _type_path(entity)
+            date = _date(doc['event_time'])
+            for f, field in doc['data'].items():
+                value = field.get('value')
+                if not _is_number(value):
+                    continue
+                for p, path in entity['aggregation_paths'].items():
+                    emit(period_key(date) + [doc['submission']['form_code'], entity_type, p, f] + list(path) +
+                         [[entity['short_code']]], value)
+
+    return map_fun
+
+
+_daily = lambda date: [date.year, date.month, date.day]
+_weekly = lambda date: [date.year, _js_week(date)]
+_monthly = lambda date: [date.year, date.month]
+_yearly = lambda date: [date.year]
+
+map_daily_aggregate_stats = _period_aggregate_map(_daily, True)
+map_daily_aggregate_latest = _period_aggregate_map(_daily, False)
+map_weekly_aggregate_stats = _period_aggregate_map(_weekly, True)
+map_weekly_aggregate_latest = _period_aggregate_map(_weekly, False)
+map_monthly_aggregate_stats = _period_aggregate_map(_monthly, True)
+map_monthly_aggregate_latest = _period_aggregate_map(_monthly, False)
+map_yearly_aggregate_stats = _period_aggregate_map(_yearly, True)
+map_yearly_aggregate_latest = _period_aggregate_map(_yearly, False)
+map_daily_aggregate_stats_by_path = _period_aggregate_by_path_map(_daily)
+map_weekly_aggregate_stats_by_path = _period_aggregate_by_path_map(_weekly)
+map_monthly_aggregate_stats_by_path = _period_aggregate_by_path_map(_monthly)
+map_yearly_aggregate_stats_by_path = _period_aggregate_by_path_map(_yearly)
+
+
+def reduce_latest(keys, values, rereduce):
+    current = values[0]
+    for x in values:
+        if x['timestamp'] > current['timestamp']:
+            current = x
+    return {'latest': current['latest'] if rereduce else current['value'], 'timestamp': current['timestamp']}
+
+
+def reduce_survey_response_count(keys, values, rereduce):
+    if not rereduce:
+        return {'count': len(values), 'success': len([x for x in values if x.get('status')])}
+    return {'count': sum(x['count'] for x in values), 'success': sum(x['success'] for x in values)}
+
+
+def _find_python_views():
+    views = {}
+    for name, func in globals().items():
+        if name.startswith('map_') and callable(func):
+            views[name[len('map_'):]] = {'map': func}
+    for name in ('by_values_latest', 'by_values_latest_by_time', 'daily_aggregate_latest',
+                 'weekly_aggregate_latest', 'monthly_aggregate_latest', 'yearly_aggregate_latest'):
+        views[name]['reduce'] = reduce_latest
+    for name in ('surveyresponse', 'undeleted_survey_response'):
+        views[name]['reduce'] = reduce_survey_response_count
+    return views
+
+python_views = _find_python_views()
@@ -0,0 +1 @@
+_stats
\ No newline at end of file
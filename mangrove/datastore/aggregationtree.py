@@ -1,13 +1,59 @@
 
 
-from threading import Lock
+from collections import deque
+from threading import Lock, RLock
 
 import networkx as nx
 
+from mangrove.errors.MangroveException import FailedToSaveDataObject
 from mangrove.utils.types import is_not_empty, is_sequence, is_string
+from compact_tree import CompactTree
 from documents import AggregationTreeDocument
 from database import DataObject
 
+# saves of one tree retried after a conflict with a concurrent writer
+MAX_SAVE_ATTEMPTS = 5
+
+# one lock per (server, database, tree id), held while a tree is saved
+_tree_locks = {}
+_tree_locks_lock = Lock()
+
+
+def _tree_lock(dbm, id):
+    k = (dbm.url, dbm.database_name, id)
+    lock = _tree_locks.get(k)
+    if lock is None:
+        with _tree_locks_lock:
+            lock = _tree_locks.setdefault(k, RLock())
+    return lock
+
+
+class _TreeIndex(object):
+    """""
+    Parent, depth and root path of every node reachable from the root of
+    a graph, and the leaves, built with one breadth first walk.
+    """""
+    __slots__ = ('parents', 'paths', 'leaves')
+
+    def __init__(self, graph, root):
+        parents = {root: None}
+        paths = {root: (root,)}
+        leaves = []
+        queue = deque([root])
+        while queue:
+            node = queue.popleft()
+            children = graph.successors(node)
+            if not children and node != root:
+                leaves.append(node)
+            for child in children:
+                if child not in parents:
+                    parents[child] = node
+                    paths[child] = paths[node] + (child,)
+                    queue.append(child)
+        self.parents = parents
+        self.paths = paths
+        self.leaves = leaves
+
 
 class AggregationTree(DataObject):
     """""
@@ -59,7 +105,15 @@ class AggregationTree(DataObject):
         assert (id is None or is_not_empty(id))
 
         DataObject.__init__(self, dbm)
-        self.graph = None
+        self._graph = None
+        self._graph_exposed = False
+        self._index = None
+        # changes since the tree was loaded or saved, None if unknown; see save
+        self._changes = []
+        # nodes whose attributes or children changed, None to rebuild all
+        self._dirty = set()
+        # nodes whose data dict was handed out by get_data_for
+        self._touched = set()
 
         # being constructed from DB? If so, no more work here
         if id is None:
@@ -71,13 +125,88 @@ class AggregationTree(DataObject):
     def _set_document(self, document):
         DataObject._set_document(self, document)
         self._sync_doc_to_graph()
+        self._graph_exposed = False
+        self._index = None
+        self._synced()
+
+    @property
+    def graph(self):
+        """""
+        The networkx graph of the tree. Once it has been handed out, saves
+        rebuild the whole document and are not retried on conflicts, as
+        changes made to it directly can not be told apart.
+        """""
+        self._graph_exposed = True
+        self.invalidate_index()
+        return self._graph
+
+    @property
+    def index(self):
+        """""
+        The parents and root paths of the nodes, built on first use after
+        the tree changes through add_child, add_path or remove_node.
+        Changes made to self.graph directly must be followed by
+        invalidate_index.
+        """""
+        index = self._index
+        if index is None:
+            index = self._index = _TreeIndex(self._graph, AggregationTree.root_id)
+        return index
+
+    def invalidate_index(self):
+        self._index = None
+        self._changes = None
+        self._dirty = None
 
     def save(self):
-        id = None
-        with Lock():
-            self._sync_graph_to_doc()
-            id = DataObject.save(self)
-        return id
+        """""
+        Saves the tree. Only the branches of the document under nodes
+        changed through this API are rebuilt. If somebody else saved the
+        tree meanwhile, the saved tree is loaded, this tree's changes are
+        made to it again and the save is retried.
+        """""
+        with _tree_lock(self._dbm, self.id):
+            for attempt in range(MAX_SAVE_ATTEMPTS):
+                self._sync_graph_to_doc()
+                try:
+                    id = DataObject.save(self)
+                except FailedToSaveDataObject:
+                    if self._changes is None or attempt == MAX_SAVE_ATTEMPTS - 1:
+                        raise
+                    self._merge_with_saved()
+                else:
+                    self._synced()
+                    return id
+
+    def _merge_with_saved(self):
+        """""Loads the saved tree and makes this tree's changes to it again"""""
+        # data changed through get_data_for is only known by its current value
+        changes = self._changes + [('set_data_for', (node, dict(self.get_data_for(node))))
+                                   for node in self._touched if self._has_node(node)]
+        saved = self._dbm._load_document(self.id, self.__document_class__)
+        if saved is None:
+            raise FailedToSaveDataObject('Aggregation tree %s no longer exists' % self.id)
+        self._set_document(saved)
+        for method, args in changes:
+            if method in ('remove_node', 'set_data_for') and not self._has_node(args[0]):
+                continue
+            getattr(self, method)(*args)
+
+    def _changed(self, method, args, nodes):
+        """""Notes a change made through method(*args) to the data or children of nodes"""""
+        self._index = None
+        if self._changes is not None:
+            self._changes.append((method, args))
+        if self._dirty is not None:
+            self._dirty.update(nodes)
+
+    def _synced(self):
+        self._changes = None if self._graph_exposed else []
+        self._dirty = None if self._graph_exposed else set()
+        self._touched = set()
+
+    def _has_node(self, node):
+        return node in self._graph
 
     @property
     def name(self):
@@ -85,7 +214,12 @@ class AggregationTree(DataObject):
 
     def get_data_for(self, node):
         assert is_string(node)
-        return self.graph.node[node]
+        data = self._graph.node[node]
+        # the caller may change it
+        self._touched.add(node)
+        if self._dirty is not None:
+            self._dirty.add(node)
+        return data
 
     def set_data_for(self, node, dikt):
         """""
@@ -96,7 +230,8 @@ class AggregationTree(DataObject):
         assert is_string(node)
         if not self._verify_dict_keys_are_strings(dikt):
             raise ValueError('Keys in a nodes data-dictionary must be strings')
-        self.graph.node[node] = dikt
+        self._graph.node[node] = dikt
+        self._changed('set_data_for', (node, dikt), [node])
 
     def get_paths(self):
         """""
@@ -107,8 +242,7 @@ class AggregationTree(DataObject):
         Use this method if every node has meaning, e.g. HEALTH FAC->HOSPITAL->REGIONAL
 
         """""
-        # TODO: hold this as a cache that is blown by Add Path
-        return [p[1:] for p in nx.shortest_path(self.graph, AggregationTree.root_id, ).values() if is_not_empty(p[1:])]
+        return [list(p[1:]) for p in self.index.paths.values() if len(p) > 1]
 
     def get_leaf_paths(self):
         """""
@@ -117,11 +251,22 @@ class AggregationTree(DataObject):
         Paths do not include ROOT and start one level below root
 
         """""
+        index = self.index
+        return [list(index.paths[n][1:]) for n in index.leaves]
 
-        # TODO: this is a hacky, probably really slow way to do ths. I need to either find the fast way or cache this.
-        # But it is a crazy list comprehension ;-)
-        return [nx.shortest_path(self.graph, AggregationTree.root_id, n)[1:] for n in
-        [n for n in self.graph.nodes() if n != AggregationTree.root_id and self.graph.degree(n) == 1]]
+    def path_to(self, node):
+        """""Returns the path from root to node, root removed"""""
+        return list(self._path(node)[1:])
+
+    def depth_of(self, node):
+        """""Returns the number of edges between root and node"""""
+        return len(self._path(node)) - 1
+
+    def _path(self, node):
+        path = self.index.paths.get(node)
+        if path is None:
+            raise ValueError("Node named: '%s' not in graph" % node)
+        return path
 
     def _verify_dict_keys_are_strings(self, dikt):
         """""
@@ -150,45 +295,47 @@ class AggregationTree(DataObject):
         if not self._verify_dict_keys_are_strings(data):
             raise ValueError('Keys in a nodes data-dictionary must be strings')
 
-        self.graph.add_node(name, data)
+        self._graph.add_node(name, data)
 
     def add_child(self, parent, child, data=None):
         """""raises value error if parent not in tree"""""
-        if parent not in self.graph:
+        if parent not in self._graph:
             raise ValueError('"%s" not found in graph' % parent)
 
         self._add_node(child, data)
-        self.graph.add_edge(parent, child)
+        self._graph.add_edge(parent, child)
+        self._changed('add_child', (parent, child, data), [parent, child])
 
     def remove_node(self, node):
-        if node not in self.graph:
+        if node not in self._graph:
             raise ValueError("Node named: '%s' not in graph" % node)
 
-        self.graph.remove_node(node)
+        parent = self.parent_of(node)
+        self._graph.remove_node(node)
+        self._changed('remove_node', (node,), [parent] if parent is not None else [])
 
     def children_of(self, node):
-        if node not in self.graph:
+        if node not in self._graph:
             raise ValueError("Node named: '%s' not in graph" % node)
 
-        return self.graph.successors(node)
+        return self._graph.successors(node)
 
     def parent_of(self, node):
-        if node not in self.graph:
+        if node not in self._graph:
             raise ValueError("Node named: '%s' not in graph" % node)
 
-        p = self.graph.predecessors(node)
+        parents = self.index.parents
+        if node in parents:
+            return parents[node]
+        p = self._graph.predecessors(node)
         return (None if len(p) == 0 else p[0])
 
     def ancestors_of(self, node):
-        a = []
-        while True:
-            p = self.parent_of(node)
-            if p == self.root_id:
-                break
-            a.append(p)
-            node = p
-        a.reverse()
-        return a
+        return list(self._path(node)[1:-1])
+
+    def is_under(self, node, ancestor):
+        """""True if node is ancestor or lies below it"""""
+        return ancestor in self._path(node)
 
     def add_path(self, nodes):
         """""Adds a path to the tree.
@@ -208,7 +355,7 @@ class AggregationTree(DataObject):
         assert is_sequence(nodes) and is_not_empty(nodes)
 
         first = (nodes[0][0] if is_sequence(nodes[0]) else nodes[0])
-        if not first in self.graph:
+        if not first in self._graph:
             raise ValueError('First item in path: %s not in Tree.' % first)
 
         # iterate, add nodes, and pull out path
@@ -226,7 +373,8 @@ class AggregationTree(DataObject):
             path.append(name)
 
         # add the path
-        self.graph.add_path(path)
+        self._graph.add_path(path)
+        self._changed('add_path', (nodes,), path)
 
     def add_root_path(self, path):
         """""Convenience function for adding this path starting at "root" """
@@ -263,17 +411,17 @@ class AggregationTree(DataObject):
 
         graph = nx.DiGraph()
         build_graph(graph, None, AggregationTree.root_id, self._doc.root)
-        self.graph = graph
+        self._graph = graph
 
     def _sync_graph_to_doc(self):
         """""Converts internal tree to dict for CouchDB document"""""
-        assert self.graph is not None
+        assert self._graph is not None
 
         def build_dicts(dicts, parent, node_dict):
             for n in node_dict:
                 # if we haven't seen it yet, build a dict for it
                 if n not in dicts:
-                    d = dict(self.graph.node[n])
+                    d = dict(self._graph.node[n])
                     dicts[n] = d  # hang onto them until they are connected up so don't get garbage collected!
                 else:
                     d = dicts[n]
@@ -289,8 +437,155 @@ class AggregationTree(DataObject):
                         d['_children'] = dict()
                     build_dicts(dicts, d, node_dict[n])
 
+        if self._dirty is not None:
+            self._sync_dirty_nodes_to_doc()
+            return
+
         # walk the tree and pull out dicts and values and construct
         # dict for couchdb, save the root!
         seen = {}
-        build_dicts(seen, None, self.graph.adj)
+        build_dicts(seen, None, self._graph.adj)
         self._doc.root = seen[AggregationTree.root_id]
+
+    def _sync_dirty_nodes_to_doc(self):
+        """""Brings the dicts of the changed nodes up to date, shallowest first, and builds new branches"""""
+        paths = self.index.paths
+        for node in sorted((n for n in self._dirty if n in paths), key=lambda n: len(paths[n])):
+            d = self._doc.root
+            for name in paths[node][1:]:
+                d = d.get('_children', {}).get(name)
+                if d is None:
+                    # new, built with its parent
+                    break
+            if d is None:
+                continue
+
+            children = d.pop('_children', {})
+            d.clear()
+            d.update(self._graph.node[node])
+            successors = self._graph.successors(node)
+            for child in set(children) - set(successors):
+                del children[child]
+            for child in successors:
+                if child not in children:
+                    children[child] = self._branch_dict(child)
+            if children:
+                d['_children'] = children
+        self._dirty = set()
+
+    def _branch_dict(self, node):
+        d = dict(self._graph.node[node])
+        stack = [(node, d)]
+        while stack:
+            node, d = stack.pop()
+            for child in self._graph.successors(node):
+                child_dict = dict(self._graph.node[child])
+                d.setdefault('_children', {})[child] = child_dict
+                stack.append((child, child_dict))
+        return d
+
+
+class CompactAggregationTree(AggregationTree):
+    """""
+    An AggregationTree held in a CompactTree instead of a networkx graph,
+    for trees with many nodes, e.g. national location hierarchies. It
+    reads and saves the same documents and has the same methods, but no
+    graph attribute. A node belongs to one parent only; adding it under
+    another raises ValueError.
+
+        tree = CompactAggregationTree.get(dbm, 'locations')
+    """""
+
+    def __init__(self, dbm, id=None):
+        self.tree = None
+        AggregationTree.__init__(self, dbm, id)
+
+    def get_data_for(self, node):
+        assert is_string(node)
+        data = self.tree.get_data(self.tree.ids[node])
+        self._touched.add(node)
+        return data
+
+    def set_data_for(self, node, dikt):
+        assert is_string(node)
+        if not self._verify_dict_keys_are_strings(dikt):
+            raise ValueError('Keys in a nodes data-dictionary must be strings')
+        self.tree.set_data(self.tree.ids[node], dikt)
+        self._changed('set_data_for', (node, dikt), [node])
+
+    def get_paths(self):
+        return [list(path[1:]) for id, path in self.tree.paths() if id != self.tree.root]
+
+    def get_leaf_paths(self):
+        return [list(path[1:]) for id, path in self.tree.paths() if id != self.tree.root and self.tree.is_leaf(id)]
+
+    def path_to(self, node):
+        return self._names(self.tree.path(self.tree.id_of(node))[1:])
+
+    def depth_of(self, node):
+        return self.tree.depth(self.tree.id_of(node))
+
+    def add_child(self, parent, child, data=None):
+        """""raises value error if parent not in tree"""""
+        if parent not in self.tree:
+            raise ValueError('"%s" not found in graph' % parent)
+        if not self._verify_dict_keys_are_strings(data):
+            raise ValueError('Keys in a nodes data-dictionary must be strings')
+        self.tree.add_child(parent, child, data)
+        self._changed('add_child', (parent, child, data), [parent, child])
+
+    def remove_node(self, node):
+        """""Removes node and the nodes below it"""""
+        self.tree.remove(node)
+        self._changed('remove_node', (node,), [])
+
+    def children_of(self, node):
+        return self._names(self.tree.children(self.tree.id_of(node)))
+
+    def parent_of(self, node):
+        parent = self.tree.parent[self.tree.id_of(node)]
+        return self.tree.names[parent] if parent >= 0 else None
+
+    def ancestors_of(self, node):
+        return self._names(self.tree.path(self.tree.id_of(node))[1:-1])
+
+    def is_under(self, node, ancestor):
+        return self.tree.is_under(self.tree.id_of(node), self.tree.id_of(ancestor))
+
+    def add_path(self, nodes):
+        """""Adds a path to the tree, see AggregationTree.add_path"""""
+        assert is_sequence(nodes) and is_not_empty(nodes)
+
+        first = (nodes[0][0] if is_sequence(nodes[0]) else nodes[0])
+        if not first in self.tree:
+            raise ValueError('First item in path: %s not in Tree.' % first)
+
+        parent = None
+        for n in nodes:
+            name, data = (n[0], n[1]) if is_sequence(n) else (n, None)
+            if not is_string(name):
+                raise ValueError('Node names must be strings')
+            if not self._verify_dict_keys_are_strings(data):
+                raise ValueError('Keys in a nodes data-dictionary must be strings')
+            if parent is None:
+                if data is not None:
+                    self.tree.get_data(self.tree.ids[name]).update(data)
+            else:
+                self.tree.add_child(parent, name, data)
+            parent = name
+        self._changed('add_path', (nodes,), [])
+
+    def _has_node(self, node):
+        return node in self.tree
+
+    def _names(self, ids):
+        return [self.tree.names[id] for id in ids]
+
+    def _sync_doc_to_graph(self):
+        assert self._doc is not None
+        self.tree = CompactTree.from_dict(AggregationTree.root_id, self._doc.root)
+
+    def _sync_graph_to_doc(self):
+        # rebuilding from the arrays is cheap, so there is no dirty tracking
+        assert self.tree is not None
+        self._doc.root = self.tree.to_dict()
@@ -0,0 +1,83 @@
+""" Concurrent access to CouchDB through a DatabaseManager.
+
+AsyncDatabaseManager runs DatabaseManager calls on a pool of worker
+threads and returns immediately with a pending result, so independent
+lookups can be in flight at the same time:
+
+    async_dbm = AsyncDatabaseManager(dbm)
+    reporter = async_dbm.load_all_rows_in_view('by_short_codes', key=[['reporter'], 'rep1'], include_docs=True)
+    form_model = async_dbm.get(form_model_id, FormModel)
+    reporter_rows, form_model = gather([reporter, form_model])
+
+All workers go through the wrapped manager and therefore share its HTTP
+session and connection pool; sockets are reused rather than opened per
+request. Saves made on worker threads do not join a dbm.batch() opened
+by the calling thread.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_WORKERS = 8
+
+
+def gather(pending, timeout=None):
+    """Wait for all pending results and return their values in order. Re-raises the first failure."""
+    return [result.get(timeout) for result in pending]
+
+
+class AsyncDatabaseManager(object):
+    def __init__(self, dbm, workers=DEFAULT_WORKERS):
+        self.dbm = dbm
+        self._pool = ThreadPool(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def _submit(self, func, *args, **kwargs):
+        return self._pool.apply_async(func, args, kwargs)
+
+    def get(self, id, object_class, get_or_create=False):
+        return self._submit(self.dbm.get, id, object_class, get_or_create)
+
+    def get_many(self, ids, object_class):
+        return self._submit(self.dbm.get_many, ids, object_class)
+
+    def load_view_results(self, view_name, **values):
+        return self._submit(_fetched_view_results, self.dbm, view_name, values)
+
+    def load_all_rows_in_view(self, view_name, **values):
+        return self._submit(self.dbm.load_all_rows_in_view, view_name, **values)
+
+    def _load_document(self, id, document_class=None):
+        if document_class is None:
+            return self._submit(self.dbm._load_document, id)
+        return self._submit(self.dbm._load_document, id, document_class)
+
+    def _save_documents(self, documents, modified=None):
+        return self._submit(self.dbm._save_documents, documents, modified)
+
+    def _save_document(self, document, modified=None, process_post_update=True, prev_doc=None):
+        return self._submit(self.dbm._save_document, document, modified, process_post_update, prev_doc)
+
+    def get_attachments(self, id, attachment_name=None):
+        return self._submit(self.dbm.get_attachments, id, attachment_name)
+
+    def put_attachment(self, document, attachment, attachment_name=None):
+        return self._submit(self.dbm.put_attachment, document, attachment, attachment_name)
+
+    def delete_attachment(self, document, attachment_name):
+        return self._submit(self.dbm.delete_attachment, document, attachment_name)
+
+
+def _fetched_view_results(dbm, view_name, values):
+    results = dbm.load_view_results(view_name, **values)
+    # ViewResults are lazy, make sure the request happens on the worker
+    results.rows
+    return results
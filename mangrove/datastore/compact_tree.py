@@ -0,0 +1,194 @@
+""" Compact in-memory tree for large aggregation trees.
+
+Nodes get integer ids; their names, parents and children are held in
+plain arrays rather than networkx node and adjacency dicts:
+
+    parent[i], first_child[i], next_sibling[i]  -- node ids, NONE if absent
+    names[i]                                     -- the node name
+    data[i]                                      -- the attribute dict or None
+
+Euler tour entry/exit times and depths are computed on first use after a
+structural change, so "is X under Y" is two comparisons. The tree reads
+and writes the nested dict format of AggregationTreeDocument.root.
+"""
+
+from array import array
+
+from mangrove.utils.types import is_string
+
+NONE = -1
+CHILDREN = '_children'
+
+
+class CompactTree(object):
+    def __init__(self, root_name):
+        self.names = []
+        self.ids = {}
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.data = []
+        self._tour = None
+        self.root = self._new_node(root_name, None, NONE)
+
+    @classmethod
+    def from_dict(cls, root_name, root):
+        """Builds the tree from the nested _children dicts of an AggregationTreeDocument root"""
+        tree = cls(root_name)
+        tree.data[tree.root] = _attributes(root)
+        stack = [(tree.root, root.get(CHILDREN))]
+        while stack:
+            parent, children = stack.pop()
+            if not children:
+                continue
+            for name, node in children.items():
+                if name in tree.ids:
+                    raise ValueError('Attempting to add multiple nodes to tree with same _id: %s' % name)
+                stack.append((tree._new_node(name, _attributes(node), parent), node.get(CHILDREN)))
+        return tree
+
+    def to_dict(self):
+        """The nested dict form of the tree, for AggregationTreeDocument.root"""
+        dicts = {}
+        for id in self._preorder(self.root):
+            d = dicts[id] = dict(self.data[id] or {})
+            parent = self.parent[id]
+            if parent != NONE:
+                dicts[parent].setdefault(CHILDREN, {})[self.names[id]] = d
+        return dicts[self.root]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id_of(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            raise ValueError("Node named: '%s' not in graph" % name)
+        return id
+
+    def add_child(self, parent_name, name, data=None):
+        """Adds name under parent_name, or updates its data if it is already there"""
+        parent = self.id_of(parent_name)
+        id = self.ids.get(name)
+        if id is None:
+            return self._new_node(name, data, parent)
+        if self.parent[id] != parent:
+            raise ValueError("Node named: '%s' is already in the tree under '%s'" %
+                             (name, self.names[self.parent[id]] if self.parent[id] != NONE else None))
+        if data is not None:
+            self.data[id] = dict(self.data[id] or {}, **data)
+        return id
+
+    def remove(self, name):
+        """Removes the node and everything under it"""
+        id = self.id_of(name)
+        if id == self.root:
+            raise ValueError('The root node can not be removed')
+        parent = self.parent[id]
+        if self.first_child[parent] == id:
+            self.first_child[parent] = self.next_sibling[id]
+        else:
+            sibling = self.first_child[parent]
+            while self.next_sibling[sibling] != id:
+                sibling = self.next_sibling[sibling]
+            self.next_sibling[sibling] = self.next_sibling[id]
+        for each in list(self._preorder(id)):
+            del self.ids[self.names[each]]
+            self.names[each] = self.data[each] = None
+            self.parent[each] = self.first_child[each] = self.next_sibling[each] = NONE
+        self._tour = None
+
+    def children(self, id):
+        child = self.first_child[id]
+        while child != NONE:
+            yield child
+            child = self.next_sibling[child]
+
+    def path(self, id):
+        """Node ids from the root to id, both included"""
+        path = []
+        while id != NONE:
+            path.append(id)
+            id = self.parent[id]
+        path.reverse()
+        return path
+
+    def paths(self):
+        """(id, names on the path from the root) for every node, root first"""
+        stack = [(self.root, ())]
+        while stack:
+            id, path = stack.pop()
+            path = path + (self.names[id],)
+            yield id, path
+            stack.extend((child, path) for child in self.children(id))
+
+    def is_leaf(self, id):
+        return self.first_child[id] == NONE
+
+    def depth(self, id):
+        return self._euler_tour()[2][id]
+
+    def is_under(self, id, ancestor):
+        """True if id is ancestor or below it"""
+        entry, exit, _ = self._euler_tour()
+        return entry[ancestor] <= entry[id] and exit[id] <= exit[ancestor]
+
+    def get_data(self, id):
+        data = self.data[id]
+        if data is None:
+            data = self.data[id] = {}
+        return data
+
+    def set_data(self, id, data):
+        self.data[id] = data
+
+    def _new_node(self, name, data, parent):
+        if not is_string(name):
+            raise ValueError('Node names must be strings')
+        id = len(self.names)
+        self.ids[name] = id
+        self.names.append(name)
+        self.data.append(dict(data) if data else None)
+        self.parent.append(parent)
+        self.first_child.append(NONE)
+        self.next_sibling.append(NONE)
+        if parent != NONE:
+            self.next_sibling[id] = self.first_child[parent]
+            self.first_child[parent] = id
+        self._tour = None
+        return id
+
+    def _preorder(self, id):
+        stack = [id]
+        while stack:
+            id = stack.pop()
+            yield id
+            stack.extend(self.children(id))
+
+    def _euler_tour(self):
+        if self._tour is None:
+            size = len(self.names)
+            entry, exit, depth = array('i', [NONE]) * size, array('i', [NONE]) * size, array('i', [0]) * size
+            clock = 0
+            stack = [(self.root, False)]
+            while stack:
+                id, done = stack.pop()
+                if done:
+                    exit[id] = clock
+                else:
+                    entry[id] = clock
+                    parent = self.parent[id]
+                    depth[id] = depth[parent] + 1 if parent != NONE else 0
+                    stack.append((id, True))
+                    stack.extend((child, False) for child in self.children(id))
+                clock += 1
+            self._tour = (entry, exit, depth)
+        return self._tour
+
+
+def _attributes(node):
+    attributes = dict((k, v) for k, v in node.items() if k != CHILDREN)
+    return attributes or None
@@ -1,6 +1,11 @@
 
 
-from threading import Lock
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from threading import Lock, local
+from time import time
 from couchdb import http
 
 from couchdb.design import ViewDefinition
@@ -9,17 +14,35 @@ import couchdb.client
 
 import settings
 from documents import DocumentBase
+from document_cache import DocumentCache, ShortCodeCache
+import memory_backend
 from datetime import datetime
+from mangrove.bootstrap.views import design_doc_for_view
 from mangrove.utils import dates
 from mangrove.utils.types import is_empty, is_sequence
 from mangrove.errors.MangroveException import NoDocumentError, DataObjectNotFound, FailedToSaveDataObject
 
 
+# DatabaseManagers by (server, database), bounded by settings.DB_MANAGER_POOL_SIZE
 _dbms = {}
+_dbms_last_used = {}
+_dbms_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 _dbms_lock = Lock()
+# one http.Session, and so one connection pool, per CouchDB server url
+_sessions = {}
+_sessions_lock = Lock()
 
+VIEW_BATCH_SIZE = 1000
+# documents per _all_docs/_bulk_docs request of void_documents and delete_documents
+BULK_CHUNK_SIZE = 1000
 
-def get_db_manager(server=None, database=None, credentials=settings.COUCHDB_CREDENTIALS):
+# per-call view consistency, see load_view_results
+STALE_OK = 'ok'
+STALE_UPDATE_AFTER = 'update_after'
+
+
+def get_db_manager(server=None, database=None, credentials=settings.COUCHDB_CREDENTIALS,
+                   cache_size=settings.DOCUMENT_CACHE_SIZE, short_code_cache_size=settings.SHORT_CODE_CACHE_SIZE):
     global _dbms
     assert _dbms is not None
 
@@ -29,27 +52,68 @@ def get_db_manager(server=None, database=None, credentials=settings.COUCHDB_CRED
 
     k = (srv, db)
     # check if already created and in dict
-    if k not in _dbms or _dbms[k] is None:
+    dbm = _dbms.get(k)
+    if dbm is None:
         with _dbms_lock:
-            if k not in _dbms or _dbms[k] is None:
+            dbm = _dbms.get(k)
+            if dbm is None:
                 # nope, create it
-                _dbms[k] = DatabaseManager(credentials, server, database)
+                _make_room_for_db_manager()
+                dbm = _dbms[k] = DatabaseManager(credentials, server, database, cache_size=cache_size,
+                                                         short_code_cache_size=short_code_cache_size)
+                _dbms_stats['misses'] += 1
+            else:
+                _dbms_stats['hits'] += 1
+    else:
+        _dbms_stats['hits'] += 1
+    _dbms_last_used[k] = time()
+    return dbm
+
+
+def _make_room_for_db_manager():
+    """Drops idle managers, then the least recently used ones until a new one fits. Call with _dbms_lock held."""
+    idle_timeout = settings.DB_MANAGER_IDLE_TIMEOUT
+    if idle_timeout is not None:
+        _evict_db_managers([k for k, last_used in _dbms_last_used.items() if time() - last_used > idle_timeout])
+    max_size = settings.DB_MANAGER_POOL_SIZE
+    if max_size is not None and len(_dbms) >= max_size:
+        by_last_use = sorted(_dbms, key=lambda k: _dbms_last_used.get(k, 0))
+        _evict_db_managers(by_last_use[:len(_dbms) - max_size + 1])
+
+
+def _evict_db_managers(keys):
+    for k in keys:
+        _dbms_last_used.pop(k, None)
+        if _dbms.pop(k, None) is not None:
+            _dbms_stats['evictions'] += 1
+
+
+def evict_idle_db_managers():
+    """Drops the managers unused for longer than settings.DB_MANAGER_IDLE_TIMEOUT, e.g. from a periodic task"""
+    with _dbms_lock:
+        before = len(_dbms)
+        _make_room_for_db_manager()
+        return before - len(_dbms)
 
-    return _dbms[k]
+
+def db_manager_stats():
+    with _dbms_lock:
+        now = time()
+        return dict(_dbms_stats, live=len(_dbms), max_size=settings.DB_MANAGER_POOL_SIZE,
+                    idle_timeout=settings.DB_MANAGER_IDLE_TIMEOUT, servers=len(_sessions),
+                    oldest_idle_time=max([now - _dbms_last_used.get(k, now) for k in _dbms] or [0]))
 
 
 def remove_db_manager(dbm):
     global _dbms
     assert isinstance(dbm, DatabaseManager)
-    assert dbm in _dbms.values()
 
     with _dbms_lock:
-        try:
-            del _dbms[(dbm.url, dbm.database_name)]
-        except KeyError, ex:
-            print ex
-            assert False
-            pass  # must have been already deleted
+        k = (dbm.url, dbm.database_name)
+        # it may have been evicted already
+        if _dbms.get(k) is dbm:
+            del _dbms[k]
+            _dbms_last_used.pop(k, None)
 
 
 def _delete_db_and_remove_db_manager(dbm):
@@ -139,47 +203,181 @@ class DataObject(object):
         return self._doc.created
 
 
+def _connect(url):
+    if url.startswith(memory_backend.MEMORY_URL_SCHEME):
+        return memory_backend.get_server(url)
+    with _sessions_lock:
+        session = _sessions.get(url)
+        if session is None:
+            session = _sessions[url] = http.Session(retry_delays=[5, 30])
+    return couchdb.client.Server(url, session=session)
+
+
+def _query_view(database, view_name, instrumentation, values):
+    full_view_name = design_doc_for_view(view_name) + '/' + view_name
+    if instrumentation is None:
+        return database.view(full_view_name, **values)
+    start = time()
+    results = database.view(full_view_name, **values)
+    rows = results.rows
+    instrumentation.record(view_name, time() - start, rows)
+    return results
+
+
 class View(object):
-    def __init__(self, database):
+    def __init__(self, database, instrumentation=None):
         self.database = database
+        self.instrumentation = instrumentation
 
-    def _load_all_rows_in_view(self, **values):
-        full_view_name = self.name + '/' + self.name
-        print '[DEBUG] loading view: %s' % full_view_name
-        start = datetime.now()
-        rows = self.database.view(full_view_name, **values).rows
-        end = datetime.now()
-        delta_t = (end - start)
-        print "[DEBUG] --- took %s.%s seconds (%s rows)" %\
-              (delta_t.seconds, delta_t.microseconds, len(rows))
-        return rows
-
-    def _execute(self, **values):
-        return self._load_all_rows_in_view(**values)
+    def _load_all_rows_in_view(self, view_name, **values):
+        return _query_view(self.database, view_name, self.instrumentation, values).rows
 
     def __getattr__(self, name):
-        self.name = name
-        return self._execute
+        # bind the view name per call rather than on self so that threads sharing this View don't race
+        return partial(self._load_all_rows_in_view, name)
+
+
+class SaveBatch(object):
+    """
+    Documents saved through DatabaseManager._save_document while a batch
+    is active are queued here and written with one _bulk_docs request on
+    flush. post_update callbacks only run for documents that were written.
+
+    Saving the same document twice before a flush writes it once. Failed
+    writes, e.g. ResourceConflict, are collected in 'conflicts' as
+    (docid, exception) pairs.
+
+    Latest data updates of entities can be deferred to the flush with
+    update_latest_data; every entity is then written once per flush
+    however many data records were added for it. Documents registered with
+    void_on_conflict are voided again when their entity fails to save.
+    """
+
+    def __init__(self, dbm, max_size=None):
+        self._dbm = dbm
+        self.max_size = max_size
+        self._pending = OrderedDict()
+        self._latest_data = OrderedDict()
+        self._dependents = {}
+        self.saved = []
+        self.conflicts = []
+
+    def __len__(self):
+        return len(self._pending) + len(self._latest_data)
+
+    def add(self, document, modified=None, process_post_update=True, prev_doc=None):
+        self._queue(document, modified, process_post_update, prev_doc)
+        if self.max_size is not None and len(self) >= self.max_size:
+            self.flush()
+        return document.id
+
+    def _queue(self, document, modified=None, process_post_update=True, prev_doc=None):
+        document.modified = (modified if modified is not None else dates.utcnow())
+        if document.id in self._pending:
+            _, queued_post_update, queued_prev_doc = self._pending[document.id]
+            process_post_update = process_post_update or queued_post_update
+            prev_doc = queued_prev_doc or prev_doc
+        self._pending[document.id] = (document, process_post_update, prev_doc)
+
+    def update_latest_data(self, entity_doc, data):
+        """Sets the (label, value) pairs in data as latest data of entity_doc when the batch is flushed"""
+        queued = self._latest_data.get(entity_doc.id)
+        if queued is None:
+            queued = self._latest_data[entity_doc.id] = (entity_doc, OrderedDict())
+        queued[1].update(data)
+        if self.max_size is not None and len(self) >= self.max_size:
+            self.flush()
+
+    def void_on_conflict(self, entity_id, ids):
+        """Void the documents with the given ids if the entity with entity_id fails to save"""
+        self._dependents.setdefault(entity_id, set()).update(ids)
+
+    def flush(self):
+        for entity_doc, data in self._latest_data.values():
+            for label, value in data.items():
+                entity_doc.data[label] = {'value': value}
+            self._queue(entity_doc)
+        self._latest_data = OrderedDict()
+        if not self._pending:
+            return []
+        pending = self._pending.values()
+        self._pending = OrderedDict()
+        results = self._dbm._update_documents([document for document, _, _ in pending])
+        for (document, process_post_update, prev_doc), (success, id, rev_or_exc) in zip(pending, results):
+            if not success:
+                self.conflicts.append((id, rev_or_exc))
+                continue
+            self.saved.append(id)
+            if process_post_update:
+                document.post_update(self._dbm, prev_doc)
+        self._void_orphans()
+        return results
+
+    def _void_orphans(self):
+        failed = set(id for id, _ in self.conflicts).intersection(self._dependents)
+        if not failed:
+            return
+        saved = set(self.saved)
+        orphans = []
+        for entity_id in failed:
+            ids = self._dependents[entity_id]
+            orphans.extend(ids & saved)
+            ids -= saved
+        if orphans:
+            self._dbm.void_documents(orphans, raise_on_conflict=False)
+
+    def discard(self):
+        self._pending = OrderedDict()
+        self._latest_data = OrderedDict()
+        self._dependents = {}
 
 
 class DatabaseManager(object):
-    def __init__(self, credentials, server=None, database=None  ):
+    def __init__(self, credentials, server=None, database=None, cache_size=None, instrumentation=None,
+                 short_code_cache_size=None):
         """
         Connect to the CouchDB server. If no database name is given,
         use the name provided in the settings
+
+        If cache_size is given, up to that many documents are kept in an
+        in-process LRU cache in front of get, get_many and _load_document.
+
+        If short_code_cache_size is given, entity lookups by short code
+        remember up to that many entity ids for settings.SHORT_CODE_CACHE_TTL
+        seconds.
+
+        instrumentation is an optional ViewInstrumentation that records
+        every view query made through this manager.
+
+        A server url starting with memory:// uses the in-process stand-in
+        from memory_backend instead of CouchDB.
         """
 
         self.url = (server if server is not None else settings.SERVER)
         self.database_name = database or settings.DATABASE
-        self.server = couchdb.client.Server(self.url, session=http.Session(retry_delays=[5, 30]))
+        self.server = _connect(self.url)
         self.server.resource.credentials = credentials
         try:
             self.database = self.server[self.database_name]
         except ResourceNotFound:
             self.database = self.server.create(self.database_name)
 
-        self.view = View(self.database)
+        self.view = View(self.database, instrumentation)
+        self._instrumentation = instrumentation
+        self.document_cache = DocumentCache(cache_size) if cache_size else None
+        self.short_code_cache = (ShortCodeCache(short_code_cache_size, settings.SHORT_CODE_CACHE_TTL)
+                                 if short_code_cache_size else None)
+        self.view_warmer = None
+        self._local = local()
 
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
+    @instrumentation.setter
+    def instrumentation(self, instrumentation):
+        self._instrumentation = instrumentation
+        self.view.instrumentation = instrumentation
 
     def __unicode__(self):
         return u"Connected on %s - working on %s" % (self.url, self.database_name)
@@ -190,23 +388,60 @@ class DatabaseManager(object):
     def __repr__(self):
         return repr(self.database)
 
-    def load_all_rows_in_view(self, view_name, **values):
-        return self.load_view_results(view_name, **values).rows
-
-    def load_view_results(self, view_name, **values):
-        full_view_name = view_name + '/' + view_name
-        print '[DEBUG] loading view: %s' % full_view_name
-        start = datetime.now()
-        results = self.database.view(full_view_name, **values)
-        end = datetime.now()
-        delta_t = (end - start)
-        print "[DEBUG] --- took %s.%s seconds (%s rows)" %\
-              (delta_t.seconds, delta_t.microseconds, len(results.rows))
-        return results
+    def load_all_rows_in_view(self, view_name, stale=None, **values):
+        return self.load_view_results(view_name, stale=stale, **values).rows
 
+    def load_view_results(self, view_name, stale=None, **values):
+        """
+        stale=None waits for the view index to include every write.
+        STALE_OK answers from the index as it is, STALE_UPDATE_AFTER does
+        too and then has CouchDB update the index in the background.
+        """
+        if stale is not None:
+            assert stale in (STALE_OK, STALE_UPDATE_AFTER)
+            values['stale'] = stale
+        return _query_view(self.database, view_name, self.instrumentation, values)
+
+    def iter_view(self, view_name, batch_size=VIEW_BATCH_SIZE, **params):
+        """
+        Yield the rows of a view one at a time, fetching at most batch_size
+        rows per request so memory stays flat however big the result is.
 
-    def create_view(self, view_name, map, reduce):
-        view_document = view_name # views get their own design doc for the time being
+        Pages are chained on the startkey/startkey_docid of the first row
+        of the next page rather than skip, so every request costs the same
+        however deep into the view it starts. Requests with 'keys' are
+        paged by splitting the keys instead.
+        """
+        assert batch_size > 0
+        limit = params.pop('limit', None)
+        if limit is not None:
+            batch_size = min(batch_size, limit)
+        rows = self._iter_view_by_keys(view_name, batch_size, params) if 'keys' in params \
+            else self._iter_view_by_startkey(view_name, batch_size, params)
+        return rows if limit is None else islice(rows, limit)
+
+    def _iter_view_by_keys(self, view_name, batch_size, params):
+        keys = params.pop('keys')
+        for i in range(0, len(keys), batch_size):
+            for row in self.load_all_rows_in_view(view_name, keys=keys[i:i + batch_size], **params):
+                yield row
+
+    def _iter_view_by_startkey(self, view_name, batch_size, params):
+        if 'key' in params:
+            params['startkey'] = params['endkey'] = params.pop('key')
+        while True:
+            rows = self.load_all_rows_in_view(view_name, limit=batch_size + 1, **params)
+            for row in rows[:batch_size]:
+                yield row
+            if len(rows) <= batch_size:
+                return
+            next_row = rows[batch_size]
+            params['startkey'] = next_row['key']
+            if next_row.get('id') is not None:
+                params['startkey_docid'] = next_row['id']
+
+    def create_view(self, view_name, map, reduce, design_doc=None):
+        view_document = design_doc or design_doc_for_view(view_name)
         view = ViewDefinition(view_document, view_name, map, reduce)
         view.sync(self.database)
 
@@ -221,8 +456,49 @@ class DatabaseManager(object):
     def _delete_design_docs(self):
         for doc in self._get_design_docs(): del self.database[doc.id]
 
+    @contextmanager
+    def batch(self, max_size=None, raise_on_conflict=True):
+        """
+        Unit of work for document saves made by this thread:
+
+            with dbm.batch() as batch:
+                data_record.save()
+                survey_response.save()
+
+        Saves inside the block are queued and written in one _bulk_docs
+        request when the block exits, or every max_size documents. If the
+        block raises, queued documents are dropped. Unless
+        raise_on_conflict is False, FailedToSaveDataObject is raised after
+        the flush if any document failed; batch.conflicts lists them.
+        A nested batch joins the enclosing one.
+        """
+        current = self.current_batch()
+        if current is not None:
+            yield current
+            return
+
+        batch = SaveBatch(self, max_size)
+        self._local.batch = batch
+        try:
+            yield batch
+        except:
+            batch.discard()
+            raise
+        finally:
+            self._local.batch = None
+        batch.flush()
+        if raise_on_conflict and batch.conflicts:
+            raise FailedToSaveDataObject(str(batch.conflicts))
+
+    def current_batch(self):
+        return getattr(self._local, 'batch', None)
+
     def _save_document(self, document, modified=None, process_post_update=True, prev_doc=None):
         u"""'Returns document ID''"""
+        batch = self.current_batch()
+        if batch is not None:
+            return batch.add(document, modified, process_post_update, prev_doc)
+
         # TODO: Throw exception if an error
         result = self._save_documents([document], modified)[0]
         # first item is success/failure
@@ -239,7 +515,9 @@ class DatabaseManager(object):
         for doc in documents:
             assert isinstance(doc, DocumentBase)
             doc.modified = (modified if modified is not None else dates.utcnow())
+        return self._update_documents(documents)
 
+    def _update_documents(self, documents):
         # TODO: what should we return here? this is what is available from db.update()...
         # The return value of this method is a list containing a tuple for every
         # element in the `documents` sequence. Each tuple is of the form
@@ -253,14 +531,38 @@ class DatabaseManager(object):
         for x in range(len(results)):
             if results[x][0]:
                 documents[x]._data['_rev'] = results[x][2]
+                if documents[x]._data.get('_deleted'):
+                    self._uncache_document(results[x][1])
+                else:
+                    self._cache_document(documents[x]._data)
+                    self._uncache_short_code(results[x][1])
+            else:
+                self._uncache_document(results[x][1])
+        if self.view_warmer is not None:
+            self.view_warmer.documents_written([documents[x]._data for x in range(len(results)) if results[x][0]])
         return results
 
+    def _cache_document(self, doc):
+        if self.document_cache is not None and not doc.get('_id', '').startswith('_design/'):
+            self.document_cache.put(doc)
+
+    def _uncache_document(self, id, rev=None):
+        if self.document_cache is not None:
+            self.document_cache.discard(id, rev)
+        self._uncache_short_code(id)
+
+    def _uncache_short_code(self, id):
+        if self.short_code_cache is not None:
+            self.short_code_cache.discard(id)
+
     def put_attachment(self, document, attachment, attachment_name=None):
         if attachment_name is not None:
+            self._uncache_document(document['_id'])
             return self.database.put_attachment(document, attachment, attachment_name)
 
     def delete_attachment(self, document, attachment_name):
         if attachment_name is not None:
+            self._uncache_document(document['_id'])
             return self.database.delete_attachment(document, attachment_name)
 
     def get_attachments(self, id, attachment_name=None):
@@ -275,7 +577,58 @@ class DatabaseManager(object):
         doc.void = True
         self._save_document(doc)
 
+    def void_documents(self, ids, chunk_size=BULK_CHUNK_SIZE, retries=1, raise_on_conflict=True):
+        """
+        Marks the documents with ids void, chunk_size documents at a time:
+        one _all_docs request to load them and one _bulk_docs request to
+        save them. Documents that conflict are loaded and saved again up
+        to retries times. Missing documents are skipped.
+
+        Returns the ids that could not be saved, or raises
+        FailedToSaveDataObject for them unless raise_on_conflict is False.
+        """
+        def void(ids):
+            rows = self.database.view('_all_docs', keys=ids, include_docs=True)
+            docs = [DocumentBase.wrap(row['doc']) for row in rows if row.get('doc') is not None]
+            for doc in docs:
+                doc.void = True
+            return self._save_documents(docs) if docs else []
+
+        return self._bulk_update(ids, void, chunk_size, retries, raise_on_conflict)
+
+    def delete_documents(self, ids, chunk_size=BULK_CHUNK_SIZE, retries=1, raise_on_conflict=True):
+        """
+        Deletes the documents with ids like void_documents voids them.
+        The deleted revisions keep the document_type, so a view warmer
+        knows which views the deletes touched.
+        """
+        def delete(ids):
+            rows = self.database.view('_all_docs', keys=ids, include_docs=True)
+            stubs = [DocumentBase.wrap({'_id': row['id'], '_rev': row['value']['rev'], '_deleted': True,
+                                        'document_type': row['doc'].get('document_type')})
+                     for row in rows if row.get('doc') is not None]
+            return self._update_documents(stubs) if stubs else []
+
+        return self._bulk_update(ids, delete, chunk_size, retries, raise_on_conflict)
+
+    def _bulk_update(self, ids, update, chunk_size, retries, raise_on_conflict):
+        assert is_sequence(ids)
+        assert chunk_size > 0
+        failed = []
+        ids = list(ids)
+        for i in range(0, len(ids), chunk_size):
+            pending = ids[i:i + chunk_size]
+            for attempt in range(retries + 1):
+                pending = [id for success, id, _ in update(pending) if not success]
+                if not pending:
+                    break
+            failed.extend(pending)
+        if failed and raise_on_conflict:
+            raise FailedToSaveDataObject(str(failed))
+        return failed
+
     def _delete_document(self, document):
+        self._uncache_document(document['_id'])
         self.database.delete(document)
 
     def _load_document(self, id, document_class=DocumentBase):
@@ -287,8 +640,14 @@ class DatabaseManager(object):
         """
         if is_empty(id):
             return None
-        else:
-            return document_class.load(self.database, id=id)
+        if self.document_cache is not None:
+            cached = self.document_cache.get(id)
+            if cached is not None:
+                return document_class.wrap(cached)
+        document = document_class.load(self.database, id=id)
+        if document is not None:
+            self._cache_document(document._data)
+        return document
 
     def get_many(self, ids, object_class):
         """
@@ -300,16 +659,30 @@ class DatabaseManager(object):
         assert issubclass(object_class, DataObject)
         assert is_sequence(ids)
 
-        objs = []
-        rows = self.database.view('_all_docs', keys=ids, include_docs=True)
-        for row in rows:
-            if 'error' in row:
-                continue
-            if 'value' in row and row['value'].get('deleted', False): #Ignore deleted documents
-                continue
-            obj = object_class.new_from_doc(self, object_class.__document_class__.wrap(row.get('doc')))
-            objs.append(obj)
-        return objs
+        docs = {}
+        missing = ids
+        if self.document_cache is not None:
+            missing = []
+            for id in ids:
+                cached = self.document_cache.get(id)
+                if cached is None:
+                    missing.append(id)
+                else:
+                    docs[id] = cached
+
+        if missing:
+            rows = self.database.view('_all_docs', keys=missing, include_docs=True)
+            for row in rows:
+                if 'error' in row:
+                    continue
+                if 'value' in row and row['value'].get('deleted', False): #Ignore deleted documents
+                    continue
+                doc = row.get('doc')
+                self._cache_document(doc)
+                docs[row['key']] = doc
+
+        return [object_class.new_from_doc(self, object_class.__document_class__.wrap(docs[id]))
+                for id in ids if id in docs]
 
     def get(self, id, object_class, get_or_create=False):
         """
@@ -326,6 +699,8 @@ class DatabaseManager(object):
             # create one 'cause none exists
             doc = object_class.__document_class__(id=id)
             doc.store(self.database)
+            self._cache_document(doc._data)
+            self._uncache_short_code(doc.id)
             many.append(object_class.new_from_doc(self, doc))
 
         if not len(many):
@@ -344,4 +719,5 @@ class DatabaseManager(object):
             raise NoDocumentError
 
         id = d_obj._doc.id
+        self._uncache_document(id)
         self.database.delete(d_obj._doc)
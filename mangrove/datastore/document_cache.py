@@ -0,0 +1,157 @@
+import copy
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class DocumentCache(object):
+    """
+    Bounded, in-process LRU cache of raw CouchDB documents keyed by _id.
+
+    Every entry is the document dict as last read from or written to the
+    database, so it always carries the _rev it was seen at. Documents are
+    copied on the way in and on the way out; mutating a loaded document
+    never changes what is cached.
+
+    The cache only knows about writes that go through this process. Use
+    discard(id, rev) to drop entries that other writers have moved past.
+    """
+
+    def __init__(self, max_size=1000):
+        assert max_size > 0
+        self.max_size = max_size
+        self._docs = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, id):
+        return id in self._docs
+
+    def get(self, id, rev=None):
+        """
+        Return a copy of the cached document, or None on a miss.
+
+        If rev is given, an entry at any other revision counts as a miss
+        and is dropped.
+        """
+        with self._lock:
+            doc = self._docs.pop(id, None)
+            if doc is None or (rev is not None and doc.get('_rev') != rev):
+                self.misses += 1
+                return None
+            self._docs[id] = doc
+            self.hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, doc):
+        """Cache a document dict. Documents without an _id and _rev are ignored."""
+        id, rev = doc.get('_id'), doc.get('_rev')
+        if id is None or rev is None:
+            return
+        doc = copy.deepcopy(dict(doc))
+        with self._lock:
+            self._docs.pop(id, None)
+            self._docs[id] = doc
+            while len(self._docs) > self.max_size:
+                self._docs.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, id, rev=None):
+        """
+        Drop the entry for id. If rev is given, the entry is only dropped
+        when it is at a different revision.
+        """
+        with self._lock:
+            doc = self._docs.get(id)
+            if doc is not None and (rev is None or doc.get('_rev') != rev):
+                del self._docs[id]
+
+    def clear(self):
+        with self._lock:
+            self._docs.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._docs), 'max_size': self.max_size}
+
+
+class ShortCodeCache(object):
+    """
+    Bounded, in-process LRU cache of entity ids keyed by
+    (entity_type, short_code).
+
+    Only ids are kept; callers load the document itself by id and check
+    that it still has the short code, so a cached entry can never hand out
+    a stale revision. Short codes that matched no entity are not
+    remembered, so newly registered entities are found straight away.
+
+    Entries expire after ttl seconds. Writes through this process drop the
+    affected entries straight away, see discard.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        assert max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_id = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, entity_type, short_code):
+        """Return the id of the entity with the short code, or None when it has to be looked up"""
+        key = (tuple(entity_type), short_code)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl is not None and entry[0] < time()):
+                if entry is not None:
+                    self._forget(key, entry[1])
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        return entry[1]
+
+    def put(self, entity_type, short_code, id):
+        """Remember the id of the entity with the short code"""
+        key = (tuple(entity_type), short_code)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old[1])
+            self._entries[key] = (time() + self.ttl if self.ttl is not None else None, id)
+            self._keys_by_id[id] = key
+            while len(self._entries) > self.max_size:
+                evicted, (_, evicted_id) = self._entries.popitem(last=False)
+                self._forget(evicted, evicted_id)
+                self.evictions += 1
+
+    def discard(self, id):
+        """Drop whatever is cached for the entity with the given id"""
+        with self._lock:
+            key = self._keys_by_id.pop(id, None)
+            if key is not None:
+                self._entries.pop(key, None)
+
+    def _forget(self, key, id):
+        if self._keys_by_id.get(id) == key:
+            del self._keys_by_id[id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl}
@@ -1,7 +1,8 @@
 
 import logging
 
-from couchdb.mapping import TextField, Document, DateTimeField, DictField, BooleanField, ListField, FloatField
+from couchdb.mapping import TextField, Document, DateTimeField, DictField, BooleanField, ListField, FloatField, \
+    IntegerField
 import datetime
 import calendar
 from uuid import uuid1
@@ -352,3 +353,16 @@ class EntityActionDocument(DocumentBase):
         self.short_code = short_code
         self.action = action
 
+
+class ShortCodeCounterDocument(DocumentBase):
+    """
+    The last short code number handed out for an entity type, see
+    short_code_allocator.
+    """
+    entity_type = TextField()
+    last = IntegerField()
+
+    def __init__(self, id=None, entity_type=None, last=0):
+        DocumentBase.__init__(self, id=id, document_type='ShortCodeCounter')
+        self.entity_type = entity_type
+        self.last = last
@@ -3,13 +3,17 @@
 import copy
 from datetime import datetime
 from collections import defaultdict
+from itertools import islice
 from documents import EntityDocument, DataRecordDocument, attributes
-from mangrove.datastore.entity_type import entity_type_already_defined
-from mangrove.errors.MangroveException import DataObjectAlreadyExists, EntityTypeDoesNotExistsException, DataObjectNotFound
+from mangrove.datastore.entity_type import entity_type_already_defined, entity_type_registry
+from mangrove.errors.MangroveException import DataObjectAlreadyExists, EntityTypeDoesNotExistsException, DataObjectNotFound, \
+    FailedToSaveDataObject, MangroveException
 from mangrove.utils.types import is_empty
-from mangrove.utils.types import is_not_empty, is_sequence, is_string
+from mangrove.utils.types import is_not_empty, is_sequence, is_string, is_number
 from mangrove.utils.dates import utcnow, convert_date_time_to_epoch
-from database import DatabaseManager, DataObject
+from database import DatabaseManager, DataObject, VIEW_BATCH_SIZE
+
+SAVE_CHUNK_SIZE = 1000
 
 
 def void_entity(dbm, entity_type, short_code):
@@ -40,6 +44,91 @@ def create_entity(dbm, entity_type, short_code, location=None, aggregation_paths
     return e
 
 
+def create_entities_bulk(dbm, rows, chunk_size=SAVE_CHUNK_SIZE):
+    """
+    Register many entities at once, e.g. from a spreadsheet import.
+
+    Each row is a dict of the create_entity arguments (entity_type,
+    short_code and optionally location, aggregation_paths, geometry) and,
+    optionally, data, event_time and submission, which are recorded as
+    Entity.add_data does. Entity types are checked against one snapshot
+    of the type registry and all short codes are looked up with one multi-key
+    query. Entities and data records are then saved with _bulk_docs,
+    chunk_size documents per request; a row whose entity fails to save
+    is reported with FailedToSaveDataObject and its data record voided.
+
+    Returns a (success, entity_or_exception) tuple for every row.
+    """
+    entity_types = entity_type_registry(dbm)
+    keys = []
+    for row in rows:
+        try:
+            keys.append(_row_key(row))
+        except ValueError:
+            # reported by _create_entity_from_row
+            continue
+    existing = _entities_by_short_codes_include_voided(dbm, keys)
+    results = []
+    with dbm.batch(max_size=chunk_size, raise_on_conflict=False) as batch:
+        for row in rows:
+            try:
+                entity = _create_entity_from_row(dbm, row, entity_types, existing)
+            except (MangroveException, ValueError) as e:
+                results.append((False, e))
+                continue
+            existing[(tuple(entity.type_path), entity.short_code.lower())] = entity._doc
+            results.append((True, entity))
+    failed = dict(batch.conflicts)
+    return [(False, FailedToSaveDataObject(failed[result.id])) if success and result.id in failed else (success, result)
+            for success, result in results]
+
+
+def _row_key(row):
+    """(entity_type, short_code) of a create_entities_bulk row, ValueError if either is missing or malformed"""
+    entity_type, short_code = row.get('entity_type'), row.get('short_code')
+    if not is_string(short_code) or is_empty(short_code):
+        raise ValueError(u'Short code must be a non-empty string: %r' % (short_code,))
+    if type(entity_type) is not list or is_empty(entity_type):
+        raise ValueError(u'Entity type must be a non-empty list: %r' % (entity_type,))
+    return tuple(entity_type), short_code.lower()
+
+
+def _create_entity_from_row(dbm, row, entity_types, existing):
+    key = _row_key(row)
+    entity_type, short_code = row['entity_type'], row['short_code']
+    data = row.get('data') or []
+    for (label, value) in data:
+        if is_empty(label):
+            raise ValueError(u'Data must be of the form (label, value).')
+    if entity_type not in entity_types:
+        raise EntityTypeDoesNotExistsException(entity_type)
+    existing_doc = existing.get(key)
+    if existing_doc is not None:
+        entity_name = existing_doc.get('data', {}).get('name', {'value': ''}).get('value')
+        raise DataObjectAlreadyExists(entity_type[0].capitalize(), "Unique ID Number", short_code,
+                                      existing_name=entity_name)
+    entity = Entity(dbm, entity_type=entity_type, location=row.get('location'),
+                    aggregation_paths=row.get('aggregation_paths'), short_code=short_code,
+                    geometry=row.get('geometry'))
+    for (label, value) in data:
+        entity.data[label] = {'value': value}
+    entity.save()
+    if data:
+        record = DataRecordDocument(entity_doc=entity._doc, event_time=row.get('event_time') or utcnow(),
+                                    data=data, submission=row.get('submission'))
+        # registered before queueing, which may flush the chunk
+        dbm.current_batch().void_on_conflict(entity.id, [record.id])
+        dbm._save_document(record)
+    return entity
+
+
+def _entities_by_short_codes_include_voided(dbm, keys):
+    """{(entity_type, short_code): entity doc} for the keys, looked up with one multi-key query"""
+    keys = [[entity_type, short_code] for entity_type, short_code in set((tuple(t), c) for t, c in keys)]
+    rows = dbm.iter_view('entity_by_short_code', keys=keys, include_docs=True) if keys else []
+    return dict(((tuple(row['key'][0]), row['key'][1]), row['doc']) for row in rows)
+
+
 def get_by_short_code(dbm, short_code, entity_type):
     """
     Finds Entity with a given short code
@@ -53,13 +142,38 @@ def get_by_short_code(dbm, short_code, entity_type):
 
 
 def by_short_code(dbm, short_code, entity_type):
+    cache = dbm.short_code_cache
+    id = cache.get(entity_type, short_code) if cache is not None else None
+    if id is not None:
+        entities = dbm.get_many([id], Entity)
+        if entities and _has_short_code(entities[0], short_code, entity_type):
+            return entities[0]
+        cache.discard(id)
     rows = dbm.view.by_short_codes(key=[entity_type, short_code], reduce=False, include_docs=True)
     if is_empty(rows):
         raise DataObjectNotFound(entity_type[0], "Unique Identification Number (ID)", short_code)
-    doc = EntityDocument.wrap(rows[0]['doc'])
-    return Entity.new_from_doc(dbm, doc)
+    if cache is not None:
+        cache.put(entity_type, short_code, rows[0]['id'])
+    return Entity.new_from_doc(dbm, EntityDocument.wrap(rows[0]['doc']))
+
+
+def _has_short_code(entity, short_code, entity_type):
+    return not entity._doc.void and entity.short_code == short_code and entity.type_path == list(entity_type)
 
 def by_short_codes(dbm, short_codes, entity_type, limit=None):
+    entities = list(iter_by_short_codes(dbm, short_codes, entity_type, limit))
+    if is_empty(entities):
+        raise DataObjectNotFound(entity_type[0], "Unique Identification Number (ID)", "")
+    return entities
+
+
+def iter_by_short_codes(dbm, short_codes, entity_type, limit=None, batch_size=VIEW_BATCH_SIZE, fields=None,
+                        as_view=False):
+    """
+    Yields the entities of entity_type with the given short codes, asking
+    for batch_size short codes per request. See iter_all_entities for
+    fields and as_view.
+    """
     kwargs = {
                 'include_docs': True,
                 'reduce': False
@@ -67,14 +181,9 @@ def by_short_codes(dbm, short_codes, entity_type, limit=None):
     if limit:
         kwargs['limit'] = limit
 
-    keys = [[entity_type, short_code] for short_code in short_codes]
-    kwargs["keys"] = keys
-
-    rows = dbm.view.by_short_codes(**kwargs)
-    if is_empty(rows):
-        raise DataObjectNotFound(entity_type[0], "Unique Identification Number (ID)", "")
-    docs = [EntityDocument.wrap(row['doc']) for row in rows]
-    return [Entity.new_from_doc(dbm, doc) for doc in docs]
+    kwargs["keys"] = [[entity_type, short_code] for short_code in short_codes]
+    rows = dbm.iter_view('by_short_codes', batch_size=batch_size, **kwargs)
+    return _entities_from_rows(dbm, rows, fields, as_view)
 
 def _entity_by_short_code(dbm, short_code, entity_type):
     rows = dbm.view.entity_by_short_code(key=[entity_type, short_code], include_docs=True)
@@ -99,29 +208,118 @@ def get_all_entities(dbm, entity_type=None, limit=None):
     """
     Returns all the entities in the Database
     """
+    return list(iter_all_entities(dbm, entity_type, limit))
+
+
+def iter_all_entities(dbm, entity_type=None, limit=None, batch_size=VIEW_BATCH_SIZE, fields=None, as_view=False):
+    """
+    Yields the entities in the Database, or those of entity_type, reading
+    batch_size rows per request.
+
+    With fields, a list of dotted paths into the entity document such as
+    'short_code' or 'data.name.value', yields a dict of just those values
+    for each entity instead of the Entity itself. With as_view, yields a
+    read-only EntityView.
+    """
     if entity_type is not None:
-        return _get_all_entities_of_type(dbm, entity_type, limit)
+        rows = _iter_entity_rows_of_type(dbm, entity_type, limit, batch_size)
     else:
-        return _get_all_entities(dbm, limit)
+        rows = _iter_entity_rows(dbm, limit, batch_size)
+    return _entities_from_rows(dbm, rows, fields, as_view)
 
 
 def get_short_codes_by_entity_type(dbm, entity_type):
     startkey = [entity_type]
     endkey = [entity_type, {}]
-    rows = dbm.view.by_short_codes(reduce=False, include_docs=False, startkey=startkey, endkey=endkey)
-    return [row.key[1] for row in rows]
+    rows = dbm.iter_view('by_short_codes', reduce=False, include_docs=False, startkey=startkey, endkey=endkey)
+    return [row['key'][1] for row in rows]
 
 
 def get_entities_by_value(dbm, label, value, as_of=None):
     """
     Returns all entities with the given value for a label
     """
+    return list(iter_entities_by_value(dbm, label, value, as_of))
+
+
+def iter_entities_by_value(dbm, label, value, as_of=None, batch_size=VIEW_BATCH_SIZE):
+    """
+    Yields the entities whose latest value for label is value.
+
+    Without as_of this is one range over latest_by_label_value, which
+    indexes the latest data kept on the entity documents. With as_of, the
+    entities that had the value at some point until then come from
+    by_label_value_time and are checked batch_size at a time against
+    their latest value as of then.
+    """
     assert isinstance(dbm, DatabaseManager)
     assert as_of is None or isinstance(as_of, datetime)
-    rows = dbm.load_all_rows_in_view(u'by_label_value', key=[label, value])
-    entities = dbm.get_many([row[u'value'] for row in rows], Entity)
+    if as_of is None:
+        for row in dbm.iter_view(u'latest_by_label_value', batch_size=batch_size, key=[label, value],
+                                 include_docs=True):
+            yield Entity.new_from_doc(dbm, EntityDocument.wrap(row[u'doc']))
+        return
+
+    rows = dbm.iter_view(u'by_label_value_time', batch_size=batch_size, startkey=[label, value],
+                         endkey=[label, value, convert_date_time_to_epoch(as_of)])
+    candidates = _unique(row[u'value'] for row in rows)
+    while True:
+        ids = list(islice(candidates, batch_size))
+        if not ids:
+            return
+        values = get_entity_values(dbm, ids, {label: u'latest'}, asof=as_of)
+        for entity in dbm.get_many([id for id in ids if values[id] == {label: value}], Entity):
+            yield entity
+
+
+def _unique(values):
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+
+def _latest(points):
+    return max(points, key=lambda point: point[u'timestamp'])[u'value'] if points else None
+
+
+def _numbers(points):
+    return [point[u'value'] for point in points
+            if is_number(point[u'value']) and not isinstance(point[u'value'], bool)]
 
-    return [e for e in entities if e.values({label: u'latest'}, asof=as_of) == {label: value}]
+
+# how each function folds the (timestamp, value) points of a field recorded until asof;
+# sum, min and max give None and count 0 when nothing numeric was recorded
+ENTITY_VALUE_AGGREGATES = {
+    u'latest': _latest,
+    u'sum': lambda points: sum(_numbers(points)) if _numbers(points) else None,
+    u'min': lambda points: min(_numbers(points)) if _numbers(points) else None,
+    u'max': lambda points: max(_numbers(points)) if _numbers(points) else None,
+    u'count': lambda points: len(_numbers(points)),
+}
+
+
+def get_entity_values(dbm, entity_ids, aggregation_rules, asof=None):
+    """
+    Aggregates the data of several entities at once, see Entity.values.
+    Every [entity_id, field] pair is read with one keys request on the
+    entity_field_values view and folded up to asof here. Returns
+    {entity_id: {field: value}}.
+    """
+    for aggregate_fn in aggregation_rules.values():
+        if aggregate_fn not in ENTITY_VALUE_AGGREGATES:
+            raise ValueError(u"Unknown aggregate function: %s" % aggregate_fn)
+    asof = convert_date_time_to_epoch(asof or utcnow())
+    points = defaultdict(list)
+    keys = [[entity_id, field] for entity_id in entity_ids for field in aggregation_rules]
+    if keys:
+        for row in dbm.load_all_rows_in_view(u'entity_field_values', keys=keys):
+            if row[u'value'][u'timestamp'] <= asof:
+                points[tuple(row[u'key'])].append(row[u'value'])
+    return dict((entity_id, dict((field, ENTITY_VALUE_AGGREGATES[aggregate_fn](points[(entity_id, field)]))
+                                 for field, aggregate_fn in aggregation_rules.items()))
+                for entity_id in entity_ids)
 
 
 def entities_exists_with_value(dbm, entity_type, label, value):
@@ -258,7 +456,7 @@ class Entity(DataObject):
         # aggregation paths on data records, in which case we need to
         # set a dirty flag and handle this in save.
 
-    def add_data(self, data=(), event_time=None, submission=None, multiple_records=False):
+    def add_data(self, data=(), event_time=None, submission=None, multiple_records=False, defer_latest=False):
         """
         Add a new datarecord to this Entity and return a UUID for the datarecord.
         Arguments:
@@ -267,6 +465,14 @@ class Entity(DataObject):
                 when it was reported
             submission_id: an id to a 'submission' document in the
                 submission log from which this data came
+            multiple_records: one datarecord per (label, value), the
+                list of their UUIDs is returned
+            defer_latest: inside a DatabaseManager.batch, write the
+                entity's latest data once when the batch is flushed
+
+        The entity and its datarecords are written with one bulk request,
+        or queued in the enclosing DatabaseManager.batch; the datarecords
+        are voided again if the entity fails to save.
         """
         assert is_sequence(data)
         assert event_time is None or isinstance(event_time, datetime)
@@ -280,31 +486,23 @@ class Entity(DataObject):
         for (label, value) in data:
             if is_empty(label):
                 raise ValueError(u'Data must be of the form (label, value).')
-        self.update_latest_data(data=data)
-        if multiple_records:
-            data_list = []
-            for (label, value) in data:
-                data_record = DataRecordDocument(
-                    entity_doc=self._doc,
-                    event_time=event_time,
-                    data=[(label, value)],
-                    submission=submission
-                )
-                data_list.append(data_record)
-            return self._dbm._save_documents(data_list)
-        else:
-            data_record_doc = DataRecordDocument(
-                entity_doc=self._doc,
-                event_time=event_time,
-                data=data,
-                submission=submission
-            )
-            return self._dbm._save_document(data_record_doc)
-
-    def update_latest_data(self, data):
+        with self._dbm.batch() as batch:
+            self.update_latest_data(data=data, defer=defer_latest)
+            records = [[(label, value)] for (label, value) in data] if multiple_records else [data]
+            documents = [DataRecordDocument(entity_doc=self._doc, event_time=event_time, data=record_data,
+                                            submission=submission) for record_data in records]
+            batch.void_on_conflict(self.id, [document.id for document in documents])
+            ids = [self._dbm._save_document(document) for document in documents]
+        return ids if multiple_records else ids[0]
+
+    def update_latest_data(self, data, defer=False):
         for (label, value) in data:
             self.data[label] = {'value': value}
-        self.save()
+        batch = self._dbm.current_batch() if defer else None
+        if batch is not None:
+            batch.update_latest_data(self._doc, data)
+        else:
+            self.save()
 
     def invalidate_data(self, uid):
         """
@@ -324,8 +522,7 @@ class Entity(DataObject):
         """
         self._doc.void = True
         self.save()
-        for id in self._get_data_ids():
-            self.invalidate_data(id)
+        self._dbm.void_documents(self._get_data_ids())
 
 
     # def get_all_data(self):
@@ -359,14 +556,18 @@ class Entity(DataObject):
         Eg: aggregation_rules={'arv':'latest', 'num_patients':'sum'}
         will return latest value for arv and sum the number of
         patients.
+        The functions in ENTITY_VALUE_AGGREGATES are answered together
+        with one request on the entity_field_values view; any other
+        aggregate_fn is still taken to be the name of a 'latest' style
+        view and costs one request per field.
         """
-        # todo: I think we need to simplify this method a bit and
-        # expose some of the ViewResults goodness.
         asof = asof or utcnow()
-        result = {}
+        batched = dict((field, aggregate_fn) for field, aggregate_fn in aggregation_rules.items()
+                       if aggregate_fn in ENTITY_VALUE_AGGREGATES)
+        result = get_entity_values(self._dbm, [self.id], batched, asof)[self.id] if batched else {}
         for field, aggregate_fn in aggregation_rules.items():
-            view_name = self._translate(aggregate_fn)
-            result[field] = self._get_aggregate_value(field, view_name, asof)
+            if field not in batched:
+                result[field] = self._get_aggregate_value(field, aggregate_fn, asof)
         return result
 
     def latest_values(self):
@@ -387,13 +588,8 @@ class Entity(DataObject):
         #           }
         #  The aggregation map-reduce view will return only one row for an entity-id
         # From this we return the field we are interested in.
-        # TODO: Hardcoding to 'latest' for now. Generalize to any aggregation function.
         return rows[0][u'value'][u'latest'] if len(rows) else None
 
-    def _translate(self, aggregate_fn):
-        view_names = {u"latest": u"by_values_latest_by_time"}
-        return view_names[aggregate_fn] if aggregate_fn in view_names else aggregate_fn
-
     def _get_data_ids(self):
         """
         Returns a list of all data documents ids for this entity.
@@ -439,6 +635,48 @@ class Entity(DataObject):
         self._doc.geometry = geometry
 
 
+class EntityView(object):
+    """
+    A read-only record of an entity, taken straight from the raw entity
+    document of a view row. Listings and exports that only read entities
+    use it to skip wrapping the document and copying its paths.
+    """
+    __slots__ = ('id', 'short_code', 'type_path', 'location_path', 'geometry', 'centroid', 'data')
+
+    def __init__(self, doc):
+        paths = doc.get(attributes.AGG_PATHS) or {}
+        set_ = super(EntityView, self).__setattr__
+        set_('id', doc.get('_id'))
+        set_('short_code', doc.get('short_code'))
+        set_('type_path', paths.get(attributes.TYPE_PATH))
+        set_('location_path', paths.get(attributes.GEO_PATH) or [])
+        set_('geometry', doc.get('geometry') or {})
+        set_('centroid', doc.get('centroid'))
+        set_('data', doc.get('data') or {})
+
+    def __setattr__(self, name, value):
+        raise AttributeError(u"EntityView is read-only")
+
+    @property
+    def type_string(self):
+        return u'.'.join(self.type_path or [])
+
+    @property
+    def location_string(self):
+        return u'.'.join(self.location_path)
+
+    @property
+    def is_reporter(self):
+        return self.type_path[0] == 'reporter'
+
+    def value(self, label):
+        """
+            Returns the latest value for the given label.
+        """
+        field = self.data.get(label)
+        return field.get('value') if field is not None else None
+
+
 class DataRecord(DataObject):
     __document_class__ = DataRecordDocument
 
@@ -465,9 +703,7 @@ class DataRecord(DataObject):
 
 def delete_data_record(dbm, form_code, short_code):
     data_records = dbm.view.data_record_by_form_code(key=[form_code, short_code])
-    for data_record in data_records:
-        data_record_doc = data_record.value
-        dbm.database.delete(data_record_doc)
+    dbm.delete_documents([data_record.value['_id'] for data_record in data_records])
 
 
 def _check_if_entity_exists(dbm, entity_type, short_code, return_entity=False):
@@ -505,7 +741,7 @@ def _make_short_code(entity_type, num):
     return SHORT_CODE_FORMAT % (entity_prefix, num)
 
 
-def _get_all_entities(dbm, limit=None):
+def _iter_entity_rows(dbm, limit=None, batch_size=VIEW_BATCH_SIZE):
     kwargs = {
                 'include_docs': True,
                 'reduce': False
@@ -513,11 +749,10 @@ def _get_all_entities(dbm, limit=None):
     if limit:
         kwargs['limit'] = limit
 
-    rows = dbm.view.by_short_codes(**kwargs)
-    return [_from_row_to_entity(dbm, row) for row in rows]
+    return dbm.iter_view('by_short_codes', batch_size=batch_size, **kwargs)
 
 
-def _get_all_entities_of_type(dbm, entity_type, limit=None):
+def _iter_entity_rows_of_type(dbm, entity_type, limit=None, batch_size=VIEW_BATCH_SIZE):
     kwargs = {
                 'startkey': [entity_type],
                 'endkey': [entity_type, {}],
@@ -527,15 +762,38 @@ def _get_all_entities_of_type(dbm, entity_type, limit=None):
     if limit:
         kwargs['limit'] = limit
 
-    rows = dbm.view.by_short_codes(**kwargs)
-    return [_from_row_to_entity(dbm, row) for row in rows]
+    return dbm.iter_view('by_short_codes', batch_size=batch_size, **kwargs)
+
+
+def _entities_from_rows(dbm, rows, fields=None, as_view=False):
+    for row in rows:
+        if fields is not None:
+            yield project_document(row.get('doc'), fields)
+        elif as_view:
+            yield EntityView(row.get('doc'))
+        else:
+            yield _from_row_to_entity(dbm, row)
+
+
+def project_document(doc, fields):
+    """
+    Picks the dotted paths in fields out of a raw document, e.g.
+    project_document(doc, ['short_code', 'data.name.value']). Missing
+    paths come back as None.
+    """
+    projection = {}
+    for field in fields:
+        value = doc
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        projection[field] = value
+    return projection
 
 
 def get_all_entities_include_voided(dbm, entity_type):
     startkey = [entity_type]
     endkey = [entity_type, {}]
-    rows = dbm.database.iterview('entity_by_short_code/entity_by_short_code', 1000, reduce=False, include_docs=True,
-                                 startkey=startkey, endkey=endkey)
+    rows = dbm.iter_view('entity_by_short_code', reduce=False, include_docs=True, startkey=startkey, endkey=endkey)
     for row in rows:
         yield _from_row_to_entity(dbm, row)
 
@@ -4,13 +4,75 @@
 for example Clinic, Hospital, Waterpoints, School etc are entity types
 """
 
-from mangrove.datastore.aggregationtree import AggregationTree
+from threading import Lock
+from mangrove.datastore.aggregationtree import AggregationTree, CompactAggregationTree
 from mangrove.datastore.database import DatabaseManager
 from mangrove.errors.MangroveException import EntityTypeAlreadyDefined
 from mangrove.utils.types import is_not_empty, is_sequence
 
 ENTITY_TYPE_TREE_ID = u'entity_type_tree'
 
+
+class EntityTypeRegistry(object):
+    """
+    The entity types of one database as of a revision of the entity type
+    tree document. Loading the tree and walking its graph happens only
+    when that revision changes; checking it costs one _all_docs lookup.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (rev, paths, lower case paths), replaced as a whole
+        self._types = (None, [], frozenset())
+
+    @property
+    def rev(self):
+        return self._types[0]
+
+    @property
+    def paths(self):
+        return self._types[1]
+
+    def refresh(self, dbm):
+        rev = _entity_type_tree_rev(dbm)
+        if rev is None or rev != self.rev:
+            with self._lock:
+                if rev is None or rev != self.rev:
+                    self.load(CompactAggregationTree.get(dbm, ENTITY_TYPE_TREE_ID, get_or_create=True))
+        return self
+
+    def load(self, tree):
+        """Takes the types from the given, e.g. just saved, entity type tree"""
+        paths = tree.get_paths()
+        self._types = (tree._doc.rev, paths, frozenset(tuple(x.lower() for x in each) for each in paths))
+
+    def __contains__(self, entity_type):
+        return tuple(each.strip().lower() for each in entity_type) in self._types[2]
+
+
+_registries = {}
+_registries_lock = Lock()
+
+
+def entity_type_registry(dbm):
+    """The process' registry for dbm's database, brought up to date with the type tree"""
+    return _registry(dbm).refresh(dbm)
+
+
+def _registry(dbm):
+    k = (dbm.url, dbm.database_name)
+    registry = _registries.get(k)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.setdefault(k, EntityTypeRegistry())
+    return registry
+
+
+def _entity_type_tree_rev(dbm):
+    rows = dbm.database.view('_all_docs', key=ENTITY_TYPE_TREE_ID).rows
+    return rows[0]['value']['rev'] if rows else None
+
+
 def define_type(dbm, entity_type):
     """
     Add this entity type to the tree of all entity types and save it
@@ -25,6 +87,7 @@ def define_type(dbm, entity_type):
     entity_tree = AggregationTree.get(dbm, ENTITY_TYPE_TREE_ID, get_or_create=True)
     entity_tree.add_path([AggregationTree.root_id] + entity_type)
     entity_tree.save()
+    _registry(dbm).load(entity_tree)
 
 def get_all_entity_types(dbm):
     """
@@ -33,7 +96,7 @@ def get_all_entity_types(dbm):
     tree and the node is represented by a list containing the node
     names in the path to this node.
     """
-    return AggregationTree.get(dbm, ENTITY_TYPE_TREE_ID, get_or_create=True).get_paths()
+    return [list(path) for path in entity_type_registry(dbm).paths]
 
 def get_unique_id_types(manager):
     entity_types = get_all_entity_types(manager)
@@ -45,17 +108,11 @@ def delete_type(dbm, entity):
     for entity_item in entity:
         entity_tree.remove_node(entity_item)
         entity_tree.save()
+    _registry(dbm).load(entity_tree)
 
 def entity_type_already_defined(dbm, entity_type):
     """
     Return True if entity_type is already defined else false
     """
-    type_path = [item.strip() for item in entity_type]
-    all_entities = get_all_entity_types(dbm)
-    if all_entities:
-        all_entities_lower_case = [[x.lower() for x in each] for each in all_entities]
-        entity_type_lower_case = [each.lower() for each in type_path]
-        if entity_type_lower_case in all_entities_lower_case:
-            return True
-    return False
+    return entity_type in entity_type_registry(dbm)
 
@@ -0,0 +1,108 @@
+""" Instrumentation of CouchDB view queries.
+
+A DatabaseManager without instrumentation (the default) queries views
+directly and records nothing. Give it a ViewInstrumentation to keep, per
+view, a latency histogram, the number of queries, rows and (optionally)
+bytes returned. Hooks registered with add_hook are called after every
+query and are the place to export to an external metrics system.
+"""
+
+import logging
+from threading import Lock
+
+import couchdb.json
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class ViewStats(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.histogram = [0] * len(buckets)
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+        self.bytes = 0
+
+    def record(self, elapsed, row_count, byte_count):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.rows += row_count
+        self.bytes += byte_count
+        for i, upper_bound in enumerate(self.buckets):
+            if elapsed <= upper_bound:
+                self.histogram[i] += 1
+                break
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {'count': self.count, 'total_time': self.total_time, 'mean_time': self.mean_time,
+                'max_time': self.max_time, 'rows': self.rows, 'bytes': self.bytes,
+                'histogram': zip(self.buckets, self.histogram)}
+
+
+class ViewInstrumentation(object):
+    """
+    Collects per-view query statistics.
+
+    measure_bytes re-encodes every result to count its size. It is off by
+    default because it roughly doubles the JSON work done per query.
+    """
+
+    def __init__(self, measure_bytes=False, buckets=LATENCY_BUCKETS):
+        self.measure_bytes = measure_bytes
+        self.buckets = buckets
+        self._stats = {}
+        self._hooks = []
+        self._lock = Lock()
+
+    def add_hook(self, hook):
+        """hook(view_name, elapsed_seconds, row_count, byte_count) is called after every query"""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def record(self, view_name, elapsed, rows):
+        row_count = len(rows)
+        byte_count = len(couchdb.json.encode(rows)) if self.measure_bytes else 0
+        with self._lock:
+            if view_name not in self._stats:
+                self._stats[view_name] = ViewStats(self.buckets)
+            self._stats[view_name].record(elapsed, row_count, byte_count)
+        for hook in self._hooks:
+            hook(view_name, elapsed, row_count, byte_count)
+
+    def stats_for(self, view_name):
+        return self._stats.get(view_name)
+
+    def stats(self):
+        with self._lock:
+            return dict((name, stats.to_dict()) for name, stats in self._stats.items())
+
+    def slowest(self, n=10):
+        """Returns the n view names with the highest total query time, slowest first"""
+        with self._lock:
+            ranked = sorted(self._stats.items(), key=lambda item: item[1].total_time, reverse=True)
+        return [name for name, stats in ranked[:n]]
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class SlowQueryLogger(object):
+    """Hook that logs every view query slower than threshold seconds"""
+
+    def __init__(self, threshold=1.0, logger=None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger(__name__)
+
+    def __call__(self, view_name, elapsed, row_count, byte_count):
+        if elapsed >= self.threshold:
+            self.logger.warning("view %s took %.3f seconds (%s rows)", view_name, elapsed, row_count)
@@ -0,0 +1,595 @@
+""" In-memory stand-in for a CouchDB server.
+
+DatabaseManager connects here instead of over HTTP when its server url
+starts with memory://, e.g. DatabaseManager(None, 'memory://bench/', 'db').
+Servers with the same url share their databases for the life of the
+process, like a real server would.
+
+InMemoryDatabase answers the subset of couchdb.client.Database that
+mangrove uses: document CRUD, _bulk_docs updates with conflict
+detection, attachments, _all_docs and design document views. Views are
+evaluated with the Python ports of the javascript views (see
+mangrove.bootstrap.views.python_views, extend with register_view) and
+CouchDB collation; the built-in _count, _sum and _stats reduces, group
+and group_level are supported. Indexes are built on first query and
+kept up to date on every write.
+
+Documents go through couchdb.json on the way in and out, so callers get
+the same types back (e.g. datetimes) as from a real server.
+"""
+
+from bisect import bisect_left, insort
+from numbers import Number
+from StringIO import StringIO
+from threading import RLock
+from uuid import uuid4
+import json
+
+import couchdb.client
+import couchdb.json
+from couchdb.http import ResourceConflict, ResourceNotFound, PreconditionFailed
+
+from mangrove.bootstrap.views.python_views import python_views
+
+MEMORY_URL_SCHEME = 'memory://'
+REDUCE_CHUNK_SIZE = 64
+
+_OPTION_ALIASES = {'start_key': 'startkey', 'end_key': 'endkey', 'start_key_doc_id': 'startkey_docid',
+                   'end_key_doc_id': 'endkey_docid'}
+
+_views = dict(python_views)
+_servers = {}
+_servers_lock = RLock()
+
+
+def register_view(name, map_fun, reduce_fun=None):
+    """
+    Python implementation of the view called name, used for every design
+    document that defines a view of that name. map_fun(doc, emit) gets
+    the document as plain JSON and must emit JSON values; reduce_fun(keys, values, rereduce) is only
+    needed when the design document reduce is not a built-in.
+    """
+    _views[name] = {'map': map_fun}
+    if reduce_fun is not None:
+        _views[name]['reduce'] = reduce_fun
+
+
+def get_server(url):
+    with _servers_lock:
+        if url not in _servers:
+            _servers[url] = InMemoryServer(url)
+        return _servers[url]
+
+
+class _Top(object):
+    """Sorts after any value, used to build upper bounds of key ranges"""
+
+    def __eq__(self, other):
+        return other is self
+
+    def __ne__(self, other):
+        return other is not self
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return other is self
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __ge__(self, other):
+        return True
+
+_TOP = _Top()
+
+
+def collation_key(value):
+    """Sort key giving CouchDB view collation: null, false, true, numbers, strings, arrays, objects"""
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, Number):
+        return (3, value)
+    if isinstance(value, basestring):
+        # close to ICU: case-insensitive first, then lower case before upper case
+        return (4, value.lower(), value.swapcase())
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(collation_key(v) for v in value))
+    if isinstance(value, dict):
+        return (6, tuple((collation_key(k), collation_key(v)) for k, v in sorted(value.items())))
+    raise TypeError('%r is not a JSON value' % (value,))
+
+
+def _plain(value):
+    """value as the server sees it once encoded, e.g. datetimes become ISO strings"""
+    return json.loads(couchdb.json.encode(value))
+
+
+def _decoded(value):
+    """value as a client sees it once decoded"""
+    return couchdb.json.decode(json.dumps(value))
+
+
+def _builtin_count(keys, values, rereduce):
+    return sum(values) if rereduce else len(values)
+
+
+def _builtin_sum(keys, values, rereduce):
+    return sum(values)
+
+
+def _builtin_stats(keys, values, rereduce):
+    if rereduce:
+        return {'sum': sum(v['sum'] for v in values), 'count': sum(v['count'] for v in values),
+                'min': min(v['min'] for v in values), 'max': max(v['max'] for v in values),
+                'sumsqr': sum(v['sumsqr'] for v in values)}
+    return {'sum': sum(values), 'count': len(values), 'min': min(values), 'max': max(values),
+            'sumsqr': sum(v * v for v in values)}
+
+BUILTIN_REDUCES = {'_count': _builtin_count, '_sum': _builtin_sum, '_stats': _builtin_stats}
+
+
+class _Resource(object):
+    def __init__(self, url):
+        self.url = url
+        self.credentials = None
+
+
+class InMemoryServer(object):
+    def __init__(self, url):
+        self.resource = _Resource(url)
+        self._databases = {}
+        self._lock = RLock()
+
+    def __contains__(self, name):
+        return name in self._databases
+
+    def __iter__(self):
+        return iter(sorted(self._databases))
+
+    def __len__(self):
+        return len(self._databases)
+
+    def __getitem__(self, name):
+        try:
+            return self._databases[name]
+        except KeyError:
+            raise ResourceNotFound(('not_found', 'no_db_file'))
+
+    def __delitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                raise ResourceNotFound(('not_found', 'missing'))
+            del self._databases[name]
+
+    def create(self, name):
+        with self._lock:
+            if name in self._databases:
+                raise PreconditionFailed(('file_exists', 'The database could not be created, the file already exists.'))
+            self._databases[name] = InMemoryDatabase(name)
+            return self._databases[name]
+
+    def delete(self, name):
+        del self[name]
+
+
+class InMemoryViewResults(object):
+    """The parts of couchdb.client.ViewResults mangrove relies on"""
+
+    def __init__(self, rows, total_rows=None, offset=None):
+        self.rows = rows
+        self.total_rows = total_rows
+        self.offset = offset
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return '<%s rows=%d>' % (type(self).__name__, len(self.rows))
+
+
+class _Index(object):
+    """Sorted (collation key, docid, emit number, key, value) entries of one view"""
+
+    def __init__(self, map_fun):
+        self.map_fun = map_fun
+        self.entries = []
+        self._by_doc = {}
+
+    def remove(self, docid):
+        for entry in self._by_doc.pop(docid, ()):
+            del self.entries[bisect_left(self.entries, entry[:3])]
+
+    def add(self, docid, doc):
+        for entry in self._map(docid, doc):
+            insort(self.entries, entry)
+
+    def build(self, docs):
+        """Indexes (docid, doc) pairs in one sort rather than an insort per row"""
+        for docid, doc in docs:
+            self.entries.extend(self._map(docid, doc))
+        self.entries.sort()
+
+    def _map(self, docid, doc):
+        emitted = []
+        emit = lambda key, value: emitted.append((key, value))
+        try:
+            self.map_fun(doc, emit)
+        except Exception:
+            # CouchDB skips documents whose map function throws
+            return []
+        entries = []
+        for n, (key, value) in enumerate(emitted):
+            entries.append((collation_key(key), docid, n, key, value))
+        if entries:
+            self._by_doc[docid] = entries
+        return entries
+
+
+class InMemoryDatabase(object):
+    def __init__(self, name):
+        self._name = name
+        self._docs = {}
+        self._ids = []
+        self._deleted = {}
+        self._attachments = {}
+        self._indexes = {}
+        self._update_seq = 0
+        self._lock = RLock()
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self._name)
+
+    @property
+    def name(self):
+        return self._name
+
+    def __contains__(self, id):
+        return id in self._docs
+
+    def __iter__(self):
+        return iter(list(self._ids))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __nonzero__(self):
+        return True
+
+    def __getitem__(self, id):
+        doc = self.get(id)
+        if doc is None:
+            raise ResourceNotFound(('not_found', 'missing'))
+        return doc
+
+    def __setitem__(self, id, content):
+        content['_id'] = id
+        self.save(content)
+
+    def __delitem__(self, id):
+        with self._lock:
+            if id not in self._docs:
+                raise ResourceNotFound(('not_found', 'missing'))
+            self._write(id, None)
+
+    def info(self):
+        return {'db_name': self._name, 'doc_count': len(self._docs), 'doc_del_count': len(self._deleted),
+                'update_seq': self._update_seq}
+
+    def get(self, id, default=None, **options):
+        stored = self._docs.get(id)
+        if stored is None:
+            return default
+        return couchdb.client.Document(couchdb.json.decode(stored[1]))
+
+    def save(self, doc, **options):
+        success, id, rev_or_exc = self.update([doc])[0]
+        if not success:
+            raise rev_or_exc
+        doc['_id'] = id
+        doc['_rev'] = rev_or_exc
+        return id, rev_or_exc
+
+    def update(self, documents, **options):
+        docs = []
+        for doc in documents:
+            if isinstance(doc, dict):
+                docs.append(doc)
+            elif hasattr(doc, 'items'):
+                docs.append(dict(doc.items()))
+            else:
+                raise TypeError('expected dict, got %s' % type(doc))
+
+        results = []
+        with self._lock:
+            for doc in docs:
+                doc = _plain(doc)
+                id = doc.get('_id') or uuid4().hex
+                rev = doc.get('_rev')
+                current = self._docs.get(id)
+                expected = (current[0],) if current is not None else (None, self._deleted.get(id))
+                if rev not in expected:
+                    results.append((False, id, ResourceConflict(('conflict', 'Document update conflict.'))))
+                    continue
+                if doc.get('_deleted') and current is None:
+                    results.append((False, id, ResourceNotFound(('not_found', 'missing'))))
+                    continue
+                doc['_id'] = id
+                results.append((True, id, self._write(id, None if doc.get('_deleted') else doc)))
+        return results
+
+    def delete(self, doc):
+        if doc['_id'] is None:
+            raise ValueError('document ID cannot be None')
+        with self._lock:
+            current = self._docs.get(doc['_id'])
+            if current is None:
+                raise ResourceNotFound(('not_found', 'missing'))
+            if current[0] != doc['_rev']:
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            self._write(doc['_id'], None)
+
+    def _next_rev(self, id):
+        current = self._docs.get(id)
+        previous = current[0] if current is not None else self._deleted.get(id)
+        generation = int(previous.split('-', 1)[0]) if previous else 0
+        return '%d-%s' % (generation + 1, uuid4().hex)
+
+    def _write(self, id, doc):
+        """Stores doc (plain JSON) as the next revision of id, or deletes id when doc is None"""
+        new_rev = self._next_rev(id)
+        if doc is None:
+            self._docs.pop(id, None)
+            self._attachments.pop(id, None)
+            self._deleted[id] = new_rev
+            del self._ids[bisect_left(self._ids, id)]
+        else:
+            self._set_attachments(id, doc)
+            doc['_rev'] = new_rev
+            if id not in self._docs:
+                self._deleted.pop(id, None)
+                insort(self._ids, id)
+            self._docs[id] = (new_rev, json.dumps(doc))
+        self._update_seq += 1
+        self._reindex(id, doc)
+        return new_rev
+
+    def _set_attachments(self, id, doc):
+        stubs = doc.get('_attachments') or {}
+        existing = self._attachments.get(id, {})
+        attachments = {}
+        for name, stub in stubs.items():
+            if 'data' in stub:
+                attachments[name] = (stub.get('content_type'), stub['data'].decode('base64'))
+            elif name in existing:
+                attachments[name] = existing[name]
+        if attachments:
+            self._attachments[id] = attachments
+            doc['_attachments'] = dict((name, {'content_type': content_type, 'length': len(data), 'stub': True})
+                                       for name, (content_type, data) in attachments.items())
+        else:
+            self._attachments.pop(id, None)
+            doc.pop('_attachments', None)
+
+    def put_attachment(self, doc, content, filename=None, content_type=None):
+        if filename is None:
+            filename = getattr(content, 'name', None)
+        if hasattr(content, 'read'):
+            content = content.read()
+        with self._lock:
+            current = self.get(doc['_id'])
+            if current is None:
+                current = {'_id': doc['_id']}
+            elif current.rev != doc['_rev']:
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            current = _plain(current)
+            current.setdefault('_attachments', {})[filename] = {
+                'content_type': content_type or 'application/octet-stream', 'data': content.encode('base64')}
+            doc['_rev'] = self._write(doc['_id'], current)
+
+    def get_attachment(self, id_or_doc, filename, default=None):
+        id = id_or_doc if isinstance(id_or_doc, basestring) else id_or_doc['_id']
+        attachment = self._attachments.get(id, {}).get(filename)
+        if attachment is None:
+            return default
+        return StringIO(attachment[1])
+
+    def delete_attachment(self, doc, filename):
+        with self._lock:
+            current = self._docs.get(doc['_id'])
+            if current is None or filename not in self._attachments.get(doc['_id'], {}):
+                raise ResourceNotFound(('not_found', 'missing'))
+            if current[0] != doc['_rev']:
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            stored = json.loads(current[1])
+            del stored['_attachments'][filename]
+            doc['_rev'] = self._write(doc['_id'], stored)
+
+    def _reindex(self, id, doc):
+        if id.startswith('_design/'):
+            design = id[len('_design/'):]
+            for name in [name for name in self._indexes if name.split('/', 1)[0] == design]:
+                del self._indexes[name]
+            return
+        for index in self._indexes.values():
+            index.remove(id)
+            if doc is not None:
+                index.add(id, doc)
+
+    def _view_functions(self, name):
+        design, view_name = name.split('/', 1)
+        stored = self._docs.get('_design/' + design)
+        definition = json.loads(stored[1]).get('views', {}).get(view_name) if stored is not None else None
+        if definition is None:
+            raise ResourceNotFound(('not_found', 'missing_named_view'))
+        if view_name not in _views:
+            raise NotImplementedError('no python implementation of view %s' % view_name)
+        reduce_fun = definition.get('reduce')
+        if reduce_fun is not None:
+            reduce_fun = BUILTIN_REDUCES.get(reduce_fun.strip()) or _views[view_name].get('reduce')
+            if reduce_fun is None:
+                raise NotImplementedError('no python implementation of the reduce of view %s' % view_name)
+        return _views[view_name]['map'], reduce_fun
+
+    def _index(self, name, map_fun):
+        index = self._indexes.get(name)
+        if index is None:
+            index = _Index(map_fun)
+            index.build((id, json.loads(self._docs[id][1])) for id in self._ids if not id.startswith('_design/'))
+            self._indexes[name] = index
+        return index
+
+    def view(self, name, wrapper=None, **options):
+        options = dict((_OPTION_ALIASES.get(option, option), _plain(value)) for option, value in options.items())
+        with self._lock:
+            if name == '_all_docs':
+                results = self._all_docs(options)
+            else:
+                map_fun, reduce_fun = self._view_functions(name)
+                results = self._query(self._index(name, map_fun), reduce_fun, options)
+        results.rows = [couchdb.client.Row(row) for row in _decoded(results.rows)]
+        if wrapper is not None:
+            results.rows = [wrapper(row) for row in results.rows]
+        return results
+
+    iterview = couchdb.client.Database.__dict__['iterview']
+
+    def _all_docs(self, options):
+        include_docs = options.get('include_docs', False)
+        if 'keys' in options:
+            rows = []
+            for key in options['keys']:
+                if key in self._docs:
+                    rows.append(self._all_docs_row(key, include_docs))
+                elif key in self._deleted:
+                    row = {'id': key, 'key': key, 'value': {'rev': self._deleted[key], 'deleted': True}}
+                    if include_docs:
+                        row['doc'] = None
+                    rows.append(row)
+                else:
+                    rows.append({'key': key, 'error': 'not_found'})
+            return InMemoryViewResults(rows, len(self._docs), 0)
+
+        for option in ('startkey_docid', 'endkey_docid'):
+            options.pop(option, None)
+        ids = [(id,) for id in self._ids]
+        start, end = _key_range(ids, options, lambda key: key)
+        selected, offset = _window(ids, start, end, options)
+        return InMemoryViewResults([self._all_docs_row(id, include_docs) for id, in selected], len(self._docs),
+                                   offset)
+
+    def _all_docs_row(self, id, include_docs):
+        rev, text = self._docs[id]
+        row = {'id': id, 'key': id, 'value': {'rev': rev}}
+        if include_docs:
+            row['doc'] = json.loads(text)
+        return row
+
+    def _query(self, index, reduce_fun, options):
+        entries = index.entries
+        if 'keys' in options:
+            selected = []
+            for key in options['keys']:
+                start, end = _key_range(entries, {'key': key}, collation_key)
+                selected.extend(entries[start:end])
+            offset = 0
+        else:
+            start, end = _key_range(entries, options, collation_key)
+            selected, offset = _window(entries, start, end, dict(options, skip=0, limit=None))
+
+        if reduce_fun is not None and options.get('reduce', True):
+            return InMemoryViewResults(_skip_and_limit(self._reduce(selected, reduce_fun, options), options))
+
+        rows = []
+        for _, docid, _, key, value in _skip_and_limit(selected, options):
+            row = {'id': docid, 'key': key, 'value': value}
+            if options.get('include_docs', False):
+                row['doc'] = json.loads(self._docs[docid][1])
+            rows.append(row)
+        return InMemoryViewResults(rows, len(entries), offset + options.get('skip', 0))
+
+    def _reduce(self, entries, reduce_fun, options):
+        # group on the stored collation keys (arrays are (5, element keys)) rather than recomputing them
+        if options.get('group', False):
+            group_key = lambda ckey, key: (ckey, key)
+        elif 'group_level' in options:
+            level = options['group_level']
+            group_key = lambda ckey, key: ((5, ckey[1][:level]), key[:level]) if ckey[0] == 5 else (ckey, key)
+        else:
+            group_key = lambda ckey, key: (None, None)
+
+        rows = []
+        group, keys, values = None, [], []
+        for ckey, docid, _, key, value in entries:
+            current = group_key(ckey, key)
+            if keys and current[0] != group[0]:
+                rows.append({'key': group[1], 'value': _run_reduce(reduce_fun, keys, values)})
+                keys, values = [], []
+            group = current
+            keys.append([key, docid])
+            values.append(value)
+        if keys:
+            rows.append({'key': group[1], 'value': _run_reduce(reduce_fun, keys, values)})
+        return rows
+
+
+def _run_reduce(reduce_fun, keys, values):
+    """Reduces in chunks and re-reduces the results, as CouchDB does over its b-tree nodes"""
+    if len(values) <= REDUCE_CHUNK_SIZE:
+        return reduce_fun(keys, values, False)
+    reduced = [reduce_fun(keys[i:i + REDUCE_CHUNK_SIZE], values[i:i + REDUCE_CHUNK_SIZE], False)
+               for i in range(0, len(values), REDUCE_CHUNK_SIZE)]
+    while len(reduced) > REDUCE_CHUNK_SIZE:
+        reduced = [reduce_fun(None, reduced[i:i + REDUCE_CHUNK_SIZE], True)
+                   for i in range(0, len(reduced), REDUCE_CHUNK_SIZE)]
+    return reduce_fun(None, reduced, True)
+
+
+def _key_range(entries, options, sort_key):
+    """[start, end) of the ascending entries selected by key, startkey, endkey, their docids and inclusive_end"""
+    if 'key' in options:
+        options['startkey'] = options['endkey'] = options['key']
+
+    def lower(name):
+        docid = options.get(name + '_docid')
+        return (sort_key(options[name]),) + ((docid,) if docid is not None else ())
+
+    def upper(name):
+        return lower(name) + (_TOP,)
+
+    inclusive_end = options.get('inclusive_end', True)
+    start, end = 0, len(entries)
+    if options.get('descending', False):
+        if 'endkey' in options:
+            start = bisect_left(entries, lower('endkey') if inclusive_end else upper('endkey'))
+        if 'startkey' in options:
+            end = bisect_left(entries, upper('startkey'))
+    else:
+        if 'startkey' in options:
+            start = bisect_left(entries, lower('startkey'))
+        if 'endkey' in options:
+            end = bisect_left(entries, upper('endkey') if inclusive_end else lower('endkey'))
+    return start, max(start, end)
+
+
+def _window(entries, start, end, options):
+    """entries[start:end] in the requested direction after skip and limit, and the offset of the first one"""
+    descending = options.get('descending', False)
+    selected = entries[start:end]
+    if descending:
+        selected.reverse()
+    offset = (len(entries) - end if descending else start) + (options.get('skip') or 0)
+    return _skip_and_limit(selected, options), offset
+
+
+def _skip_and_limit(rows, options):
+    rows = rows[options.get('skip') or 0:]
+    return rows if options.get('limit') is None else rows[:options['limit']]
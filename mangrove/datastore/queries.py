@@ -1,6 +1,6 @@
 
-from mangrove.datastore.database import DatabaseManager
-from mangrove.datastore.entity import Entity
+from mangrove.datastore.database import DatabaseManager, VIEW_BATCH_SIZE
+from mangrove.datastore.entity import Entity, EntityView, project_document
 from mangrove.utils.types import is_string
 
 def get_entity_count_for_type(dbm, entity_type):
@@ -24,8 +24,25 @@ def get_entities_by_type(dbm, entity_type):
     assert isinstance(dbm, DatabaseManager)
     assert is_string(entity_type)
 
-    rows = dbm.view.by_type(key=entity_type, include_docs=True)
-    return [_get_entity_from_json(dbm, row['doc']) for row in rows]
+    return list(iter_entities_by_type(dbm, entity_type))
+
+def iter_entities_by_type(dbm, entity_type, batch_size=VIEW_BATCH_SIZE, fields=None, as_view=False):
+    """
+    Yields the entities with this type, reading batch_size per request.
+    With fields, yields dicts of those document paths instead, with
+    as_view read-only EntityViews.
+    """
+    assert isinstance(dbm, DatabaseManager)
+    assert is_string(entity_type)
+
+    rows = dbm.iter_view('by_type', batch_size=batch_size, key=entity_type, include_docs=True)
+    for row in rows:
+        if fields is not None:
+            yield project_document(row['doc'], fields)
+        elif as_view:
+            yield EntityView(row['doc'])
+        else:
+            yield _get_entity_from_json(dbm, row['doc'])
 
 def _get_entity_from_json(dbm ,doc):
     return Entity.new_from_doc(dbm, Entity.__document_class__.wrap(doc))
@@ -4,4 +4,13 @@ COUCHDB_USERNAME = 'admin'
 COUCHDB_PASSWORD = 'admin'
 COUCHDB_CREDENTIALS = (COUCHDB_USERNAME,COUCHDB_PASSWORD)
 CACHE_SERVERS = ["127.0.0.1"]
-
+# Number of documents each DatabaseManager keeps in its in-process cache, None to disable
+DOCUMENT_CACHE_SIZE = None
+# Most DatabaseManagers get_db_manager keeps, least recently used ones are dropped first; None for no limit
+DB_MANAGER_POOL_SIZE = 1000
+# Seconds after which an unused DatabaseManager is dropped from get_db_manager's registry; None to keep them
+DB_MANAGER_IDLE_TIMEOUT = 60 * 60
+# Entity ids each DatabaseManager from get_db_manager remembers by short code, None to disable
+SHORT_CODE_CACHE_SIZE = None
+# Seconds a remembered short code lookup is trusted, covers writes made by other processes
+SHORT_CODE_CACHE_TTL = 60
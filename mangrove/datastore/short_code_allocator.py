@@ -0,0 +1,66 @@
+""" Hands out short codes for new entities.
+
+Every entity type has a counter document holding the number of the last
+short code given out, e.g. 41 for cli41. Allocating increments it with a
+conditional write, retried on conflict, so two workers never get the same
+number. A block of codes for a bulk import costs the same single write:
+
+    codes = allocate_short_codes(dbm, 'clinic', count=500)
+
+Short codes can also be chosen by hand at registration, so the numbers
+reserved are checked against the existing entities with one multi-key
+query and any that are taken are skipped.
+"""
+
+from couchdb.http import ResourceConflict
+
+from documents import ShortCodeCounterDocument
+from mangrove.datastore.queries import get_entity_count_for_type
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+
+COUNTER_ID_FORMAT = u'short_code_counter_%s'
+MAX_ATTEMPTS = 20
+
+
+def short_code_prefix(entity_type):
+    return entity_type.lower().replace(" ", "")[:3]
+
+
+def next_short_code(dbm, entity_type):
+    return allocate_short_codes(dbm, entity_type)[0]
+
+
+def allocate_short_codes(dbm, entity_type, count=1):
+    """Returns count unused short codes for entity_type, which no other caller will be given"""
+    assert count > 0
+    entity_type = entity_type.lower()
+    codes = []
+    while len(codes) < count:
+        wanted = count - len(codes)
+        first = _reserve(dbm, entity_type, wanted)
+        candidates = [u'%s%d' % (short_code_prefix(entity_type), number) for number in range(first, first + wanted)]
+        taken = _short_codes_in_use(dbm, entity_type, candidates)
+        codes.extend(code for code in candidates if code not in taken)
+    return codes
+
+
+def _reserve(dbm, entity_type, count):
+    """Moves the counter of entity_type on by count and returns the first number reserved"""
+    id = COUNTER_ID_FORMAT % entity_type
+    for attempt in range(MAX_ATTEMPTS):
+        counter = ShortCodeCounterDocument.load(dbm.database, id)
+        if counter is None:
+            counter = ShortCodeCounterDocument(id, entity_type, get_entity_count_for_type(dbm, entity_type))
+        first = counter.last + 1
+        counter.last += count
+        try:
+            counter.store(dbm.database)
+            return first
+        except ResourceConflict:
+            continue
+    raise FailedToSaveDataObject(u"short code counter %s still conflicting after %d attempts" % (id, MAX_ATTEMPTS))
+
+
+def _short_codes_in_use(dbm, entity_type, short_codes):
+    rows = dbm.iter_view('entity_by_short_code', keys=[[[entity_type], code] for code in short_codes])
+    return set(row['key'][1] for row in rows)
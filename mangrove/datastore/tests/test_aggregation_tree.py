@@ -1,10 +1,13 @@
 
 
 import unittest
-from mangrove.datastore.database import get_db_manager
+from mock import patch
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import get_db_manager, DatabaseManager
 from mangrove.datastore.database import _delete_db_and_remove_db_manager as trash_db
+from mangrove.datastore import aggregationtree
 from mangrove.datastore.aggregationtree import AggregationTree as ATree
-from mangrove.errors.MangroveException import  DataObjectNotFound
+from mangrove.errors.MangroveException import  DataObjectNotFound, FailedToSaveDataObject
 
 
 class TestAggregationTrees(unittest.TestCase):
@@ -196,3 +199,137 @@ class TestAggregationTrees(unittest.TestCase):
         self.assertEqual(t2.ancestors_of('c'), ['a', 'b'])
         with self.assertRaises(ValueError):
             t2.ancestors_of('not-in-tree')
+
+
+class TestAggregationTreeIndex(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://tree-index-test/', 'mangrove-test')
+        self.tree = ATree(self.dbm, 'index_test')
+        self.tree.add_root_path(['India', 'MH', 'Pune'])
+        self.tree.add_path(['India', 'KA'])
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://tree-index-test/')['mangrove-test']
+
+    def test_should_answer_path_queries_from_one_walk(self):
+        with patch.object(aggregationtree, '_TreeIndex', wraps=aggregationtree._TreeIndex) as build:
+            self.assertEqual(sorted([['India'], ['India', 'MH'], ['India', 'MH', 'Pune'], ['India', 'KA']]),
+                             sorted(self.tree.get_paths()))
+            self.assertEqual(sorted([['India', 'MH', 'Pune'], ['India', 'KA']]), sorted(self.tree.get_leaf_paths()))
+            self.assertEqual(['India', 'MH'], self.tree.ancestors_of('Pune'))
+            self.assertEqual(['India', 'MH', 'Pune'], self.tree.path_to('Pune'))
+            self.assertEqual((0, 2), (self.tree.depth_of(ATree.root_id), self.tree.depth_of('MH')))
+            self.assertEqual('MH', self.tree.parent_of('Pune'))
+            self.assertEqual(1, build.call_count)
+
+    def test_should_rebuild_index_after_changes(self):
+        self.tree.get_paths()
+        self.tree.add_child('KA', 'Mysore')
+        self.assertEqual(['India', 'KA'], self.tree.ancestors_of('Mysore'))
+
+        self.tree.remove_node('Pune')
+        self.assertEqual(sorted([['India', 'MH'], ['India', 'KA', 'Mysore']]), sorted(self.tree.get_leaf_paths()))
+        self.assertRaises(ValueError, self.tree.depth_of, 'Pune')
+
+        self.tree.save()
+        loaded = self.dbm.get('index_test', ATree)
+        self.assertEqual(sorted(self.tree.get_paths()), sorted(loaded.get_paths()))
+
+    def test_should_copy_cached_paths(self):
+        self.tree.get_paths()[0].append('x')
+        self.tree.ancestors_of('Pune').append('x')
+
+        self.assertEqual(['India', 'MH'], self.tree.ancestors_of('Pune'))
+        self.assertNotIn('x', sum(self.tree.get_paths(), []))
+
+
+class TestAggregationTreePersistence(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://tree-save-test/', 'mangrove-test')
+        tree = ATree(self.dbm, 'save_test')
+        tree.add_root_path(['India', 'MH', 'Pune'])
+        tree.add_root_path(['India', 'KA'])
+        tree.save()
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://tree-save-test/')['mangrove-test']
+
+    def _saved_paths(self):
+        return sorted(self.dbm.get('save_test', ATree).get_paths())
+
+    def test_should_rebuild_only_changed_branches(self):
+        tree = self.dbm.get('save_test', ATree)
+        mh = tree._doc.root['_children']['India']['_children']['MH']
+
+        tree.add_path(['KA', ('Mysore', {'size': 3})])
+        tree.set_data_for('India', {'code': 'IN'})
+        with patch.object(tree, '_branch_dict', wraps=tree._branch_dict) as build:
+            tree.save()
+            build.assert_called_once_with('Mysore')
+
+        india = tree._doc.root['_children']['India']
+        self.assertIs(mh, india['_children']['MH'])
+        self.assertEqual('IN', india['code'])
+        self.assertEqual({'_children': {'Mysore': {'size': 3}}}, india['_children']['KA'])
+        self.assertIn(['India', 'KA', 'Mysore'], self._saved_paths())
+
+    def test_should_drop_removed_branches(self):
+        tree = self.dbm.get('save_test', ATree)
+        tree.remove_node('MH')
+        tree.save()
+
+        self.assertEqual([['India'], ['India', 'KA']], self._saved_paths())
+
+    def test_should_rebuild_whole_document_after_direct_graph_changes(self):
+        tree = self.dbm.get('save_test', ATree)
+        tree.graph.add_edge('KA', 'Mysore')
+        tree.save()
+        self.assertIn(['India', 'KA', 'Mysore'], self._saved_paths())
+
+        tree.graph.remove_edge('KA', 'Mysore')
+        tree.graph.add_edge('MH', 'Mysore')
+        tree.save()
+        self.assertIn(['India', 'MH', 'Mysore'], self._saved_paths())
+        self.assertNotIn(['India', 'KA', 'Mysore'], self._saved_paths())
+
+    def test_should_merge_changes_of_concurrent_writers(self):
+        first, second = self.dbm.get('save_test', ATree), self.dbm.get('save_test', ATree)
+        first.add_root_path(['US', 'Ohio'])
+        second.add_path(['KA', 'Mysore'])
+        second.remove_node('Pune')
+        first.remove_node('Pune')
+
+        first.save()
+        second.save()
+
+        self.assertEqual(sorted([['India'], ['India', 'MH'], ['India', 'KA'], ['India', 'KA', 'Mysore'], ['US'],
+                                 ['US', 'Ohio']]), self._saved_paths())
+        self.assertEqual(sorted(second.get_paths()), self._saved_paths())
+
+    def test_should_merge_data_changed_through_get_data_for(self):
+        first, second = self.dbm.get('save_test', ATree), self.dbm.get('save_test', ATree)
+        first.add_root_path(['US'])
+        first.save()
+        second.get_data_for('MH')['pop'] = 5
+        second.add_path(['KA', 'Mysore'])
+
+        second.save()
+
+        saved = self.dbm.get('save_test', ATree)
+        self.assertEqual({'pop': 5}, saved.get_data_for('MH'))
+        self.assertIn(['US'], saved.get_paths())
+
+    def test_should_not_retry_untracked_changes(self):
+        first, second = self.dbm.get('save_test', ATree), self.dbm.get('save_test', ATree)
+        first.add_root_path(['US'])
+        first.save()
+        second.graph.add_edge(ATree.root_id, 'UK')
+
+        self.assertRaises(FailedToSaveDataObject, second.save)
+
+    def test_should_share_one_lock_per_tree(self):
+        self.assertIs(aggregationtree._tree_lock(self.dbm, 'save_test'),
+                      aggregationtree._tree_lock(DatabaseManager(None, 'memory://tree-save-test/', 'mangrove-test'),
+                                                 'save_test'))
+        self.assertIsNot(aggregationtree._tree_lock(self.dbm, 'save_test'),
+                         aggregationtree._tree_lock(self.dbm, 'other'))
@@ -0,0 +1,112 @@
+import json
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+from mangrove.datastore.async_database import AsyncDatabaseManager, gather
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.documents import DocumentBase
+from mangrove.datastore.entity import Entity
+
+
+class StandInCouchHandler(BaseHTTPRequestHandler):
+    """Answers just enough of the CouchDB API for DatabaseManager, slowly, counting concurrent requests."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, body):
+        self.server.enter()
+        try:
+            time.sleep(0.1)
+            content = json.dumps(body)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        finally:
+            self.server.leave()
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers.getheader('Content-Length'))))
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        view_name = path.rsplit('/', 1)[-1]
+        self._reply({'total_rows': 1, 'offset': 0, 'rows': [{'id': 'e1', 'key': view_name, 'value': 1}]})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self._body()
+        if path.endswith('_all_docs'):
+            rows = [{'id': key, 'key': key, 'value': {'rev': '1-a'},
+                     'doc': {'_id': key, '_rev': '1-a', 'document_type': 'Entity',
+                             'aggregation_paths': {'_type': ['clinic']}}} for key in body['keys']]
+            self._reply({'total_rows': len(rows), 'offset': 0, 'rows': rows})
+        elif path.endswith('_bulk_docs'):
+            self._reply([{'id': doc['_id'], 'rev': '1-a'} for doc in body['docs']])
+
+
+class StandInCouchServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInCouchHandler)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def enter(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class TestAsyncDatabaseManager(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInCouchServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        url = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+        self.dbm = DatabaseManager(None, url, 'async-test')
+        self.async_dbm = AsyncDatabaseManager(self.dbm, workers=4)
+
+    def tearDown(self):
+        self.async_dbm.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_should_run_independent_lookups_concurrently(self):
+        pending = [self.async_dbm.get('e1', Entity),
+                   self.async_dbm.get_many(['e2', 'e3'], Entity),
+                   self.async_dbm.load_all_rows_in_view('by_short_codes', key=[['reporter'], 'rep1']),
+                   self.async_dbm.load_view_results('questionnaire', key='cli001')]
+
+        entity, entities, rows, results = gather(pending, timeout=10)
+
+        self.assertEqual('e1', entity.id)
+        self.assertEqual(['e2', 'e3'], [e.id for e in entities])
+        self.assertEqual('by_short_codes', rows[0]['key'])
+        self.assertEqual('questionnaire', results.rows[0]['key'])
+        self.assertTrue(self.server.max_in_flight > 1)
+
+    def test_should_save_documents_on_worker(self):
+        document = DocumentBase(id='d1', document_type='Test')
+
+        results = self.async_dbm._save_documents([document]).get(10)
+
+        self.assertEqual([(True, 'd1', '1-a')], results)
+        self.assertEqual('1-a', document.rev)
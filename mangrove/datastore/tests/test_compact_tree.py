@@ -0,0 +1,97 @@
+import unittest
+from mangrove.datastore import memory_backend
+from mangrove.datastore.aggregationtree import AggregationTree, CompactAggregationTree
+from mangrove.datastore.compact_tree import CompactTree
+from mangrove.datastore.database import DatabaseManager
+
+
+class TestCompactTree(unittest.TestCase):
+    def setUp(self):
+        self.tree = CompactTree('root')
+        for parent, child in [('root', 'India'), ('India', 'MH'), ('MH', 'Pune'), ('India', 'KA'), ('root', 'US')]:
+            self.tree.add_child(parent, child)
+
+    def test_should_test_subtrees_with_euler_tour(self):
+        ids = self.tree.ids
+        self.assertTrue(self.tree.is_under(ids['Pune'], ids['India']))
+        self.assertTrue(self.tree.is_under(ids['Pune'], ids['Pune']))
+        self.assertFalse(self.tree.is_under(ids['Pune'], ids['KA']))
+        self.assertFalse(self.tree.is_under(ids['India'], ids['Pune']))
+        self.assertEqual([0, 1, 3], [self.tree.depth(ids[n]) for n in ('root', 'US', 'Pune')])
+
+    def test_should_remove_subtrees(self):
+        self.tree.remove('MH')
+
+        self.assertNotIn('Pune', self.tree)
+        self.assertEqual(4, len(self.tree))
+        self.assertEqual(['KA'], [self.tree.names[id] for id in self.tree.children(self.tree.ids['India'])])
+        self.tree.add_child('KA', 'Pune')
+        self.assertTrue(self.tree.is_under(self.tree.ids['Pune'], self.tree.ids['KA']))
+        self.assertRaises(ValueError, self.tree.remove, 'root')
+
+    def test_should_keep_one_parent_per_node(self):
+        self.assertRaises(ValueError, self.tree.add_child, 'US', 'Pune')
+        self.assertRaises(ValueError, self.tree.add_child, 'nowhere', 'x')
+
+    def test_should_round_trip_document_root(self):
+        root = {'_children': {'India': {'code': 'IN', '_children': {'MH': {}}}, 'US': {}}}
+        self.assertEqual(root, CompactTree.from_dict('root', root).to_dict())
+        self.assertRaises(ValueError, CompactTree.from_dict, 'root',
+                          {'_children': {'a': {'_children': {'b': {}}}, 'b': {}}})
+
+
+class TestCompactAggregationTree(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://compact-tree-test/', 'mangrove-test')
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://compact-tree-test/')['mangrove-test']
+
+    def _build(self, tree_class, id):
+        tree = tree_class(self.dbm, id)
+        tree.add_root_path(['India', ('MH', {'code': 'MH'}), 'Pune'])
+        tree.add_path(['India', 'KA'])
+        tree.add_child('KA', 'Mysore', {'size': 3})
+        tree.add_root_path(['US'])
+        tree.remove_node('US')
+        return tree
+
+    def test_should_behave_like_networkx_tree(self):
+        graph, compact = self._build(AggregationTree, 'graph'), self._build(CompactAggregationTree, 'compact')
+
+        self.assertEqual(sorted(graph.get_paths()), sorted(compact.get_paths()))
+        self.assertEqual(sorted(graph.get_leaf_paths()), sorted(compact.get_leaf_paths()))
+        for node in ('India', 'MH', 'Pune', 'Mysore'):
+            self.assertEqual(graph.parent_of(node), compact.parent_of(node))
+            self.assertEqual(graph.ancestors_of(node), compact.ancestors_of(node))
+            self.assertEqual(graph.path_to(node), compact.path_to(node))
+            self.assertEqual(graph.depth_of(node), compact.depth_of(node))
+            self.assertEqual(sorted(graph.children_of(node)), sorted(compact.children_of(node)))
+            self.assertEqual(graph.get_data_for(node), compact.get_data_for(node))
+            self.assertEqual(graph.is_under(node, 'MH'), compact.is_under(node, 'MH'))
+        self.assertIsNone(compact.parent_of(AggregationTree.root_id))
+        self.assertRaises(ValueError, compact.children_of, 'US')
+
+    def test_should_save_same_document_format(self):
+        self._build(AggregationTree, 'graph').save()
+        self._build(CompactAggregationTree, 'compact').save()
+
+        self.assertEqual(self.dbm.database['graph']['root'], self.dbm.database['compact']['root'])
+        loaded = CompactAggregationTree.get(self.dbm, 'graph')
+        self.assertEqual(['India', 'KA', 'Mysore'], loaded.path_to('Mysore'))
+        self.assertEqual({'size': 3}, loaded.get_data_for('Mysore'))
+        self.assertEqual(sorted(AggregationTree.get(self.dbm, 'compact').get_paths()), sorted(loaded.get_paths()))
+
+    def test_should_merge_changes_of_concurrent_writers(self):
+        self._build(CompactAggregationTree, 'compact').save()
+        first, second = CompactAggregationTree.get(self.dbm, 'compact'), CompactAggregationTree.get(self.dbm, 'compact')
+        first.add_child('MH', 'Nagpur')
+        second.add_root_path(['US'])
+        second.get_data_for('MH')['pop'] = 5
+        first.save()
+        second.save()
+
+        saved = CompactAggregationTree.get(self.dbm, 'compact')
+        self.assertEqual(['India', 'MH', 'Nagpur'], saved.path_to('Nagpur'))
+        self.assertEqual(5, saved.get_data_for('MH')['pop'])
+        self.assertEqual(['US'], second.path_to('US'))
@@ -0,0 +1,237 @@
+import unittest
+from mock import Mock, patch
+from mangrove.datastore import database
+from mangrove.datastore.database import DatabaseManager, get_db_manager, db_manager_stats, evict_idle_db_managers, \
+    remove_db_manager
+from mangrove.datastore.documents import DocumentBase
+from mangrove.datastore.instrumentation import ViewInstrumentation
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+
+
+def _dbm():
+    with patch('couchdb.client.Server'):
+        return DatabaseManager(None, 'http://localhost:5984/', 'unit-test')
+
+
+class FakeView(object):
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda r: (r['key'], r.get('id')))
+        self.requests = []
+
+    def __call__(self, view_name, **params):
+        self.requests.append(params)
+        if 'keys' in params:
+            return [r for r in self.rows if r['key'] in params['keys']]
+        start = (params.get('startkey'), params.get('startkey_docid', ''))
+        rows = [r for r in self.rows if (r['key'], r.get('id')) >= start]
+        if 'endkey' in params:
+            rows = [r for r in rows if r['key'] <= params['endkey']]
+        return rows[:params['limit']] if 'limit' in params else rows
+
+
+class TestIterView(unittest.TestCase):
+    def setUp(self):
+        self.dbm = _dbm()
+        rows = [{'id': 'doc%02d' % i, 'key': [i // 3], 'value': i} for i in range(10)]
+        self.view = FakeView(rows)
+        self.dbm.load_all_rows_in_view = self.view
+
+    def test_should_yield_all_rows_in_order_across_pages(self):
+        values = [row['value'] for row in self.dbm.iter_view('v', batch_size=2, startkey=[0])]
+
+        self.assertEqual(range(10), values)
+        self.assertEqual(5, len(self.view.requests))
+
+    def test_should_page_with_startkey_and_docid_instead_of_skip(self):
+        list(self.dbm.iter_view('v', batch_size=4, startkey=[0]))
+
+        second_request = self.view.requests[1]
+        self.assertEqual([1], second_request['startkey'])
+        self.assertEqual('doc04', second_request['startkey_docid'])
+        self.assertEqual(5, second_request['limit'])
+        self.assertNotIn('skip', second_request)
+
+    def test_should_respect_limit(self):
+        values = [row['value'] for row in self.dbm.iter_view('v', batch_size=4, startkey=[0], limit=6)]
+
+        self.assertEqual(range(6), values)
+
+    def test_should_turn_key_into_key_range(self):
+        values = [row['value'] for row in self.dbm.iter_view('v', batch_size=1, key=[1])]
+
+        self.assertEqual([3, 4, 5], values)
+
+    def test_should_split_keys_into_batches(self):
+        values = [row['value'] for row in self.dbm.iter_view('v', batch_size=2, keys=[[0], [2], [3]])]
+
+        self.assertEqual([0, 1, 2, 6, 7, 8, 9], values)
+        self.assertEqual([[[0], [2]], [[3]]], [r['keys'] for r in self.view.requests])
+
+    def test_should_fetch_lazily(self):
+        rows = self.dbm.iter_view('v', batch_size=2, startkey=[0])
+        self.assertEqual(0, len(self.view.requests))
+        next(rows)
+        self.assertEqual(1, len(self.view.requests))
+
+
+class TestViewInstrumentationWiring(unittest.TestCase):
+    def setUp(self):
+        self.dbm = _dbm()
+        self.results = Mock()
+        self.results.rows = [{'key': 1}]
+        self.dbm.database.view.return_value = self.results
+
+    def test_should_not_touch_results_without_instrumentation(self):
+        results = Mock()
+        self.dbm.database.view.return_value = results
+
+        self.assertIs(results, self.dbm.load_view_results('by_short_codes', key=1))
+        self.assertEqual([], results.method_calls)
+
+    def test_should_record_queries_through_view_and_load_view_results(self):
+        instrumentation = ViewInstrumentation()
+        self.dbm.instrumentation = instrumentation
+
+        self.dbm.load_all_rows_in_view('by_short_codes')
+        self.dbm.view.questionnaire(key='cli001')
+
+        self.assertEqual(1, instrumentation.stats_for('by_short_codes').count)
+        self.assertEqual(1, instrumentation.stats_for('questionnaire').rows)
+        self.dbm.database.view.assert_called_with('formmodel_views/questionnaire', key='cli001')
+
+
+class TestSaveBatch(unittest.TestCase):
+    def setUp(self):
+        self.dbm = _dbm()
+        self.dbm.database.update.side_effect = lambda docs: [(True, d['_id'], '1-%s' % d['_id']) for d in docs]
+
+    def test_should_write_all_documents_saved_in_batch_with_one_request(self):
+        first, second = DocumentBase(id='a'), DocumentBase(id='b')
+        with self.dbm.batch():
+            self.assertEqual('a', self.dbm._save_document(first, process_post_update=False))
+            self.dbm._save_document(second, process_post_update=False)
+            self.assertFalse(self.dbm.database.update.called)
+
+        self.assertEqual(1, self.dbm.database.update.call_count)
+        self.assertEqual('1-a', first.rev)
+        self.assertEqual('1-b', second.rev)
+
+    def test_should_run_post_update_only_after_flush(self):
+        document = Mock(spec=DocumentBase)
+        document.id = 'a'
+        document._data = {'_id': 'a'}
+        self.dbm.database.update.side_effect = lambda docs: [(True, 'a', '1-a')]
+
+        with self.dbm.batch():
+            self.dbm._save_document(document, prev_doc='old')
+            self.assertFalse(document.post_update.called)
+
+        document.post_update.assert_called_once_with(self.dbm, 'old')
+
+    def test_should_write_document_saved_twice_once(self):
+        document = DocumentBase(id='a')
+        with self.dbm.batch():
+            self.dbm._save_document(document, process_post_update=False)
+            self.dbm._save_document(document, process_post_update=False)
+
+        self.assertEqual(1, len(self.dbm.database.update.call_args[0][0]))
+
+    def test_should_report_conflicts_per_document(self):
+        conflict = Exception('conflict')
+        self.dbm.database.update.side_effect = lambda docs: [(True, 'a', '1-a'), (False, 'b', conflict)]
+
+        with self.assertRaises(FailedToSaveDataObject):
+            with self.dbm.batch() as batch:
+                self.dbm._save_document(DocumentBase(id='a'), process_post_update=False)
+                self.dbm._save_document(DocumentBase(id='b'), process_post_update=False)
+
+        self.assertEqual(['a'], batch.saved)
+        self.assertEqual([('b', conflict)], batch.conflicts)
+
+    def test_should_drop_queued_documents_when_block_raises(self):
+        with self.assertRaises(ValueError):
+            with self.dbm.batch():
+                self.dbm._save_document(DocumentBase(id='a'), process_post_update=False)
+                raise ValueError()
+
+        self.assertFalse(self.dbm.database.update.called)
+        self.assertIsNone(self.dbm.current_batch())
+
+    def test_should_flush_every_max_size_documents(self):
+        with self.dbm.batch(max_size=2):
+            for id in 'abcde':
+                self.dbm._save_document(DocumentBase(id=id), process_post_update=False)
+
+        self.assertEqual(3, self.dbm.database.update.call_count)
+
+    def test_should_join_enclosing_batch(self):
+        with self.dbm.batch() as outer:
+            with self.dbm.batch() as inner:
+                self.dbm._save_document(DocumentBase(id='a'), process_post_update=False)
+            self.assertIs(outer, inner)
+            self.assertFalse(self.dbm.database.update.called)
+
+        self.assertEqual(1, self.dbm.database.update.call_count)
+
+
+class TestDatabaseManagerRegistry(unittest.TestCase):
+    server = 'memory://registry-test/'
+
+    def setUp(self):
+        self.patches = [patch.dict(database._dbms, clear=True), patch.dict(database._dbms_last_used, clear=True),
+                        patch.object(database.settings, 'DB_MANAGER_POOL_SIZE', 2),
+                        patch.object(database.settings, 'DB_MANAGER_IDLE_TIMEOUT', 60)]
+        for p in self.patches:
+            p.start()
+        self.now = 1000
+        self.patches.append(patch('mangrove.datastore.database.time', lambda: self.now))
+        self.patches[-1].start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_should_reuse_manager_for_same_database(self):
+        dbm = get_db_manager(self.server, 'org1')
+
+        self.assertIs(dbm, get_db_manager(self.server, 'org1'))
+        self.assertEqual(1, db_manager_stats()['live'])
+
+    def test_should_evict_least_recently_used_manager_when_full(self):
+        first = get_db_manager(self.server, 'org1')
+        self.now += 1
+        second = get_db_manager(self.server, 'org2')
+        self.now += 1
+        get_db_manager(self.server, 'org1')
+        self.now += 1
+        get_db_manager(self.server, 'org3')
+
+        self.assertIs(first, get_db_manager(self.server, 'org1'))
+        self.assertIsNot(second, get_db_manager(self.server, 'org2'))
+        self.assertEqual(2, db_manager_stats()['live'])
+
+    def test_should_evict_idle_managers(self):
+        get_db_manager(self.server, 'org1')
+        self.now += 30
+        get_db_manager(self.server, 'org2')
+        self.now += 40
+
+        self.assertEqual(1, evict_idle_db_managers())
+        self.assertEqual([(self.server, 'org2')], database._dbms.keys())
+
+    def test_should_tolerate_removing_evicted_manager(self):
+        dbm = get_db_manager(self.server, 'org1')
+        self.now += 61
+        evict_idle_db_managers()
+
+        remove_db_manager(dbm)
+        self.assertEqual(0, db_manager_stats()['live'])
+
+    def test_should_share_one_session_per_couchdb_server(self):
+        with patch.dict(database._sessions, clear=True):
+            first = database._connect('http://couch:5984/')
+            second = database._connect('http://couch:5984/')
+
+            self.assertIsNot(first, second)
+            self.assertIs(first.resource.session, second.resource.session)
+            self.assertEqual(1, len(database._sessions))
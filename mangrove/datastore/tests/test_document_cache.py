@@ -0,0 +1,150 @@
+import unittest
+from mock import Mock, patch
+from mangrove.datastore.database import DatabaseManager, DataObject
+from mangrove.datastore.document_cache import DocumentCache, ShortCodeCache
+from mangrove.datastore.documents import DocumentBase
+
+
+class TestDocumentCache(unittest.TestCase):
+    def test_should_return_copy_of_cached_document(self):
+        cache = DocumentCache(10)
+        cache.put({'_id': 'a', '_rev': '1-x', 'name': 'clinic'})
+
+        doc = cache.get('a')
+        doc['name'] = 'changed'
+
+        self.assertEqual('clinic', cache.get('a')['name'])
+        self.assertEqual(2, cache.hits)
+
+    def test_should_count_miss_for_unknown_id_or_other_revision(self):
+        cache = DocumentCache(10)
+        cache.put({'_id': 'a', '_rev': '1-x'})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNone(cache.get('a', rev='2-y'))
+        self.assertEqual(2, cache.misses)
+        self.assertNotIn('a', cache)
+
+    def test_should_evict_least_recently_used_document(self):
+        cache = DocumentCache(2)
+        cache.put({'_id': 'a', '_rev': '1'})
+        cache.put({'_id': 'b', '_rev': '1'})
+        cache.get('a')
+        cache.put({'_id': 'c', '_rev': '1'})
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(1, cache.evictions)
+
+    def test_should_only_discard_stale_revision(self):
+        cache = DocumentCache(10)
+        cache.put({'_id': 'a', '_rev': '2-x'})
+
+        cache.discard('a', rev='2-x')
+        self.assertIn('a', cache)
+        cache.discard('a', rev='3-y')
+        self.assertNotIn('a', cache)
+
+    def test_should_ignore_documents_without_revision(self):
+        cache = DocumentCache(10)
+        cache.put({'_id': 'a'})
+        self.assertEqual(0, len(cache))
+
+
+class CachedObject(DataObject):
+    __document_class__ = DocumentBase
+
+
+class TestDatabaseManagerDocumentCache(unittest.TestCase):
+    def setUp(self):
+        with patch('couchdb.client.Server'):
+            self.dbm = DatabaseManager(None, 'http://localhost:5984/', 'cache-test', cache_size=10)
+        self.database = self.dbm.database
+
+    def _all_docs_rows(self, *docs):
+        return [{'id': d['_id'], 'key': d['_id'], 'value': {'rev': d['_rev']}, 'doc': d} for d in docs]
+
+    def test_should_serve_repeated_get_from_cache(self):
+        self.database.view.return_value = self._all_docs_rows({'_id': 'a', '_rev': '1-x', 'document_type': 'T'})
+
+        self.dbm.get('a', CachedObject)
+        obj = self.dbm.get('a', CachedObject)
+
+        self.assertEqual('a', obj.id)
+        self.assertEqual(1, self.database.view.call_count)
+        self.assertEqual(1, self.dbm.document_cache.hits)
+
+    def test_should_only_fetch_missing_documents_in_get_many(self):
+        self.dbm.document_cache.put({'_id': 'a', '_rev': '1-x'})
+        self.database.view.return_value = self._all_docs_rows({'_id': 'b', '_rev': '1-y'})
+
+        objs = self.dbm.get_many(['a', 'b'], CachedObject)
+
+        self.assertEqual(['a', 'b'], [o.id for o in objs])
+        self.database.view.assert_called_once_with('_all_docs', keys=['b'], include_docs=True)
+
+    def test_should_cache_saved_document_with_new_revision(self):
+        document = DocumentBase(id='a', document_type='T')
+        self.database.update.return_value = [(True, 'a', '1-x')]
+
+        self.dbm._save_document(document, process_post_update=False)
+
+        self.assertEqual('1-x', self.dbm._load_document('a')['_rev'])
+        self.assertFalse(self.database.get.called)
+
+    def test_should_drop_document_from_cache_on_conflict(self):
+        self.dbm.document_cache.put({'_id': 'a', '_rev': '1-x'})
+        self.database.update.return_value = [(False, 'a', Exception('conflict'))]
+
+        self.dbm._save_documents([DocumentBase(id='a')])
+
+        self.assertNotIn('a', self.dbm.document_cache)
+
+    def test_should_drop_document_from_cache_on_delete(self):
+        self.dbm.document_cache.put({'_id': 'a', '_rev': '1-x'})
+        obj = CachedObject.new_from_doc(self.dbm, DocumentBase.wrap({'_id': 'a', '_rev': '1-x'}))
+
+        self.dbm.delete(obj)
+
+        self.assertNotIn('a', self.dbm.document_cache)
+
+    def test_should_not_cache_without_cache_size(self):
+        with patch('couchdb.client.Server'):
+            dbm = DatabaseManager(None, 'http://localhost:5984/', 'cache-test')
+        self.assertIsNone(dbm.document_cache)
+        dbm._cache_document({'_id': 'a', '_rev': '1-x'})
+
+
+class TestShortCodeCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ShortCodeCache(max_size=2, ttl=60)
+
+    def test_should_remember_entity_ids(self):
+        self.cache.put(['clinic'], 'cli1', 'e1')
+
+        self.assertEqual('e1', self.cache.get(['clinic'], 'cli1'))
+        self.assertIsNone(self.cache.get(['clinic'], 'cli2'))
+        self.assertEqual(1, self.cache.stats()['hits'])
+
+    def test_should_discard_entry_of_written_entity(self):
+        self.cache.put(['clinic'], 'cli1', 'e1')
+
+        self.cache.discard('e1')
+
+        self.assertIsNone(self.cache.get(['clinic'], 'cli1'))
+
+    def test_should_expire_entries(self):
+        with patch('mangrove.datastore.document_cache.time', return_value=1000):
+            self.cache.put(['clinic'], 'cli1', 'e1')
+        with patch('mangrove.datastore.document_cache.time', return_value=1061):
+            self.assertIsNone(self.cache.get(['clinic'], 'cli1'))
+
+    def test_should_evict_least_recently_used(self):
+        self.cache.put(['clinic'], 'cli1', 'e1')
+        self.cache.put(['clinic'], 'cli2', 'e2')
+        self.cache.get(['clinic'], 'cli1')
+        self.cache.put(['clinic'], 'cli3', 'e3')
+
+        self.assertEqual('e1', self.cache.get(['clinic'], 'cli1'))
+        self.assertIsNone(self.cache.get(['clinic'], 'cli2'))
+        self.assertEqual(1, self.cache.evictions)
@@ -4,11 +4,14 @@ import unittest
 from mock import Mock, patch
 from pytz import UTC
 from mangrove.datastore.entity import Entity, get_by_short_code, create_entity, get_all_entities, DataRecord, void_entity, get_by_short_code_include_voided
+from mangrove.datastore.entity import create_entities_bulk, delete_data_record, get_entities_by_value, get_entity_values, \
+    iter_all_entities, iter_by_short_codes, EntityView
 from mangrove.datastore.tests.test_data import TestData
 from mangrove.errors.MangroveException import DataObjectAlreadyExists, EntityTypeDoesNotExistsException, DataObjectNotFound, FailedToSaveDataObject
 from mangrove.utils.test_utils.database_utils import create_dbmanager_for_ut, safe_define_type, ut_reporter_id
-from mangrove.datastore.database import _delete_db_and_remove_db_manager
+from mangrove.datastore.database import _delete_db_and_remove_db_manager, DatabaseManager
 from mangrove.datastore.cache_manager import get_cache_manager
+from mangrove.utils.test_utils.mangrove_test_case import MemoryBackendTestCase
 
 
 class TestEntity(unittest.TestCase):
@@ -388,6 +391,291 @@ class TestEntity(unittest.TestCase):
         self.assertTrue(entity.is_reporter)
 
 
+class TestShortCodeCache(MemoryBackendTestCase):
+    def test_should_resolve_short_codes_once_until_entity_changes(self):
+        dbm = DatabaseManager(None, self.url, 'mangrove-test', short_code_cache_size=10)
+        self.assertRaises(DataObjectNotFound, get_by_short_code, dbm, 'cli1', ['clinic'])
+        clinic = create_entity(dbm, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+
+        with patch.object(dbm.view, '_load_all_rows_in_view', wraps=dbm.view._load_all_rows_in_view) as query:
+            self.assertEqual(clinic.id, get_by_short_code(dbm, 'cli1', ['clinic']).id)
+            self.assertEqual(clinic.id, get_by_short_code(dbm, 'cli1', ['clinic']).id)
+            self.assertEqual(1, query.call_count)
+
+        clinic.add_data([('beds', 10)], submission=dict(form_code='clinic_form'))
+        entity = get_by_short_code(dbm, 'cli1', ['clinic'])
+        entity.add_data([('beds', 12)], submission=dict(form_code='clinic_form'))
+        self.assertEqual(entity._doc.rev, dbm._load_document(clinic.id).rev)
+
+        entity.void()
+        self.assertRaises(DataObjectNotFound, get_by_short_code, dbm, 'cli1', ['clinic'])
+
+    def test_should_verify_cached_short_codes_against_the_entity(self):
+        dbm = DatabaseManager(None, self.url, 'mangrove-test', short_code_cache_size=10)
+        other = DatabaseManager(None, self.url, 'mangrove-test')
+        clinic = create_entity(dbm, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+        get_by_short_code(dbm, 'cli1', ['clinic'])
+
+        get_by_short_code(other, 'cli1', ['clinic']).void()
+
+        self.assertRaises(DataObjectNotFound, get_by_short_code, dbm, 'cli1', ['clinic'])
+
+
+class TestEntityValues(MemoryBackendTestCase):
+    def test_should_aggregate_fields_of_entities_with_one_view_request(self):
+        clinics = [create_entity(self.manager, ['clinic'], location=['India'], short_code='cli%d' % i) for i in range(2)]
+        for i, clinic in enumerate(clinics):
+            clinic.save()
+            for day in range(1, 4):
+                clinic.add_data([('beds', day * (i + 1)), ('director', 'Dr. %d%d' % (i, day))],
+                                event_time=datetime(2012, 1, day, tzinfo=UTC),
+                                submission=dict(form_code='clinic_form'))
+        rules = {'beds': 'sum', 'director': 'latest'}
+
+        with patch.object(self.manager, 'load_all_rows_in_view', wraps=self.manager.load_all_rows_in_view) as query:
+            values = get_entity_values(self.manager, [c.id for c in clinics], rules)
+            self.assertEqual(1, query.call_count)
+            self.assertEqual(4, len(query.call_args[1]['keys']))
+
+        self.assertEqual({'beds': 6, 'director': 'Dr. 03'}, values[clinics[0].id])
+        self.assertEqual({'beds': 12, 'director': 'Dr. 13'}, values[clinics[1].id])
+        self.assertEqual({'beds': 2, 'director': 'Dr. 02'},
+                         clinics[0].values({'beds': 'count', 'director': 'latest'},
+                                           asof=datetime(2012, 1, 2, tzinfo=UTC)))
+        self.assertEqual({'beds': 1, 'director': None}, clinics[0].values({'beds': 'min', 'director': 'max'},
+                                                                           asof=datetime(2012, 1, 2, tzinfo=UTC)))
+        self.assertEqual([clinics[1].id], [e.id for e in get_entities_by_value(self.manager, 'director', 'Dr. 13')])
+
+    def test_should_reject_unknown_aggregate_functions(self):
+        with self.assertRaises(ValueError):
+            get_entity_values(self.manager, ['id'], {'beds': 'median'})
+
+
+class TestEntitiesByValue(MemoryBackendTestCase):
+    def test_should_find_entities_by_latest_value(self):
+        clinics = [create_entity(self.manager, ['clinic'], location=['India'], short_code='cli%d' % i) for i in range(3)]
+        for clinic in clinics:
+            clinic.save()
+            clinic.add_data([('director', 'Dr. A')], event_time=datetime(2012, 1, 1, tzinfo=UTC),
+                            submission=dict(form_code='clinic_form'))
+        clinics[1].add_data([('director', 'Dr. B')], event_time=datetime(2012, 2, 1, tzinfo=UTC),
+                            submission=dict(form_code='clinic_form'))
+        clinics[2].invalidate()
+
+        self.assertEqual([clinics[0].id], [e.id for e in get_entities_by_value(self.manager, 'director', 'Dr. A')])
+        self.assertEqual([clinics[1].id], [e.id for e in get_entities_by_value(self.manager, 'director', 'Dr. B')])
+        january = datetime(2012, 1, 15, tzinfo=UTC)
+        self.assertEqual(sorted([clinics[0].id, clinics[1].id]),
+                         sorted(e.id for e in get_entities_by_value(self.manager, 'director', 'Dr. A', as_of=january)))
+        self.assertEqual([], get_entities_by_value(self.manager, 'director', 'Dr. B', as_of=january))
+
+    def test_should_check_all_candidates_as_of_a_date_with_one_view_request(self):
+        clinics = [create_entity(self.manager, ['clinic'], location=['India'], short_code='cli%d' % i) for i in range(4)]
+        for clinic in clinics:
+            clinic.save()
+            clinic.add_data([('director', 'Dr. A')], event_time=datetime(2012, 1, 1, tzinfo=UTC),
+                            submission=dict(form_code='clinic_form'))
+        clinics[3].add_data([('director', 'Dr. B')], event_time=datetime(2012, 1, 10, tzinfo=UTC),
+                            submission=dict(form_code='clinic_form'))
+
+        with patch.object(self.manager, 'load_all_rows_in_view', wraps=self.manager.load_all_rows_in_view) as query:
+            entities = get_entities_by_value(self.manager, 'director', 'Dr. A', as_of=datetime(2012, 1, 15, tzinfo=UTC))
+            self.assertEqual(['by_label_value_time', 'entity_field_values'],
+                             [call[0][0] for call in query.call_args_list])
+
+        self.assertEqual(sorted(c.id for c in clinics[:3]), sorted(e.id for e in entities))
+
+
+class TestCreateEntitiesBulk(MemoryBackendTestCase):
+    def test_should_report_row_whose_entity_conflicts_and_void_its_data_record(self):
+        rows = [dict(entity_type=['clinic'], short_code='cli%d' % i, location=['India'],
+                     data=[('beds', i)], submission=dict(form_code='reg'))
+                for i in range(3)]
+        database = self.manager.database
+        update = database.update
+
+        def update_after_concurrent_write(documents):
+            for document in documents:
+                if getattr(document, 'short_code', None) == 'cli1':
+                    database[document.id] = {'document_type': 'Entity'}
+            return update(documents)
+
+        with patch.object(database, 'update', side_effect=update_after_concurrent_write):
+            results = create_entities_bulk(self.manager, rows)
+
+        self.assertEqual([True, False, True], [success for success, _ in results])
+        self.assertIsInstance(results[1][1], FailedToSaveDataObject)
+        records = [row['doc'] for row in database.view('_all_docs', include_docs=True)
+                   if row['doc'].get('document_type') == 'DataRecord']
+        self.assertEqual(3, len(records))
+        self.assertEqual([True], [record['void'] for record in records if record['data']['beds']['value'] == 1])
+        self.assertFalse(any(record['void'] for record in records if record['data']['beds']['value'] != 1))
+
+    def test_should_register_entities_in_bulk_and_report_errors_per_row(self):
+        voided = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli0')
+        voided.save()
+        voided.invalidate()
+        rows = [dict(entity_type=['clinic'], short_code='cli%d' % i, location=['India'],
+                     data=[('name', 'Clinic %d' % i), ('beds', i)], submission=dict(form_code='reg'))
+                for i in range(5)]
+        rows.append(dict(entity_type=['clinic'], short_code='CLI1'))
+        rows.append(dict(entity_type=['hospital'], short_code='hos1'))
+        rows.append(dict(entity_type=['clinic']))
+        rows.append(dict(entity_type='clinic', short_code='cli9'))
+
+        with patch.object(self.manager.database, 'update', wraps=self.manager.database.update) as update:
+            results = create_entities_bulk(self.manager, rows, chunk_size=4)
+            self.assertEqual(2, update.call_count)
+
+        self.assertEqual([False, True, True, True, True, False, False, False, False],
+                         [success for success, _ in results])
+        self.assertIsInstance(results[0][1], DataObjectAlreadyExists)
+        self.assertIsInstance(results[5][1], DataObjectAlreadyExists)
+        self.assertEqual('Clinic 1', results[5][1].data[3])
+        self.assertIsInstance(results[6][1], EntityTypeDoesNotExistsException)
+        self.assertIsInstance(results[7][1], ValueError)
+        self.assertIsInstance(results[8][1], ValueError)
+        clinic = get_by_short_code(self.manager, 'cli3', ['clinic'])
+        self.assertEqual({'name': 'Clinic 3', 'beds': 3}, clinic.latest_values())
+        self.assertEqual({'beds': 3}, clinic.values({'beds': 'latest'}))
+
+
+class TestAddData(MemoryBackendTestCase):
+    def test_should_write_entity_and_data_records_in_one_request(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+
+        with patch.object(self.manager.database, 'update', wraps=self.manager.database.update) as update:
+            ids = clinic.add_data([('beds', 10), ('arv', 5)], submission=dict(form_code='f'), multiple_records=True)
+            self.assertEqual(1, update.call_count)
+        self.assertEqual(2, len(ids))
+        self.assertTrue(self.manager.database[clinic.id]['_rev'].startswith('2-'))
+
+    def test_should_void_data_records_when_entity_conflicts(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+        stale = get_by_short_code(self.manager, 'cli1', ['clinic'])
+        clinic.add_data([('beds', 10)], submission=dict(form_code='f'))
+
+        self.assertRaises(FailedToSaveDataObject, stale.add_data, [('beds', 12)], submission=dict(form_code='f'))
+        records = [row['doc'] for row in self.manager.database.view('_all_docs', include_docs=True)
+                   if row['doc'].get('document_type') == 'DataRecord']
+        self.assertEqual({10: False, 12: True}, dict((record['data']['beds']['value'], record['void'])
+                                                     for record in records))
+        self.assertEqual({'beds': 10}, clinic.values({'beds': 'latest'}))
+
+    def test_should_void_data_records_of_batched_entity_that_conflicts(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+        stale = get_by_short_code(self.manager, 'cli1', ['clinic'])
+        clinic.add_data([('beds', 10)], submission=dict(form_code='f'))
+
+        for defer_latest in (True, False):
+            ids = []
+            with self.assertRaises(FailedToSaveDataObject):
+                with self.manager.batch():
+                    ids.append(stale.add_data([('beds', 12)], submission=dict(form_code='f'),
+                                              defer_latest=defer_latest))
+            self.assertTrue(self.manager._load_document(ids[0]).void)
+
+    def test_should_write_deferred_latest_data_once_per_batch(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        clinic.save()
+
+        with self.manager.batch():
+            for beds in range(5):
+                get_by_short_code(self.manager, 'cli1', ['clinic']).add_data(
+                    [('beds', beds), ('day', beds)] if beds < 4 else [('beds', beds)], defer_latest=True)
+
+        doc = self.manager.database[clinic.id]
+        self.assertTrue(doc['_rev'].startswith('2-'))
+        self.assertEqual({'beds': {'value': 4}, 'day': {'value': 3}}, doc['data'])
+
+
+class TestIterEntities(MemoryBackendTestCase):
+    def test_should_stream_entities_in_batches(self):
+        for i in range(5):
+            create_entity(self.manager, ['clinic'], location=['India'], short_code='cli%d' % i).save()
+
+        with patch.object(self.manager, 'load_all_rows_in_view', wraps=self.manager.load_all_rows_in_view) as query:
+            entities = iter_all_entities(self.manager, ['clinic'], batch_size=2)
+            self.assertEqual(0, query.call_count)
+            self.assertEqual('cli0', next(entities).short_code)
+            self.assertEqual(1, query.call_count)
+            self.assertEqual(['cli1', 'cli2', 'cli3', 'cli4'], [e.short_code for e in entities])
+            self.assertEqual(3, query.call_count)
+
+        self.assertEqual([{'short_code': 'cli3', 'data.name.value': None}],
+                         list(iter_by_short_codes(self.manager, ['cli3'], ['clinic'], fields=['short_code', 'data.name.value'])))
+        self.assertEqual(['cli0', 'cli1'], [e.short_code for e in iter_all_entities(self.manager, limit=2, batch_size=1)])
+
+
+class TestEntityView(MemoryBackendTestCase):
+    def test_should_list_read_only_entity_views(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India', 'MP'], short_code='cli1',
+                               geometry={'type': 'point', 'coordinates': [1.0, 2.0]})
+        clinic.add_data([('name', 'Apollo')], submission=dict(form_code='clinic_form'))
+
+        views = list(iter_all_entities(self.manager, ['clinic'], as_view=True))
+        self.assertEqual(1, len(views))
+        view = views[0]
+        self.assertIsInstance(view, EntityView)
+        self.assertEqual((clinic.id, 'cli1', ['clinic'], ['India', 'MP']),
+                         (view.id, view.short_code, view.type_path, view.location_path))
+        self.assertEqual(([1.0, 2.0], 'Apollo', None), (view.geometry['coordinates'], view.value('name'), view.value('beds')))
+        self.assertEqual((u'clinic', u'India.MP', False), (view.type_string, view.location_string, view.is_reporter))
+        self.assertRaises(AttributeError, setattr, view, 'short_code', 'cli2')
+        self.assertFalse(hasattr(view, '__dict__'))
+
+
+class TestVoidAndDeleteData(MemoryBackendTestCase):
+    def test_should_void_entity_data_records_in_chunks(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        ids = clinic.add_data([('beds', i) for i in range(5)], submission=dict(form_code='clinic_form'),
+                              multiple_records=True)
+
+        with patch.object(self.manager.database, 'update', wraps=self.manager.database.update) as update:
+            clinic.invalidate()
+            self.assertEqual(2, update.call_count)
+            self.manager.void_documents(ids, chunk_size=2)
+            self.assertEqual(2 + 3, update.call_count)
+
+        self.assertTrue(all(self.manager.database[id]['void'] for id in ids))
+        self.assertTrue(self.manager.database[clinic.id]['void'])
+
+    def test_should_retry_conflicting_documents_once(self):
+        database = self.manager.database
+        for id in ('a', 'b'):
+            database.save({'_id': id, 'document_type': 'DataRecord'})
+        update = database.update
+
+        def update_after_concurrent_write(docs):
+            if not database['a'].get('touched'):
+                update([dict(database['a'], touched=True)])
+            return update(docs)
+
+        with patch.object(database, 'update', side_effect=update_after_concurrent_write):
+            self.assertEqual([], self.manager.void_documents(['a', 'b', 'missing']))
+
+        self.assertEqual((True, True, True), (database['a']['void'], database['a']['touched'], database['b']['void']))
+
+        with patch.object(database, 'update', side_effect=lambda docs: [(False, d['_id'], None) for d in docs]):
+            self.assertEqual(['a'], self.manager.delete_documents(['a'], raise_on_conflict=False))
+            self.assertRaises(FailedToSaveDataObject, self.manager.delete_documents, ['a'])
+
+    def test_should_delete_data_records_of_a_form_in_one_request(self):
+        clinic = create_entity(self.manager, ['clinic'], location=['India'], short_code='cli1')
+        ids = clinic.add_data([('beds', i) for i in range(3)], submission=dict(form_code='clinic_form'),
+                              multiple_records=True)
+
+        delete_data_record(self.manager, 'clinic_form', 'cli1')
+
+        self.assertEqual([], [id for id in ids if id in self.manager.database])
+        self.assertEqual([], self.manager.delete_documents(ids))
+
+
 def get_entities(dbm, ids):
     return dbm.get_many(ids, Entity)
 
@@ -1,10 +1,13 @@
 
 import unittest
+from mock import patch
+from mangrove.datastore.aggregationtree import AggregationTree
 from mangrove.datastore.database import _delete_db_and_remove_db_manager, get_db_manager
 from mangrove.datastore.entity import Entity
-from mangrove.datastore.entity_type import get_all_entity_types, define_type, delete_type
+from mangrove.datastore.entity_type import get_all_entity_types, define_type, delete_type, entity_type_already_defined
 from mangrove.errors.MangroveException import EntityTypeAlreadyDefined
 from mangrove.utils.test_utils.database_utils import uniq
+from mangrove.utils.test_utils.mangrove_test_case import MemoryBackendTestCase
 
 
 class TestEntityType(unittest.TestCase):
@@ -70,3 +73,16 @@ class TestEntityType(unittest.TestCase):
 
         for e in expected:
             self.assertIn(e, entity_types)
+
+
+class TestEntityTypeRegistry(MemoryBackendTestCase):
+    def test_should_reload_entity_types_only_when_type_tree_changes(self):
+        with patch.object(AggregationTree, 'get', wraps=AggregationTree.get) as load_tree:
+            self.assertTrue(entity_type_already_defined(self.manager, [' Clinic']))
+            self.assertFalse(entity_type_already_defined(self.manager, ['hospital']))
+            self.assertEqual(0, load_tree.call_count)
+
+            define_type(self.manager, ['hospital'])
+            self.assertTrue(entity_type_already_defined(self.manager, ['Hospital']))
+            self.assertEqual([['clinic'], ['hospital']], sorted(get_all_entity_types(self.manager)))
+            self.assertEqual(1, load_tree.call_count)
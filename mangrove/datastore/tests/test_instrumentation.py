@@ -0,0 +1,52 @@
+import unittest
+from mock import Mock
+from mangrove.datastore.instrumentation import ViewInstrumentation, SlowQueryLogger
+
+
+class TestViewInstrumentation(unittest.TestCase):
+    def test_should_keep_latency_histogram_and_row_counts_per_view(self):
+        instrumentation = ViewInstrumentation()
+        instrumentation.record('by_short_codes', 0.002, [{}, {}])
+        instrumentation.record('by_short_codes', 0.3, [{}])
+        instrumentation.record('questionnaire', 0.02, [])
+
+        stats = instrumentation.stats()['by_short_codes']
+        self.assertEqual(2, stats['count'])
+        self.assertEqual(3, stats['rows'])
+        self.assertEqual(0.3, stats['max_time'])
+        histogram = dict(stats['histogram'])
+        self.assertEqual(1, histogram[0.005])
+        self.assertEqual(1, histogram[0.5])
+        self.assertEqual(0, stats['bytes'])
+
+    def test_should_measure_bytes_when_asked(self):
+        instrumentation = ViewInstrumentation(measure_bytes=True)
+        instrumentation.record('v', 0.01, [{'key': 'a', 'value': 1}])
+
+        self.assertTrue(instrumentation.stats_for('v').bytes > 0)
+
+    def test_should_call_hooks_after_every_query(self):
+        instrumentation = ViewInstrumentation()
+        hook = Mock()
+        instrumentation.add_hook(hook)
+
+        instrumentation.record('v', 0.01, [{}])
+
+        hook.assert_called_once_with('v', 0.01, 1, 0)
+
+    def test_should_rank_views_by_total_time(self):
+        instrumentation = ViewInstrumentation()
+        instrumentation.record('fast', 0.01, [])
+        instrumentation.record('slow', 0.5, [])
+        instrumentation.record('fast', 0.01, [])
+
+        self.assertEqual(['slow', 'fast'], instrumentation.slowest())
+
+    def test_should_log_only_slow_queries(self):
+        logger = Mock()
+        hook = SlowQueryLogger(threshold=0.1, logger=logger)
+
+        hook('v', 0.05, 1, 0)
+        self.assertFalse(logger.warning.called)
+        hook('v', 0.2, 1, 0)
+        self.assertTrue(logger.warning.called)
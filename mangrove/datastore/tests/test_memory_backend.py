@@ -0,0 +1,178 @@
+from datetime import datetime
+import unittest
+from couchdb.design import ViewDefinition
+from couchdb.http import ResourceConflict, ResourceNotFound
+import pytz
+from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.entity import create_entity, get_all_entities, get_by_short_code
+from mangrove.datastore.entity_type import define_type
+from mangrove.datastore.memory_backend import InMemoryServer, collation_key, register_view
+
+
+def _map_by_name(doc, emit):
+    if 'name' in doc:
+        emit(doc['name'], doc.get('size'))
+
+
+def _map_by_path(doc, emit):
+    if 'path' in doc:
+        emit(doc['path'], doc['size'])
+
+
+register_view('test_by_name', _map_by_name)
+register_view('test_by_path', _map_by_path)
+
+
+class TestInMemoryDatabase(unittest.TestCase):
+    def setUp(self):
+        self.database = InMemoryServer('memory://unit-test/').create('test')
+
+    def _sync(self, name, reduce=None):
+        ViewDefinition(name, name, 'function(doc) {}', reduce).sync(self.database)
+
+    def test_should_save_and_get_documents(self):
+        doc = {'_id': 'a', 'created': datetime(2012, 1, 1, tzinfo=pytz.UTC)}
+        id, rev = self.database.save(doc)
+
+        self.assertEqual('a', id)
+        self.assertTrue(rev.startswith('1-'))
+        self.assertEqual(rev, doc['_rev'])
+        self.assertEqual(datetime(2012, 1, 1, tzinfo=pytz.UTC), self.database['a']['created'])
+        self.assertIsNone(self.database.get('missing'))
+        self.assertRaises(ResourceNotFound, lambda: self.database['missing'])
+
+    def test_should_detect_conflicts(self):
+        self.database.save({'_id': 'a'})
+        stale = {'_id': 'a'}
+
+        self.assertRaises(ResourceConflict, self.database.save, stale)
+        results = self.database.update([self.database['a'], {'_id': 'a', '_rev': '1-stale'}, {'_id': 'b'}])
+
+        self.assertEqual([True, False, True], [success for success, _, _ in results])
+        self.assertTrue(results[0][2].startswith('2-'))
+        self.assertIsInstance(results[1][2], ResourceConflict)
+
+    def test_should_delete_documents(self):
+        self.database.save({'_id': 'a'})
+        self.database.delete(self.database['a'])
+
+        self.assertNotIn('a', self.database)
+        self.database.save({'_id': 'a'})
+        self.assertTrue(self.database['a']['_rev'].startswith('3-'))
+
+    def test_should_keep_attachments_across_updates(self):
+        doc = {'_id': 'a'}
+        self.database.save(doc)
+        self.database.put_attachment(doc, 'content', 'file.txt')
+        self.database.save(self.database['a'])
+
+        self.assertEqual('content', self.database.get_attachment('a', 'file.txt').read())
+        self.database.delete_attachment(self.database['a'], 'file.txt')
+        self.assertIsNone(self.database.get_attachment('a', 'file.txt'))
+
+    def test_should_list_all_docs(self):
+        for id in ['c', 'a', 'b']:
+            self.database.save({'_id': id})
+        self.database.delete(self.database['b'])
+
+        rows = self.database.view('_all_docs', keys=['a', 'b', 'x'], include_docs=True).rows
+
+        self.assertEqual('a', rows[0].doc['_id'])
+        self.assertTrue(rows[1]['value']['deleted'])
+        self.assertEqual('not_found', rows[2]['error'])
+        self.assertEqual(['c'], [row.id for row in self.database.view('_all_docs', startkey='b')])
+
+    def test_should_query_view_ranges_in_collation_order(self):
+        self._sync('test_by_name')
+        for id, name in [('1', 'b'), ('2', 'B'), ('3', 'a'), ('4', 2), ('5', None), ('6', ['a'])]:
+            self.database.save({'_id': id, 'name': name})
+
+        keys = lambda **options: [row.key for row in self.database.view('test_by_name/test_by_name', **options)]
+
+        self.assertEqual([None, 2, 'a', 'b', 'B', ['a']], keys())
+        self.assertEqual(['a', 'b', 'B'], keys(startkey='a', endkey='B'))
+        self.assertEqual(['a', 'b'], keys(startkey='a', endkey='B', inclusive_end=False))
+        self.assertEqual(['B', 'b'], keys(startkey='B', endkey='b', descending=True))
+        self.assertEqual(['b', ['a']], keys(keys=['b', ['a']]))
+        self.assertEqual(['b'], keys(startkey='a', skip=1, limit=1))
+        self.assertEqual(['a', 'b', 'B'], keys(start_key='a', end_key='B'))
+
+    def test_should_page_on_startkey_docid(self):
+        self._sync('test_by_name')
+        for id in ['x1', 'x2', 'x3']:
+            self.database.save({'_id': id, 'name': 'same'})
+
+        rows = self.database.view('test_by_name/test_by_name', startkey='same', startkey_docid='x2').rows
+
+        self.assertEqual(['x2', 'x3'], [row.id for row in rows])
+        self.assertEqual(1, self.database.view('test_by_name/test_by_name', startkey='same', startkey_docid='x2').offset)
+
+    def test_should_reduce_stats_by_group_level(self):
+        self._sync('test_by_path', '_stats')
+        sizes = [(['a', 'x'], 1), (['a', 'y'], 3), (['b', 'x'], 5)]
+        self.database.update([{'_id': str(i), 'path': path, 'size': size} for i, (path, size) in enumerate(sizes)])
+
+        rows = self.database.view('test_by_path/test_by_path', group_level=1).rows
+        total = self.database.view('test_by_path/test_by_path').rows[0].value
+
+        self.assertEqual([['a'], ['b']], [row.key for row in rows])
+        self.assertEqual({'sum': 4, 'count': 2, 'min': 1, 'max': 3, 'sumsqr': 10}, rows[0].value)
+        self.assertEqual(9, total['sum'])
+        self.assertEqual(3, len(self.database.view('test_by_path/test_by_path', reduce=False).rows))
+
+    def test_should_rereduce_large_groups(self):
+        self._sync('test_by_path', '_count')
+        self.database.update([{'_id': str(i), 'path': ['a'], 'size': i} for i in range(200)])
+
+        self.assertEqual(200, self.database.view('test_by_path/test_by_path', group=True).rows[0].value)
+
+    def test_should_update_built_index_on_write(self):
+        self._sync('test_by_name')
+        self.database.save({'_id': 'a', 'name': 'first'})
+        self.assertEqual(['first'], [row.key for row in self.database.view('test_by_name/test_by_name')])
+
+        doc = self.database['a']
+        doc['name'] = 'second'
+        self.database.save(doc)
+
+        self.assertEqual(['second'], [row.key for row in self.database.view('test_by_name/test_by_name')])
+
+    def test_should_require_design_document(self):
+        self.assertRaises(ResourceNotFound, self.database.view, 'test_by_name/test_by_name')
+
+
+class TestCollation(unittest.TestCase):
+    def test_should_order_types_like_couchdb(self):
+        values = [{'a': 1}, ['a'], 'b', 'A', 'a', 10, 2, True, False, None]
+
+        self.assertEqual([None, False, True, 2, 10, 'a', 'A', 'b', ['a'], {'a': 1}], sorted(values, key=collation_key))
+
+
+class TestDatabaseManagerOnMemoryBackend(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://unit-test/', 'mangrove-test')
+        initializer.sync_views(self.dbm, warm=False)
+        define_type(self.dbm, ['clinic'])
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://unit-test/')['mangrove-test']
+
+    def test_should_run_entity_queries_through_python_views(self):
+        for i in range(3):
+            clinic = create_entity(self.dbm, ['clinic'], location=['India', 'MP'], short_code='cli%d' % i)
+            clinic.add_data([('beds', 10 + i)], event_time=datetime(2012, 1, 1 + i, tzinfo=pytz.UTC),
+                            submission=dict(form_code='clinic_form'))
+
+        self.assertEqual(3, len(get_all_entities(self.dbm, ['clinic'])))
+        self.assertEqual(clinic.id, get_by_short_code(self.dbm, 'cli2', ['clinic']).id)
+        self.assertEqual({'beds': 12}, clinic.values({'beds': 'latest'}))
+        stats = self.dbm.load_all_rows_in_view('monthly_aggregate_stats', group_level=4)[0]
+        self.assertEqual([2012, 1, 'clinic_form', ['clinic']], stats.key)
+        self.assertEqual(33, stats.value['sum'])
+
+    def test_should_share_databases_between_managers_on_same_url(self):
+        other = DatabaseManager(None, 'memory://unit-test/', 'mangrove-test')
+
+        self.assertIs(self.dbm.database, other.database)
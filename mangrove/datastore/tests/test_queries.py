@@ -2,8 +2,8 @@
 from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
 from mangrove.datastore.entity import create_entity
 from mangrove.datastore.entity_type import define_type
-from mangrove.datastore.queries import get_entity_count_for_type
-from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase
+from mangrove.datastore.queries import get_entity_count_for_type, iter_entities_by_type
+from mangrove.utils.test_utils.mangrove_test_case import MangroveTestCase, MemoryBackendTestCase
 
 class TestQueries(MangroveTestCase):
     def setUp(self):
@@ -26,3 +26,11 @@ class TestQueries(MangroveTestCase):
         self.assertEqual(1,get_entity_count_for_type(self.manager,entity_type))
 
 
+class TestIterEntitiesByType(MemoryBackendTestCase):
+    def test_should_stream_entities_of_type_in_batches(self):
+        for i in range(5):
+            create_entity(self.manager, ['clinic'], location=['India'], short_code='cli%d' % i).save()
+
+        self.assertEqual(5, len(list(iter_entities_by_type(self.manager, 'clinic', batch_size=2))))
+        self.assertEqual(['cli%d' % i for i in range(5)],
+                         sorted(view.short_code for view in iter_entities_by_type(self.manager, 'clinic', as_view=True)))
@@ -0,0 +1,61 @@
+import unittest
+from couchdb.http import ResourceConflict
+from mock import patch
+from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.documents import ShortCodeCounterDocument
+from mangrove.datastore.entity import create_entity
+from mangrove.datastore.entity_type import define_type
+from mangrove.datastore.short_code_allocator import allocate_short_codes, next_short_code
+from mangrove.errors.MangroveException import FailedToSaveDataObject
+
+
+class TestShortCodeAllocator(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://short-code-test/', 'mangrove-test')
+        initializer.sync_views(self.dbm, warm=False)
+        define_type(self.dbm, ['clinic'])
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://short-code-test/')['mangrove-test']
+
+    def _register(self, short_code):
+        create_entity(self.dbm, ['clinic'], location=['India'], short_code=short_code).save()
+
+    def test_should_continue_after_existing_entities(self):
+        self._register('cli1')
+
+        self.assertEqual('cli2', next_short_code(self.dbm, 'clinic'))
+        self.assertEqual('cli3', next_short_code(self.dbm, 'Clinic'))
+
+    def test_should_use_first_three_characters_without_spaces_as_prefix(self):
+        self.assertEqual('som1', next_short_code(self.dbm, 'so me type'))
+
+    def test_should_reserve_block_and_skip_codes_already_taken(self):
+        self._register('cli2')
+        self._register('cli4')
+
+        self.assertEqual(['cli3', 'cli5', 'cli6', 'cli7'], allocate_short_codes(self.dbm, 'clinic', count=4))
+        self.assertEqual('cli8', next_short_code(self.dbm, 'clinic'))
+
+    def test_should_retry_on_conflicting_counter_update(self):
+        next_short_code(self.dbm, 'clinic')
+        store = ShortCodeCounterDocument.store
+        attempts = []
+
+        def store_after_other_worker(counter, database):
+            attempts.append(counter.last)
+            if len(attempts) == 1:
+                other = ShortCodeCounterDocument.load(database, counter.id)
+                other.last += 1
+                store(other, database)
+            return store(counter, database)
+
+        with patch.object(ShortCodeCounterDocument, 'store', store_after_other_worker):
+            self.assertEqual('cli3', next_short_code(self.dbm, 'clinic'))
+        self.assertEqual([2, 3], attempts)
+
+    def test_should_give_up_after_repeated_conflicts(self):
+        with patch.object(ShortCodeCounterDocument, 'store', side_effect=ResourceConflict()):
+            self.assertRaises(FailedToSaveDataObject, next_short_code, self.dbm, 'clinic')
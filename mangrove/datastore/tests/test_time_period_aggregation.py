@@ -0,0 +1,133 @@
+from datetime import datetime
+import unittest
+from mock import Mock, patch
+import pytz
+from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import DatabaseManager
+from mangrove.datastore.entity import create_entity
+from mangrove.datastore.entity_type import define_type
+from mangrove.datastore.time_period_aggregation import aggregate_for_time_period, aggregate_for_time_periods, \
+    LocationAggregation, LocationFilter, TypeAggregation, Sum, Max, Min, Latest, Day, Month, Week, Year, GRAND_TOTALS
+
+
+class TestPathAggregation(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://aggregation-test/', 'mangrove-test')
+        initializer.sync_views(self.dbm, warm=False)
+        define_type(self.dbm, ['clinic'])
+        clinics = [('cli1', ['India', 'MH', 'Pune'], 10), ('cli2', ['India', 'MH', 'Mumbai'], 20),
+                   ('cli3', ['India', 'KA', 'Mysore'], 5), ('cli4', ['India'], 7)]
+        for short_code, location, patients in clinics:
+            clinic = create_entity(self.dbm, ['clinic'], short_code, location=location)
+            for day in (1, 2):
+                clinic.add_data([('patients', patients * day), ('director', 'Dr. %s' % short_code)],
+                                event_time=datetime(2012, 1, day, tzinfo=pytz.UTC),
+                                submission=dict(form_code='CL1'))
+        clinic.add_data([('patients', 1000)], event_time=datetime(2012, 2, 1, tzinfo=pytz.UTC),
+                        submission=dict(form_code='CL1'))
+        form_model = Mock(form_code='CL1', entity_type=['clinic'])
+        self.patcher = patch('mangrove.datastore.time_period_aggregation.get_form_model_by_code',
+                             return_value=form_model)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        del memory_backend.get_server('memory://aggregation-test/')['mangrove-test']
+
+    def aggregate(self, aggregates, period=Month(1, 2012), **kwargs):
+        return aggregate_for_time_period(self.dbm, 'CL1', period, aggregates, **kwargs)
+
+    def test_should_roll_up_to_location_level(self):
+        values = self.aggregate([Sum('patients'), Max('beds')], aggregate_on=LocationAggregation(2))
+
+        self.assertEqual({('India', 'MH'): {'patients': 90}, ('India', 'KA'): {'patients': 15},
+                          ('India',): {'patients': 21}}, dict(values))
+        self.assertEqual({('India',): {'patients': 1126}},
+                         dict(self.aggregate([Sum('patients')], Year(2012), aggregate_on=LocationAggregation(1))))
+
+    def test_should_combine_entities_above_the_level(self):
+        clinic = create_entity(self.dbm, ['clinic'], 'cli5', location=['India'])
+        clinic.add_data([('patients', 3)], event_time=datetime(2012, 1, 1, tzinfo=pytz.UTC),
+                        submission=dict(form_code='CL1'))
+
+        for aggregate, expected in [(Sum, 24), (Min, 3), (Max, 14)]:
+            values = self.aggregate([aggregate('patients')], aggregate_on=LocationAggregation(2))
+            self.assertEqual({'patients': expected}, values[('India',)])
+
+    def test_should_filter_by_location(self):
+        self.assertEqual({('India', 'MH', 'Pune'): {'patients': 30}, ('India', 'MH', 'Mumbai'): {'patients': 60}},
+                         dict(self.aggregate([Sum('patients')], aggregate_on=LocationAggregation(3),
+                                             filter=LocationFilter(['India', 'MH']))))
+        self.assertEqual({'cli1': {'patients': 20}},
+                         dict(self.aggregate([Max('patients')], filter=LocationFilter(['India', 'MH', 'Pune']))))
+        self.assertEqual(['cli1', 'cli2', 'cli3', 'cli4'],
+                         sorted(self.aggregate([Sum('patients')], filter=LocationFilter(['India']))))
+
+    def test_should_roll_up_any_aggregation_path(self):
+        values = self.aggregate([Sum('patients')], aggregate_on=TypeAggregation('_type', 1), include_grand_totals=True)
+
+        self.assertEqual({'patients': 126}, values[('clinic',)])
+        self.assertEqual({'patients': 126}, values[GRAND_TOTALS])
+
+    def test_should_reject_what_can_not_be_rolled_up(self):
+        self.assertRaises(ValueError, self.aggregate, [Latest('director')], aggregate_on=LocationAggregation(1))
+        self.assertRaises(ValueError, self.aggregate, [Sum('patients')], aggregate_on=TypeAggregation('_type', 1),
+                          filter=LocationFilter(['India']))
+
+
+class TestMultiPeriodAggregation(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://periods-test/', 'mangrove-test')
+        initializer.sync_views(self.dbm, warm=False)
+        define_type(self.dbm, ['clinic'])
+        clinic = create_entity(self.dbm, ['clinic'], 'cli1', location=['India'])
+        for month, patients in [(1, 10), (2, 20), (3, 30), (5, 50), (12, 120)]:
+            clinic.add_data([('patients', patients), ('director', 'Dr. %d' % month)],
+                            event_time=datetime(2011 if month == 12 else 2012, month, 1, tzinfo=pytz.UTC),
+                            submission=dict(form_code='CL1'))
+            clinic.add_data([('patients', 1)], event_time=datetime(2012, month % 12 + 1, 1, tzinfo=pytz.UTC),
+                            submission=dict(form_code='OTHER'))
+        form_model = Mock(form_code='CL1', entity_type=['clinic'])
+        self.patcher = patch('mangrove.datastore.time_period_aggregation.get_form_model_by_code',
+                             return_value=form_model)
+        self.get_form_model = self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        del memory_backend.get_server('memory://periods-test/')['mangrove-test']
+
+    def test_should_read_consecutive_periods_with_one_query_per_view(self):
+        periods = [Month(5, 2012), Month(12, 2011), Month(1, 2012), Month(2, 2012), Month(3, 2012), Month(4, 2012),
+                   Month(1, 2012)]
+        aggregates = [Sum('patients'), Latest('director')]
+
+        with patch.object(self.dbm, 'load_all_rows_in_view', wraps=self.dbm.load_all_rows_in_view) as query:
+            values = aggregate_for_time_periods(self.dbm, 'CL1', periods, aggregates)
+            self.assertEqual(2, query.call_count)
+
+        self.assertEqual(1, self.get_form_model.call_count)
+        self.assertEqual([{'patients': 50, 'director': 'Dr. 5'}, {'patients': 120, 'director': 'Dr. 12'},
+                          {'patients': 10, 'director': 'Dr. 1'}, {'patients': 20, 'director': 'Dr. 2'},
+                          {'patients': 30, 'director': 'Dr. 3'}, None, {'patients': 10, 'director': 'Dr. 1'}],
+                         [value.get('cli1') for value in values])
+        self.assertEqual([dict(aggregate_for_time_period(self.dbm, 'CL1', period, aggregates)) for period in periods],
+                         [dict(value) for value in values])
+
+    def test_should_query_runs_of_each_period_kind_separately(self):
+        periods = [Year(2012), Week(49, 2011), Week(6, 2012), Day(1, 3, 2012), Month(3, 2012), Month(5, 2012)]
+
+        with patch.object(self.dbm, 'load_all_rows_in_view', wraps=self.dbm.load_all_rows_in_view) as query:
+            values = aggregate_for_time_periods(self.dbm, 'CL1', periods, [Sum('patients')],
+                                                include_grand_totals=True)
+            self.assertEqual(6, query.call_count)
+
+        self.assertEqual([110, 120, 20, 30, 30, 50], [value['cli1']['patients'] for value in values])
+        self.assertEqual([110, 120, 20, 30, 30, 50], [value[GRAND_TOTALS]['patients'] for value in values])
+
+    def test_should_know_the_next_period(self):
+        self.assertEqual([2012, 1], Month(12, 2011).next_period().startkey_start)
+        self.assertEqual([2010, 1], Week(53, 2009).next_period().startkey_start)
+        self.assertEqual([2009, 53], Week(52, 2009).next_period().startkey_start)
+        self.assertEqual([2012, 1], Week(52, 2011).next_period().startkey_start)
+        self.assertEqual([2012, 3, 1], Day(29, 2, 2012).next_period().startkey_start)
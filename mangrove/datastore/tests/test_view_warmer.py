@@ -0,0 +1,87 @@
+import unittest
+from mock import Mock, patch
+from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
+from mangrove.datastore.database import DatabaseManager, STALE_OK, STALE_UPDATE_AFTER
+from mangrove.datastore.documents import DocumentBase
+from mangrove.datastore.view_warmer import ViewWarmer, design_docs_for_document_type, warm_up
+
+
+class TestViewWarmer(unittest.TestCase):
+    def setUp(self):
+        self.dbm = DatabaseManager(None, 'memory://view-warmer-test/', 'mangrove-test')
+        initializer.sync_views(self.dbm, warm=False)
+
+    def tearDown(self):
+        del memory_backend.get_server('memory://view-warmer-test/')['mangrove-test']
+
+    def test_should_map_document_types_to_design_docs(self):
+        self.assertEqual(['entity_views'], design_docs_for_document_type('Entity'))
+        self.assertEqual(['datarecord_views'], design_docs_for_document_type('DataRecord'))
+        self.assertEqual([], design_docs_for_document_type('Unknown'))
+        self.assertEqual([], design_docs_for_document_type(None))
+
+    def test_should_query_one_view_per_design_doc(self):
+        warm_up(self.dbm, ['entity_views', 'datarecord_views'], stale=STALE_UPDATE_AFTER)
+
+        built = set(name.split('/')[0] for name in self.dbm.database._indexes)
+        self.assertEqual(set(['entity_views', 'datarecord_views']), built)
+
+    def test_should_schedule_design_docs_of_written_documents(self):
+        warmer = ViewWarmer(self.dbm, delay=60)
+        with patch('mangrove.datastore.view_warmer.Timer') as timer:
+            warmer.documents_written([{'document_type': 'Entity'}, {'document_type': 'DataRecord'}])
+            warmer.documents_written([{'document_type': 'SurveyResponse'}, {'document_type': 'Unknown'}])
+
+        self.assertEqual(1, timer.call_count)
+        self.assertEqual(set(['entity_views', 'datarecord_views', 'surveyresponse_views']), warmer._pending)
+
+    def test_should_warm_up_pending_design_docs_with_update_after(self):
+        warmer = ViewWarmer(self.dbm)
+        with patch('mangrove.datastore.view_warmer.Timer'):
+            warmer.schedule(['entity_views'])
+        with patch('mangrove.datastore.view_warmer.warm_up') as warm:
+            warmer.run()
+
+        warm.assert_called_once_with(self.dbm, ['entity_views'], stale=STALE_UPDATE_AFTER)
+        self.assertEqual(set(), warmer._pending)
+        self.assertIsNone(warmer._timer)
+
+    def test_should_notify_warmer_of_saved_documents(self):
+        self.dbm.view_warmer = Mock(spec=ViewWarmer)
+        self.dbm.database.save({'_id': 'taken'})
+        saved, conflicting = DocumentBase(id='saved', document_type='Entity'), DocumentBase(id='taken')
+
+        self.dbm._save_documents([saved, conflicting])
+
+        written = self.dbm.view_warmer.documents_written.call_args[0][0]
+        self.assertEqual(['saved'], [doc['_id'] for doc in written])
+
+    def test_should_notify_warmer_of_deleted_documents(self):
+        self.dbm.database.save({'_id': 'record', 'document_type': 'DataRecord'})
+        self.dbm.view_warmer = Mock(spec=ViewWarmer)
+
+        self.dbm.delete_documents(['record', 'missing'])
+
+        written = self.dbm.view_warmer.documents_written.call_args[0][0]
+        self.assertEqual([('record', 'DataRecord')], [(doc['_id'], doc['document_type']) for doc in written])
+        self.assertNotIn('record', self.dbm.database)
+
+
+class TestStaleViewQueries(unittest.TestCase):
+    def setUp(self):
+        with patch('couchdb.client.Server'):
+            self.dbm = DatabaseManager(None, 'http://localhost:5984/', 'unit-test')
+
+    def test_should_pass_stale_to_couchdb(self):
+        self.dbm.load_all_rows_in_view('by_short_codes', stale=STALE_OK, key='cli1')
+
+        self.dbm.database.view.assert_called_once_with('entity_views/by_short_codes', stale='ok', key='cli1')
+
+    def test_should_leave_out_stale_by_default(self):
+        self.dbm.load_all_rows_in_view('by_short_codes', key='cli1')
+
+        self.dbm.database.view.assert_called_once_with('entity_views/by_short_codes', key='cli1')
+
+    def test_should_reject_unknown_stale_values(self):
+        self.assertRaises(AssertionError, self.dbm.load_all_rows_in_view, 'by_short_codes', stale='never')
@@ -1,5 +1,6 @@
 
 from _collections import defaultdict
+from datetime import date, timedelta
 from mangrove.form_model.form_model import get_form_model_by_code
 from mangrove.utils.types import is_empty
 
@@ -47,45 +48,114 @@ from mangrove.utils.types import is_empty
 
     2. Aggregate on a location level = 2
 
-    #TODO
+    values = aggregate_for_time_period(
+        self.manager,
+        form_code='CL1',
+        aggregates=[Sum("patients")],
+        period=Month(2, 2010),
+        aggregate_on=LocationAggregation(2)
+        )
+
     Returns {("India", "MH"): {"patients": 2}}
 
     3. All entities, selected fields, filtered by location,
 
-    #TODO
+    values = aggregate_for_time_period(
+        self.manager,
+        form_code='CL1',
+        aggregates=[Sum("patients"), Max('beds')],
+        period=Month(2, 2010),
+        filter=LocationFilter(["India", "MH", "Pune"])
+        )
 
     This returns you one row per entity for all entities of type
     entity_type in Pune with the aggregations applied per field.
+    {"<short_code>": {"patients": 10, 'beds': 300}}
 
     4. Aggregate on a location level = 2, but filter by location,
 
-    #TODO
+    aggregate_on=LocationAggregation(2), filter=LocationFilter(["India"])
 
-    5. Aggregate on any hierarchy,
+    Returns {("India", "MH"): {"patients": 2}, ("India", "KA"): {"patients": 5}}
 
-    #TODO
+    5. Aggregate on any hierarchy, e.g. the first level of the entity type,
+
+    aggregate_on=TypeAggregation("_type", 1)
+
+    Returns {("clinic",): {"patients": 12}}
+
+    The rollups are done by CouchDB with group_level on the
+    *_aggregate_stats_by_path views, so only Sum, Min and Max can be
+    used with aggregate_on or filter.
 
-    6. Fetch aggregation for all the fields for all entities of a
+    6. The same aggregates over several periods, e.g. a yearly trend,
+
+    values = aggregate_for_time_periods(
+        self.manager,
+        form_code='CL1',
+        aggregates=[Sum("patients"), Latest("director")],
+        periods=[Month(m, 2010) for m in range(1, 13)]
+        )
+
+    Returns a list with one result per period, each like the result of
+    aggregate_for_time_period for that period. Consecutive periods are
+    read with one range query per view.
+
+    7. Fetch aggregation for all the fields for all entities of a
     given type, use '*' instead of field name,
 
     #TODO
 """
 
 def aggregate_for_time_period(dbm, form_code, period, aggregates=None, aggregate_on=None, filter=None,
-                              include_grand_totals=False):
+                              include_grand_totals=False, stale=None):
     form_model = get_form_model_by_code(dbm, form_code)
-    statsdict = _get_stats_aggregation(aggregates, dbm, form_model, period)
+    if aggregate_on is not None or filter is not None:
+        statsdict = _get_path_aggregation(aggregates, dbm, form_model, period, aggregate_on, filter, stale)
+        if include_grand_totals is True:
+            _calculate_grand_total(statsdict)
+        return statsdict
+
+    statsdict = _get_stats_aggregation(aggregates, dbm, form_model, period, stale)
 
     if include_grand_totals is True:
         _calculate_grand_total(statsdict)
 
     if _latest_aggregation_required(aggregates):
-        latestdict = _get_latest_aggregation(aggregates, dbm, form_model, period)
+        latestdict = _get_latest_aggregation(aggregates, dbm, form_model, period, stale)
         return _merge(statsdict, latestdict)
 
     return statsdict
 
 
+def aggregate_for_time_periods(dbm, form_code, periods, aggregates=None, include_grand_totals=False, stale=None):
+    form_model = get_form_model_by_code(dbm, form_code)
+    stats = [defaultdict(dict) for period in periods]
+    latest = [defaultdict(dict) for period in periods]
+    views = [('stats_view', stats)]
+    if _latest_aggregation_required(aggregates):
+        views.append(('latest_view', latest))
+
+    for run in _consecutive_runs(periods):
+        indexes_by_key = defaultdict(list)
+        for i in run:
+            indexes_by_key[tuple(periods[i].startkey_start)].append(i)
+        for view, results in views:
+            for period_key, row in _load_periods_view(dbm, form_model, [periods[i] for i in run], view, stale):
+                field_name = _get_field_name(row)
+                result = _get_aggregates_for_field(field_name, aggregates, row)
+                if result is not None:
+                    for i in indexes_by_key.get(period_key, ()):
+                        results[i][_get_short_code(row)][field_name] = result
+
+    values = []
+    for statsdict, latestdict in zip(stats, latest):
+        if include_grand_totals is True:
+            _calculate_grand_total(statsdict)
+        values.append(_merge(statsdict, latestdict) if len(views) > 1 else statsdict)
+    return values
+
+
 class Aggregate(object):
     def __init__(self, field_name, aggregate_name):
         self.field_name = field_name
@@ -119,6 +189,35 @@ class Latest(Aggregate):
         super(Latest, self).__init__(field_name, "latest")
 
 
+LOCATION_PATH = '_geo'
+TYPE_PATH = '_type'
+
+
+class TypeAggregation(object):
+    """Rolls values up to the given level of the entities' aggregation path named path"""
+    def __init__(self, path, level):
+        assert level > 0
+        self.path = path
+        self.level = level
+
+
+class LocationAggregation(TypeAggregation):
+    def __init__(self, level):
+        super(LocationAggregation, self).__init__(LOCATION_PATH, level)
+
+
+class PathFilter(object):
+    """Only entities whose aggregation path named path_name starts with path"""
+    def __init__(self, path_name, path):
+        self.path_name = path_name
+        self.path = list(path)
+
+
+class LocationFilter(PathFilter):
+    def __init__(self, path):
+        super(LocationFilter, self).__init__(LOCATION_PATH, path)
+
+
 class Month(object):
     def __init__(self, month, year):
         self.month = month
@@ -128,6 +227,10 @@ class Month(object):
     def stats_view(self):
         return "monthly_aggregate_stats"
 
+    @property
+    def stats_by_path_view(self):
+        return "monthly_aggregate_stats_by_path"
+
     @property
     def period(self):
         return self.month
@@ -140,6 +243,9 @@ class Month(object):
     def startkey_start(self):
         return [self.year,self.month]
 
+    def next_period(self):
+        return Month(1, self.year + 1) if self.month == 12 else Month(self.month + 1, self.year)
+
 
 class Year(object):
     def __init__(self, year):
@@ -149,6 +255,10 @@ class Year(object):
     def stats_view(self):
         return "yearly_aggregate_stats"
 
+    @property
+    def stats_by_path_view(self):
+        return "yearly_aggregate_stats_by_path"
+
     @property
     def period(self):
         return self.year
@@ -161,6 +271,9 @@ class Year(object):
     def startkey_start(self):
         return [self.year]
 
+    def next_period(self):
+        return Year(self.year + 1)
+
 
 class Week(object):
     def __init__(self, week, year):
@@ -175,6 +288,10 @@ class Week(object):
     def stats_view(self):
         return "weekly_aggregate_stats"
 
+    @property
+    def stats_by_path_view(self):
+        return "weekly_aggregate_stats_by_path"
+
     @property
     def latest_view(self):
         return "weekly_aggregate_latest"
@@ -183,6 +300,10 @@ class Week(object):
     def startkey_start(self):
         return [self.year,self.week]
 
+    def next_period(self):
+        weeks_in_year = date(self.year, 12, 28).isocalendar()[1]
+        return Week(1, self.year + 1) if self.week >= weeks_in_year else Week(self.week + 1, self.year)
+
 class Day(object):
     def __init__(self, day, month,year):
         self.day= day
@@ -197,6 +318,10 @@ class Day(object):
     def stats_view(self):
         return "daily_aggregate_stats"
 
+    @property
+    def stats_by_path_view(self):
+        return "daily_aggregate_stats_by_path"
+
     @property
     def latest_view(self):
         return "daily_aggregate_latest"
@@ -205,17 +330,25 @@ class Day(object):
     def startkey_start(self):
         return [self.year,self.month,self.day]
 
+    def next_period(self):
+        next_day = date(self.year, self.month, self.day) + timedelta(days=1)
+        return Day(next_day.day, next_day.month, next_day.year)
+
 
 def _get_aggregates_for_field(field_name, aggregates, row):
+    return _get_aggregates_for_value(field_name, aggregates, row.value)
+
+
+def _get_aggregates_for_value(field_name, aggregates, value):
     for aggregate in aggregates:
         if aggregate.field_name == field_name:
-            return aggregate.get(row.value)
+            return aggregate.get(value)
     return None
 
 
-def _load_aggregate_view(dbm, form_model, period):
+def _load_aggregate_view(dbm, form_model, period, stale=None):
     startkey = period.startkey_start + [form_model.form_code, form_model.entity_type]
-    rows = dbm.load_all_rows_in_view(period.stats_view, group=True,
+    rows = dbm.load_all_rows_in_view(period.stats_view, stale=stale, group=True,
                                      startkey=startkey,
                                      endkey=startkey + [{}])
     return rows
@@ -231,8 +364,8 @@ def _get_field_name(row):
     return field_name
 
 
-def _get_stats_aggregation(aggregates, dbm, form_model, period):
-    rows = _load_aggregate_view(dbm, form_model, period)
+def _get_stats_aggregation(aggregates, dbm, form_model, period, stale=None):
+    rows = _load_aggregate_view(dbm, form_model, period, stale)
     results = defaultdict(dict)
     for row in rows:
         field_name = _get_field_name(row)
@@ -243,16 +376,16 @@ def _get_stats_aggregation(aggregates, dbm, form_model, period):
     return results
 
 
-def _load_latest_view(dbm, form_model, period):
+def _load_latest_view(dbm, form_model, period, stale=None):
     startkey = period.startkey_start+[form_model.form_code, form_model.entity_type]
-    rows = dbm.load_all_rows_in_view(period.latest_view, group=True,
+    rows = dbm.load_all_rows_in_view(period.latest_view, stale=stale, group=True,
                                      startkey=startkey,
                                      endkey=startkey + [{}])
     return rows
 
 
-def _get_latest_aggregation(aggregates, dbm, form_model, period):
-    rows = _load_latest_view(dbm, form_model, period)
+def _get_latest_aggregation(aggregates, dbm, form_model, period, stale=None):
+    rows = _load_latest_view(dbm, form_model, period, stale)
     results = defaultdict(dict)
     for row in rows:
         field_name = _get_field_name(row)
@@ -262,6 +395,86 @@ def _get_latest_aggregation(aggregates, dbm, form_model, period):
     return results
 
 
+def _get_path_aggregation(aggregates, dbm, form_model, period, aggregate_on=None, filter=None, stale=None):
+    """
+    One query per field on period.stats_by_path_view. With aggregate_on
+    the rows are grouped to its level and keyed by the path to there,
+    otherwise they are keyed by the short code of each entity.
+    """
+    if _latest_aggregation_required(aggregates):
+        raise ValueError('Latest can not be used with aggregate_on or filter')
+    path_name = aggregate_on.path if aggregate_on is not None else filter.path_name
+    if filter is not None and filter.path_name != path_name:
+        raise ValueError('aggregate_on and filter must use the same aggregation path, not %s and %s' %
+                         (path_name, filter.path_name))
+    prefix = period.startkey_start + [form_model.form_code, form_model.entity_type, path_name]
+    results = defaultdict(dict)
+    for field_name in _unique_field_names(aggregates):
+        startkey = prefix + [field_name] + (filter.path if filter is not None else [])
+        options = dict(group_level=len(prefix) + 1 + aggregate_on.level) if aggregate_on is not None \
+            else dict(group=True)
+        rows = dbm.load_all_rows_in_view(period.stats_by_path_view, stale=stale, startkey=startkey,
+                                         endkey=startkey + [{}], **options)
+        stats = {}
+        for row in rows:
+            path = row.key[len(prefix) + 1:]
+            # the entity's short code comes last, wrapped in a list. Entities
+            # with paths shorter than the level are grouped by it; combine them.
+            key = tuple(path[:-1] if path and isinstance(path[-1], list) else path) if aggregate_on is not None \
+                else path[-1][0]
+            stats[key] = _combine_stats(stats[key], row.value) if key in stats else row.value
+        for key, value in stats.items():
+            result = _get_aggregates_for_value(field_name, aggregates, value)
+            if result is not None:
+                results[key][field_name] = result
+    return results
+
+
+def _combine_stats(a, b):
+    return {'sum': a['sum'] + b['sum'], 'count': a['count'] + b['count'], 'min': min(a['min'], b['min']),
+            'max': max(a['max'], b['max']), 'sumsqr': a['sumsqr'] + b['sumsqr']}
+
+
+def _unique_field_names(aggregates):
+    names = []
+    for aggregate in aggregates:
+        if aggregate.field_name not in names:
+            names.append(aggregate.field_name)
+    return names
+
+
+def _consecutive_runs(periods):
+    """Indexes into periods, grouped into runs of consecutive (or repeated) periods of one kind"""
+    runs = []
+    last = None
+    for i in sorted(range(len(periods)), key=lambda i: (periods[i].stats_view, periods[i].startkey_start)):
+        period = periods[i]
+        if last is not None and last.stats_view == period.stats_view and \
+                period.startkey_start in (last.startkey_start, last.next_period().startkey_start):
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+        last = period
+    return runs
+
+
+def _load_periods_view(dbm, form_model, periods, view, stale=None):
+    """
+    One range query from the first to the last of periods, which are
+    consecutive. The range also holds the rows of other forms for those
+    periods; yields (period key, row) for the rows of form_model only.
+    """
+    first, last = periods[0], periods[-1]
+    n = len(first.startkey_start)
+    rows = dbm.load_all_rows_in_view(getattr(first, view), stale=stale, group=True,
+                                     startkey=first.startkey_start,
+                                     endkey=last.startkey_start + [{}])
+    for row in rows:
+        key = row.key
+        if key[n] == form_model.form_code and key[n + 1] == form_model.entity_type:
+            yield tuple(key[:n]), row
+
+
 def _latest_aggregation_required(aggregates):
     result = filter(lambda x: isinstance(x, Latest), aggregates)
     return not is_empty(result)
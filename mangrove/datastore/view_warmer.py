@@ -0,0 +1,81 @@
+""" Background warm-up of view indexes.
+
+CouchDB brings a view index up to date when the view is queried, so the
+first report after a burst of submissions waits for the indexer. A
+ViewWarmer attached to a DatabaseManager notes the document types written
+through it and, after a quiet delay, queries one view of each affected
+design document with stale=update_after. CouchDB then indexes in the
+background and the next request finds the index already built:
+
+    dbm.view_warmer = ViewWarmer(dbm, delay=5)
+
+Requests that can live with a slightly stale index can also pass
+stale=STALE_OK to load_all_rows_in_view and the reporting functions.
+"""
+
+import logging
+from threading import Lock, Timer
+
+from mangrove.bootstrap.views import design_docs
+from database import STALE_UPDATE_AFTER
+
+DEFAULT_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def design_docs_for_document_type(document_type):
+    """The mangrove design documents indexing documents of document_type"""
+    design = '%s_views' % document_type.lower() if document_type else None
+    return [design] if design in design_docs else []
+
+
+def warm_up(dbm, designs, stale=None):
+    """Queries one view of each of designs, which brings the whole design document up to date"""
+    for design in designs:
+        name, funcs = sorted(design_docs[design].items())[0]
+        options = {'reduce': False} if 'reduce' in funcs else {}
+        if stale is not None:
+            options['stale'] = stale
+        try:
+            len(dbm.database.view('%s/%s' % (design, name), limit=1, **options))
+        except Exception:
+            logger.exception('warming up design document %s failed', design)
+
+
+class ViewWarmer(object):
+    def __init__(self, dbm, delay=DEFAULT_DELAY):
+        self.dbm = dbm
+        self.delay = delay
+        self._pending = set()
+        self._timer = None
+        self._lock = Lock()
+
+    def documents_written(self, documents):
+        designs = set()
+        for document in documents:
+            designs.update(design_docs_for_document_type(document.get('document_type')))
+        if designs:
+            self.schedule(designs)
+
+    def schedule(self, designs):
+        """Warm designs up after delay seconds, together with anything else scheduled meanwhile"""
+        with self._lock:
+            self._pending.update(designs)
+            if self._timer is None:
+                self._timer = Timer(self.delay, self.run)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def run(self):
+        with self._lock:
+            designs, self._pending = sorted(self._pending), set()
+            self._timer = None
+        warm_up(self.dbm, designs, stale=STALE_UPDATE_AFTER)
+
+    def cancel(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._pending = set()
@@ -150,10 +150,7 @@ class GlobalRegistrationFormSubmission(FormSubmission):
 
     def void_existing_data_records(self, dbm, form_code=None):
         data_records = dbm.view.data_record_by_form_code(key=[REGISTRATION_FORM_CODE, self.short_code])
-        for data_record in data_records:
-            data_record_doc = data_record.value
-            data_record_doc['void'] = True
-            dbm.database.save(data_record_doc)
+        dbm.void_documents([data_record.value['_id'] for data_record in data_records])
 
 
 class EntityRegistrationFormSubmission(FormSubmission):
@@ -163,10 +160,7 @@ class EntityRegistrationFormSubmission(FormSubmission):
     # soft deletes data records
     def void_existing_data_records(self, dbm, form_code):
         data_records = dbm.view.data_record_by_form_code(key=[form_code, self.short_code])
-        for data_record in data_records:
-            data_record_doc = data_record.value
-            data_record_doc['void'] = True
-            dbm.database.save(data_record_doc)
+        dbm.void_documents([data_record.value['_id'] for data_record in data_records])
 
 
 class FormSubmissionFactory(object):
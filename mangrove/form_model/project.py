@@ -1,9 +1,9 @@
 from collections import OrderedDict
 from datetime import timedelta
 
-from mangrove.datastore.database import DatabaseManager, DataObject
+from mangrove.datastore.database import DatabaseManager, DataObject, VIEW_BATCH_SIZE
 from mangrove.datastore.documents import ProjectDocument
-from mangrove.datastore.entity import Entity, _from_row_to_entity
+from mangrove.datastore.entity import iter_by_short_codes
 from mangrove.errors.MangroveException import DataObjectAlreadyExists
 from mangrove.form_model.deadline import Deadline, Month, Week
 from mangrove.form_model.field import FieldSet
@@ -124,9 +124,7 @@ class Project(FormModel):
         return [dict(zip(fields, data["cols"])) for data in all_data]
 
     def get_associated_datasenders(self, dbm):
-        keys = [([REPORTER], short_code) for short_code in self.data_senders]
-        rows = dbm.view.by_short_codes(reduce=False, include_docs=True, keys=keys)
-        return [Entity.new_from_doc(dbm, Entity.__document_class__.wrap(row.get('doc'))) for row in rows]
+        return list(iter_by_short_codes(dbm, self.data_senders, [REPORTER]))
 
     def _get_data_senders_ids_who_made_submission_for(self, dbm, deadline_date, frequency_period):
         if frequency_period == 'month':
@@ -261,13 +259,18 @@ class Project(FormModel):
         return simple_fields
 
 def load_data_senders(manager, short_codes):
-    form_model = get_form_model_by_code(manager, 'reg')
     fields, labels, codes = get_entity_type_fields(manager)
-    keys = [([REPORTER], short_code) for short_code in short_codes]
-    rows = manager.view.by_short_codes(reduce=False, include_docs=True, keys=keys)
-    data = [tabulate_data(_from_row_to_entity(manager, row), form_model, codes) for row in rows]
+    data = list(iter_data_senders(manager, short_codes, codes))
     return data, fields, labels
 
+def iter_data_senders(manager, short_codes, codes=None, batch_size=VIEW_BATCH_SIZE):
+    """Yields the tabulated data senders with short_codes, batch_size at a time"""
+    form_model = get_form_model_by_code(manager, 'reg')
+    if codes is None:
+        codes = get_entity_type_fields(manager)[2]
+    for entity in iter_by_short_codes(manager, short_codes, [REPORTER], batch_size=batch_size, as_view=True):
+        yield tabulate_data(entity, form_model, codes)
+
 def get_entity_type_fields(manager, form_code='reg'):
     form_model=get_form_model_by_code(manager, form_code)
     json_fields = form_model._doc["json_fields"]
@@ -1,5 +1,5 @@
 from mangrove.datastore.entity import get_all_entities, Entity
-from mangrove.datastore.queries import get_entities_by_type
+from mangrove.datastore.queries import iter_entities_by_type
 
 from mangrove.errors.MangroveException import NumberNotRegisteredException, MultipleReportersForANumberException
 from mangrove.form_model.form_model import MOBILE_NUMBER_FIELD
@@ -30,6 +30,6 @@ def find_reporters_by_from_number(dbm, from_number):
 def get_reporters_who_submitted_data_for_frequency_period(dbm, form_model_id, from_time=None, to_time=None):
     survey_responses = get_survey_responses_for_activity_period(dbm, form_model_id, from_time, to_time)
     source_owner_uids = set([survey_response.owner_uid for survey_response in survey_responses])
-    all_reporters = get_entities_by_type(dbm, 'reporter')
+    all_reporters = iter_entities_by_type(dbm, 'reporter')
     reporters = [reporter for reporter in all_reporters if reporter.id in source_owner_uids]
     return reporters
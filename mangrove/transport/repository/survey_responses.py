@@ -1,3 +1,4 @@
+from mangrove.datastore.database import VIEW_BATCH_SIZE
 from mangrove.errors.MangroveException import DataObjectNotFound
 from mangrove.utils.dates import convert_date_time_to_epoch
 from mangrove.transport.contract.survey_response import SurveyResponse
@@ -7,45 +8,56 @@ ENTITY_QUESTION_DISPLAY_CODE = "q1"
 UNDELETED_SURVEY_RESPONSE_VIEW_NAME = "undeleted_survey_response"
 # DELETED_SURVEY_RESPONSE_VIEW_NAME = "deleted_survey_response"
 
-def survey_response_count(dbm, form_model_id, from_time, to_time, view_name="surveyresponse"):
+def survey_response_count(dbm, form_model_id, from_time, to_time, view_name="surveyresponse", stale=None):
     startkey, endkey = _get_start_and_end_key(form_model_id, from_time, to_time)
-    rows = dbm.load_all_rows_in_view(view_name, descending=True, startkey=startkey, endkey=endkey)
+    rows = dbm.load_all_rows_in_view(view_name, stale=stale, descending=True, startkey=startkey, endkey=endkey)
     return len(rows) and rows[0]['value']['count']
 
 
 def get_survey_responses(dbm, form_model_id, from_time, to_time, page_number=0, page_size=None,
-                         view_name="surveyresponse"):
-    startkey, endkey = _get_start_and_end_key(form_model_id, from_time, to_time)
+                         view_name="surveyresponse", stale=None):
     if page_size is None:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
-            startkey=startkey,
-            endkey=endkey)
-    else:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
-            startkey=startkey,
-            endkey=endkey, skip=page_number * page_size, limit=page_size)
+        return list(iter_survey_responses(dbm, form_model_id, from_time, to_time, view_name=view_name, stale=stale))
+    startkey, endkey = _get_start_and_end_key(form_model_id, from_time, to_time)
+    rows = dbm.load_all_rows_in_view(view_name, stale=stale, reduce=False, descending=True,
+        startkey=startkey,
+        endkey=endkey, skip=page_number * page_size, limit=page_size)
     return [SurveyResponse.new_from_doc(dbm=dbm, doc=SurveyResponse.__document_class__.wrap(row['value'])) for row in
             rows]
 
+
+def iter_survey_responses(dbm, form_model_id, from_time, to_time, view_name="surveyresponse",
+                          batch_size=VIEW_BATCH_SIZE, stale=None):
+    """
+    Yields the survey responses for a form model, newest first, without
+    loading the whole range into memory.
+    """
+    startkey, endkey = _get_start_and_end_key(form_model_id, from_time, to_time)
+    rows = dbm.iter_view(view_name, batch_size=batch_size, stale=stale, reduce=False, descending=True,
+        startkey=startkey,
+        endkey=endkey)
+    return _survey_responses_from_rows(dbm, rows)
+
 def get_survey_responses_with_tag(dbm, form_model_id, from_time, to_time, ds_tag,
                           page_number=0, page_size=None,
-                         view_name="surveyresponse"):
+                         view_name="surveyresponse", stale=None):
 
     startkey, endkey = _get_start_and_end_key_with_tag(form_model_id, ds_tag, from_time, to_time)
     if page_size is None:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
+        rows = dbm.iter_view(view_name, stale=stale, reduce=False, descending=True,
             startkey=startkey,
             endkey=endkey)
     else:
-        rows = dbm.load_all_rows_in_view(view_name, reduce=False, descending=True,
+        rows = dbm.load_all_rows_in_view(view_name, stale=stale, reduce=False, descending=True,
             startkey=startkey,
             endkey=endkey, skip=page_number * page_size, limit=page_size)
     return [SurveyResponse.new_from_doc(dbm=dbm, doc=SurveyResponse.__document_class__.wrap(row['value'])) for row in
             rows]
 
-def get_view_paginated(dbm, form_model_id, skip_records=0, page_size=None, view_name="undeleted_survey_response"):
+def get_view_paginated(dbm, form_model_id, skip_records=0, page_size=None, view_name="undeleted_survey_response",
+                       stale=None):
     startkey, endkey = _get_start_and_end_key(form_model_id, None, None)
-    results = dbm.load_view_results(view_name, reduce=False, descending=True,
+    results = dbm.load_view_results(view_name, stale=stale, reduce=False, descending=True,
             startkey=startkey,
             endkey=endkey, skip=skip_records, limit=page_size)
 
@@ -79,17 +91,20 @@ def survey_responses_by_form_model_id(dbm, form_model_id):
 #     return 0 if len(rows) == 0 else rows[0]['value']['count']
 
 
-def get_survey_responses_for_activity_period(dbm, form_model_id, from_time, to_time):
+def get_survey_responses_for_activity_period(dbm, form_model_id, from_time, to_time, stale=None):
     from_time_in_epoch = convert_date_time_to_epoch(from_time) if from_time is not None else None
     to_time_in_epoch = convert_date_time_to_epoch(to_time) if to_time is not None else None
     startkey, endkey = _get_start_and_end_key(form_model_id, from_time_in_epoch, to_time_in_epoch)
 
-    rows = dbm.load_all_rows_in_view('survey_response_for_activity_period', descending=True,
+    rows = dbm.iter_view('survey_response_for_activity_period', stale=stale, descending=True,
         startkey=startkey,
         endkey=endkey)
-    return [SurveyResponse.new_from_doc(dbm=dbm, doc=SurveyResponse.__document_class__.wrap(row['value'])) for
-            row in
-            rows]
+    return list(_survey_responses_from_rows(dbm, rows))
+
+
+def _survey_responses_from_rows(dbm, rows):
+    for row in rows:
+        yield SurveyResponse.new_from_doc(dbm=dbm, doc=SurveyResponse.__document_class__.wrap(row['value']))
 
 def _get_start_and_end_key(form_model_id, from_time, to_time):
     end = [form_model_id] if from_time is None else [form_model_id, from_time]
@@ -1,6 +1,5 @@
 import unittest
 from mock import Mock, patch
-from mangrove.errors.MangroveException import DataObjectNotFound
 from mangrove.form_model.form_submission import FormSubmission
 from mangrove.form_model.field import HierarchyField, GeoCodeField, ShortCodeField
 from mangrove.form_model.form_model import LOCATION_TYPE_FIELD_NAME
@@ -20,13 +19,11 @@ class TestRegistrationWorkFlow(unittest.TestCase):
         self.dbm = Mock(spec=DatabaseManager)
         self.form_model_mock = Mock(spec=FormModel)
         self.form_model_mock.get_field_by_name = self._location_field
-        self.get_entity_count = patch('mangrove.transport.work_flow.get_entity_count_for_type', new=dummy_get_entity_count_for_type,spec=True)
-        self.get_by_short_code_include_voided = patch('mangrove.transport.work_flow.get_by_short_code_include_voided', new=dummy_get_by_short_code_include_voided)
-        self.get_by_short_code_include_voided.start()
-        self.get_entity_count.start()
+        self.next_short_code = patch('mangrove.transport.work_flow.next_short_code', new=dummy_next_short_code)
+        self.next_short_code.start()
 
     def tearDown(self):
-        self.get_entity_count.stop()
+        self.next_short_code.stop()
 
     def test_should_generate_default_code_if_short_code_is_empty(self):
         registration_work_flow = RegistrationWorkFlow(self.dbm, self.form_model_mock, DummyLocationTree())
@@ -59,11 +56,8 @@ class TestRegistrationWorkFlow(unittest.TestCase):
         geo_code_field.code='g'
         return geo_code_field
 
-def dummy_get_by_short_code_include_voided(dbm,short_code,entity_type):
-    raise DataObjectNotFound("Entity","Not found",short_code)
-
-def dummy_get_entity_count_for_type(dbm, entity_type):
-    return 0
+def dummy_next_short_code(dbm, entity_type):
+    return entity_type[:3] + '1'
 
 def dummy_get_location_hierarchy(foo):
     return [u'arantany']
@@ -2,7 +2,6 @@ import unittest
 from mock import patch, Mock, MagicMock
 from unittest.case import SkipTest
 from mangrove.datastore.database import DatabaseManager
-from mangrove.datastore.entity import Entity
 from mangrove.form_model.field import Field, SelectField, UniqueIdField
 from mangrove.transport.xforms.tests.form_content import expected_response_for_get_all_forms, expected_xform_for_project_on_reporter, expected_xform_for_project_with_unique_id, expected_xform_with_escaped_characters
 from mangrove.transport.xforms.xform import list_all_forms, xform_for
@@ -58,12 +57,11 @@ class TestXform(unittest.TestCase):
         questionnaire_mock.activeLanguages = ["en"]
         questionnaire_mock.entity_questions = [self.text_field(code='entity_question_code')]
         questionnaire_mock.xform = None
-        entity1 = Entity(dbm, short_code="shortCode1", entity_type="someType")
-        entity1._doc.data['name'] = {'value': 'nameOfEntity'}
+        entity1 = {'short_code': 'shortCode1', 'data.name.value': 'nameOfEntity'}
         entities = [entity1, entity1]
         with patch("mangrove.transport.xforms.xform.FormModel") as form_model_mock:
-            with patch("mangrove.transport.xforms.xform.get_all_entities") as get_all_entities_mock:
-                get_all_entities_mock.return_value = entities
+            with patch("mangrove.transport.xforms.xform.iter_all_entities") as iter_all_entities_mock:
+                iter_all_entities_mock.return_value = iter(entities)
                 form_model_mock.get.return_value = questionnaire_mock
                 actual_response = xform_for(dbm, "someFormId", 'rep1')
                 self.assertTrue(self.checker.check_output(actual_response,
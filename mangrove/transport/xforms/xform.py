@@ -2,7 +2,7 @@ import re
 from coverage.html import escape
 from jinja2 import Environment, PackageLoader
 from pyxform import create_survey_element_from_dict
-from mangrove.datastore.entity import get_all_entities
+from mangrove.datastore.entity import iter_all_entities
 from mangrove.form_model.field import field_attributes, SelectField, UniqueIdField
 from mangrove.form_model.form_model import FormModel
 
@@ -39,8 +39,8 @@ class UniqueIdUIField(UniqueIdField):
 
     @property
     def options(self):
-        return [(entity.short_code, escape(entity.data['name']['value'])) for entity in
-                    get_all_entities(self.dbm, [self.unique_id_type])]
+        return [(entity['short_code'], escape(entity['data.name.value'])) for entity in
+                    iter_all_entities(self.dbm, [self.unique_id_type], fields=['short_code', 'data.name.value'])]
 
 def _questionnaire_xform(dbm, questionnaire, reporter_id):
     _escape_special_characters(questionnaire)
@@ -2,8 +2,10 @@
 import os
 import unittest
 from mangrove.bootstrap import initializer
+from mangrove.datastore import memory_backend
 from mangrove.datastore.cache_manager import get_cache_manager
-from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager
+from mangrove.datastore.database import get_db_manager, _delete_db_and_remove_db_manager, DatabaseManager
+from mangrove.datastore.entity_type import define_type
 from mangrove.form_model.form_model import get_form_model_by_code
 from mangrove.utils.test_utils.database_utils import uniq
 
@@ -21,3 +23,14 @@ class MangroveTestCase(unittest.TestCase):
         get_cache_manager().flush_all()
 
 
+class MemoryBackendTestCase(unittest.TestCase):
+    """A fresh database on the in-process memory:// backend, with the views synced and the clinic type defined"""
+    url = 'memory://unit-test/'
+
+    def setUp(self):
+        self.manager = DatabaseManager(None, self.url, 'mangrove-test')
+        initializer.sync_views(self.manager, warm=False)
+        define_type(self.manager, ['clinic'])
+
+    def tearDown(self):
+        del memory_backend.get_server(self.url)['mangrove-test']